@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import CustomUser, Gym, Location, ContactInfo, GymImage, MembershipType, ClassCategory, Amenity, OperatingHour
+from .models import CustomUser, Gym, Location, ContactInfo, GymImage, MembershipType, ClassCategory, Amenity, OperatingHour, GeocodedAddress, GeocodeTask, ImportCheckpoint
 from django.contrib.auth.admin import UserAdmin
 from .forms import CustomUserCreationForm, CustomUserChangeForm
 
@@ -42,13 +42,14 @@ class OperatingHourInline(admin.TabularInline):
 
 @admin.register(Gym)
 class GymAdmin(admin.ModelAdmin):
-    list_display = ('name', 'owner', 'location', 'free_trial', 'classes_available')
+    list_display = ('name', 'owner', 'location', 'free_trial', 'classes_available', 'favorite_count')
     inlines = [GymImageInline, OperatingHourInline, MembershipTypeInline]
     filter_horizontal = ('classes', 'amenities')
 
 @admin.register(Location)
 class LocationAdmin(admin.ModelAdmin):
-    list_display = ('street_address1', 'city', 'zip_code', 'country')
+    list_display = ('street_address1', 'city', 'zip_code', 'country', 'geocode_status')
+    list_filter = ('geocode_status',)
 
 @admin.register(ContactInfo)
 class ContactInfoAdmin(admin.ModelAdmin):
@@ -69,3 +70,16 @@ class AmenityAdmin(admin.ModelAdmin):
 @admin.register(OperatingHour)
 class OperatingHourAdmin(admin.ModelAdmin):
     list_display = ('gym', 'day', 'open_time', 'close_time')
+
+@admin.register(GeocodedAddress)
+class GeocodedAddressAdmin(admin.ModelAdmin):
+    list_display = ('query', 'coordinates', 'updated_at')
+    search_fields = ('query',)
+
+@admin.register(GeocodeTask)
+class GeocodeTaskAdmin(admin.ModelAdmin):
+    list_display = ('location', 'attempts', 'run_after', 'last_error')
+
+@admin.register(ImportCheckpoint)
+class ImportCheckpointAdmin(admin.ModelAdmin):
+    list_display = ('source', 'rows_done', 'updated_at')
@@ -0,0 +1,30 @@
+"""Version tokens for cache invalidation.
+
+A version is a random token stored in the cache. Readers build their keys
+from it and writers replace it, which orphans every key built from the old
+token. Tokens are never reused, so a version that was evicted and recreated
+cannot bring stale entries back.
+"""
+import uuid
+
+from django.core.cache import caches
+
+
+def _version_key(name):
+    return f'version:{name}'
+
+
+def get_version(name, alias='default'):
+    """Returns the current token for ``name``, creating one if there is none."""
+    cache = caches[alias]
+    key = _version_key(name)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(name, alias='default'):
+    """Invalidates everything cached under the current token for ``name``."""
+    caches[alias].set(_version_key(name), uuid.uuid4().hex, timeout=None)
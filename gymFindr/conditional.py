@@ -0,0 +1,64 @@
+"""ETag/Last-Modified validators for ``django.views.decorators.http.condition``.
+
+Validators are derived from the database, never from per-process cache
+tokens, so a change committed by any worker is seen by all of them. Each
+costs one small indexed query, made once per request, and runs before the
+view loads related rows or renders a template, so a conditional request
+that still matches is answered with a bare 304.
+
+Pages that differ per user carry the user in their ETag and no
+Last-Modified, which a client could otherwise match across users.
+"""
+import hashlib
+
+from .detail_cache import gym_updated_at
+from .favorites import favorites_state
+from .geocoders import GeocodingError
+from .opening_hours import current_minute_of_week
+from .search import lookup_search_location
+from .search_cache import catalog_version
+
+
+def _etag(*parts):
+    return hashlib.sha1(':'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+def gym_detail_etag(request, pk):
+    # The owner's copy of the page has the Edit/Delete block and each user's
+    # copy the favorite button, so the user and their favorites are part of the tag
+    return _etag('gym', pk, gym_updated_at(request, pk), request.user.pk, favorites_state(request))
+
+
+def catalog_etag(request, *args, **kwargs):
+    """Tag for pages built from the search documents."""
+    # "Open now" results change with the clock, not only with the data
+    minute = current_minute_of_week() if request.GET.get('open_now') else None
+    return _etag(
+        request.path, request.GET.urlencode(), catalog_version(request)[0], minute,
+        # Signed-in users see which results they favorited
+        request.user.pk, favorites_state(request),
+    )
+
+
+def catalog_last_modified(request, *args, **kwargs):
+    # Only the ETag tells signed-in users' favorites and "open now" minutes apart
+    if request.user.is_authenticated or request.GET.get('open_now'):
+        return None
+    return catalog_version(request)[1]
+
+
+def search_etag(request, *args, **kwargs):
+    """Tag for search results, which also depend on where ``search_location`` was geocoded to.
+
+    There is none while the place cannot be geocoded, so the empty page
+    shown meanwhile is never revalidated once geocoding works again.
+    """
+    place = None
+    location = (request.GET.get('search_location') or '').strip()
+    current_location = request.GET.get('use_current_location') and request.GET.get('lat') and request.GET.get('lng')
+    if location and not current_location:
+        try:
+            place = lookup_search_location(request, location)
+        except GeocodingError:
+            return None
+    return _etag(catalog_etag(request, *args, **kwargs), place)
@@ -0,0 +1,52 @@
+"""Cache of the public part of gym detail pages.
+
+Fragments are keyed by the gym's ``updated_at``, which moves whenever the
+gym or a row rendered on its page changes (see Gym.touch and the receivers
+in ``signals``). The key comes from the database rather than from a token
+in the cache, so a write committed by any worker is seen by every other one
+on its next request, even when each worker has its own cache. A fragment
+is stored under the ``updated_at`` of the row it was rendered from, so a
+write racing with a render can only orphan the fragment, never leave a
+stale one in place.
+"""
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import Gym
+
+DETAIL_CACHE_ALIAS = getattr(settings, 'DETAIL_CACHE_ALIAS', 'default')
+DETAIL_CACHE_TIMEOUT = getattr(settings, 'DETAIL_CACHE_TIMEOUT', 60 * 60 * 24)
+
+
+def gym_updated_at(request, gym_id):
+    """Returns the gym's ``updated_at``, or None if there is no such gym.
+
+    The value is kept on the request, so the ETag check and the
+    view share one query.
+    """
+    cached = getattr(request, '_gym_updated_at', None)
+    if cached is None:
+        cached = request._gym_updated_at = {}
+    if gym_id not in cached:
+        cached[gym_id] = Gym.objects.filter(pk=gym_id).values_list('updated_at', flat=True).first()
+    return cached[gym_id]
+
+
+def _fragment_key(gym_id, updated_at):
+    return f'gymdetail:{gym_id}:{updated_at.isoformat()}'
+
+
+def get_detail_fragment(gym_id, updated_at):
+    """Returns the cached fragment for the gym as of ``updated_at``, or None on a miss.
+
+    A fragment is a dict with the rendered ``html`` and the gym's ``owner_id``.
+    """
+    if updated_at is None:
+        return None
+    return caches[DETAIL_CACHE_ALIAS].get(_fragment_key(gym_id, updated_at))
+
+
+def set_detail_fragment(gym, html):
+    fragment = {'html': html, 'owner_id': gym.owner_id}
+    caches[DETAIL_CACHE_ALIAS].set(_fragment_key(gym.pk, gym.updated_at), fragment, DETAIL_CACHE_TIMEOUT)
+    return fragment
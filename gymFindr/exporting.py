@@ -0,0 +1,135 @@
+"""Streaming catalog export, used by the export_gyms command and GymExportView.
+
+Gyms are walked in id order with ``.iterator(chunk_size=...)``, so the
+database sends them in batches and each batch gets one prefetch query per
+relation. Output is produced one row at a time by generators. Memory
+therefore stays flat whatever the catalog size, and the first bytes go out
+before the last gym is read. Rows use the record layout read by
+gymFindr.importing, so an export can be imported elsewhere.
+"""
+import csv
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Prefetch
+
+from .models import Amenity, ClassCategory, Gym, MembershipType, OperatingHour
+
+EXPORT_CHUNK_SIZE = getattr(settings, 'EXPORT_CHUNK_SIZE', 2000)
+
+CSV_COLUMNS = [
+    'id', 'name', 'description', 'free_trial', 'classes_available',
+    'street_address1', 'street_address2', 'city', 'zip_code', 'country', 'latitude', 'longitude',
+    'email', 'phone', 'website', 'classes', 'amenities', 'memberships', 'hours',
+]
+
+
+def export_queryset():
+    return (
+        Gym.objects.select_related('location', 'contact_info')
+        .prefetch_related(
+            Prefetch('classes', queryset=ClassCategory.objects.order_by('name')),
+            Prefetch('amenities', queryset=Amenity.objects.order_by('name')),
+            Prefetch('membership_types', queryset=MembershipType.objects.order_by('type', 'price')),
+            Prefetch('operating_hours', queryset=OperatingHour.objects.order_by(OperatingHour.week_order(), 'open_time')),
+        )
+        .order_by('pk')
+    )
+
+
+def gym_record(gym):
+    """Returns the export record of a gym loaded by ``export_queryset``."""
+    location = gym.location
+    contact_info = gym.contact_info
+    coordinates = location.coordinates if location else None
+    return {
+        'id': gym.pk,
+        'name': gym.name,
+        'description': gym.description,
+        'free_trial': gym.free_trial,
+        'classes_available': gym.classes_available,
+        'street_address1': location.street_address1 if location else '',
+        'street_address2': (location.street_address2 or '') if location else '',
+        'city': location.city if location else '',
+        'zip_code': location.zip_code if location else '',
+        'country': location.country if location else '',
+        'latitude': coordinates.y if coordinates else None,
+        'longitude': coordinates.x if coordinates else None,
+        'email': contact_info.email if contact_info else '',
+        'phone': contact_info.phone if contact_info else '',
+        'website': (contact_info.website or '') if contact_info else '',
+        'classes': [category.name for category in gym.classes.all()],
+        'amenities': [amenity.name for amenity in gym.amenities.all()],
+        'memberships': [
+            {'type': membership.type, 'price': membership.price} for membership in gym.membership_types.all()
+        ],
+        'hours': [
+            {'day': hour.day, 'open': hour.open_time.strftime('%H:%M'), 'close': hour.close_time.strftime('%H:%M')}
+            for hour in gym.operating_hours.all()
+        ],
+    }
+
+
+def iter_records(chunk_size=EXPORT_CHUNK_SIZE):
+    for gym in export_queryset().iterator(chunk_size=chunk_size):
+        yield gym_record(gym)
+
+
+class _Echo:
+    """File-like object whose write() hands the line back to csv.writer's caller."""
+
+    def write(self, value):
+        return value
+
+
+def _csv_value(name, value):
+    if name in ('classes', 'amenities'):
+        return ';'.join(value)
+    if name == 'memberships':
+        return ';'.join(f"{item['type']}:{item['price']}" for item in value)
+    if name == 'hours':
+        return ';'.join(f"{item['day']} {item['open']}-{item['close']}" for item in value)
+    return '' if value is None else value
+
+
+def export_csv(records):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(CSV_COLUMNS)
+    for record in records:
+        yield writer.writerow([_csv_value(name, record[name]) for name in CSV_COLUMNS])
+
+
+def _dumps(value):
+    return json.dumps(value, cls=DjangoJSONEncoder, separators=(',', ':'))
+
+
+def export_ndjson(records):
+    for record in records:
+        yield _dumps(record) + '\n'
+
+
+def export_geojson(records):
+    yield '{"type":"FeatureCollection","features":[\n'
+    separator = ''
+    for record in records:
+        latitude, longitude = record.pop('latitude'), record.pop('longitude')
+        geometry = {'type': 'Point', 'coordinates': [longitude, latitude]} if latitude is not None else None
+        feature = {'type': 'Feature', 'id': record['id'], 'geometry': geometry, 'properties': record}
+        yield separator + _dumps(feature)
+        separator = ',\n'
+    yield '\n]}\n'
+
+
+# format -> (writer, content type, file extension)
+EXPORT_FORMATS = {
+    'csv': (export_csv, 'text/csv', 'csv'),
+    'geojson': (export_geojson, 'application/geo+json', 'geojson'),
+    'ndjson': (export_ndjson, 'application/x-ndjson', 'ndjson'),
+}
+
+
+def export_catalog(format, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yields the whole catalog as strings in ``format``, one of EXPORT_FORMATS."""
+    writer = EXPORT_FORMATS[format][0]
+    return writer(iter_records(chunk_size))
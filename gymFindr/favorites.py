@@ -0,0 +1,91 @@
+"""Favorite gyms: idempotent writes, per-user favorited state and Gym.favorite_count.
+
+``add_favorite`` is one ``INSERT ... ON CONFLICT DO NOTHING`` and
+``remove_favorite`` one ``DELETE``. Gym.favorite_count only moves, with an
+``F()`` update in the same transaction, when a row really appeared or
+disappeared, so repeating a request changes nothing. Favorites deleted some
+other way (a cascade from a deleted user, the admin) leave the count high
+until ``reconcile_favorite_counts`` runs.
+
+Pages show the favorited state of every gym through ``with_favorite_state``,
+one ``EXISTS`` column in the query that loads them. ``favorites_state``
+summarizes a user's favorites for the ETags of those pages.
+"""
+from django.db import connection, transaction
+from django.db.models import Count, Exists, F, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from .models import Favorite, Gym
+
+
+def favorites_state(request):
+    """Returns ``(count, latest created_at)`` of the user's favorites, None for anonymous users.
+
+    Any favorite or unfavorite changes it. It is read once per request.
+    """
+    if not request.user.is_authenticated:
+        return None
+    if not hasattr(request, '_favorites_state'):
+        state = Favorite.objects.filter(user=request.user).aggregate(count=Count('pk'), latest=Max('created_at'))
+        request._favorites_state = (state['count'], state['latest'])
+    return request._favorites_state
+
+
+def _changed(gym_id, delta):
+    # Never below zero, which the column's CHECK constraint would reject, if the count drifted low
+    Gym.objects.filter(pk=gym_id).update(favorite_count=Greatest(F('favorite_count') + delta, 0))
+
+
+def add_favorite(user, gym_id):
+    """Favorites a gym for ``user``. Returns False if it already was a favorite."""
+    table = connection.ops.quote_name(Favorite._meta.db_table)
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {table} (user_id, gym_id, created_at) VALUES (%s, %s, %s) '
+                'ON CONFLICT (user_id, gym_id) DO NOTHING RETURNING id',
+                [user.pk, gym_id, timezone.now()],
+            )
+            created = cursor.fetchone() is not None
+        if created:
+            _changed(gym_id, 1)
+    return created
+
+
+def remove_favorite(user, gym_id):
+    """Removes a gym from ``user``'s favorites. Returns False if it was not a favorite."""
+    with transaction.atomic():
+        deleted, _ = Favorite.objects.filter(user=user, gym_id=gym_id).delete()
+        if deleted:
+            _changed(gym_id, -deleted)
+    return bool(deleted)
+
+
+def with_favorite_state(queryset, user):
+    """Annotates ``is_favorite`` for ``user`` on a queryset of Gym or GymSearchDocument rows.
+
+    Both are keyed by the gym id. Anonymous users get the queryset back as is.
+    """
+    if not user.is_authenticated:
+        return queryset
+    return queryset.annotate(is_favorite=Exists(Favorite.objects.filter(user=user, gym_id=OuterRef('pk'))))
+
+
+def reconcile_favorite_counts(batch_size=1000):
+    """Resets every drifted Gym.favorite_count to its number of Favorite rows, in id-ordered batches.
+
+    Returns the number of gyms corrected.
+    """
+    counts = Favorite.objects.filter(gym=OuterRef('pk')).order_by().values('gym').annotate(count=Count('pk')).values('count')
+    actual = Coalesce(Subquery(counts), 0)
+    corrected = 0
+    last_id = 0
+    while True:
+        gym_ids = list(
+            Gym.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:batch_size]
+        )
+        if not gym_ids:
+            return corrected
+        corrected += Gym.objects.filter(pk__in=gym_ids).exclude(favorite_count=actual).update(favorite_count=actual)
+        last_id = gym_ids[-1]
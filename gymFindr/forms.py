@@ -2,8 +2,12 @@ from django import forms
 from django import forms
 from django.contrib.auth.forms import UserCreationForm, UserChangeForm
 from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
 from django.forms import inlineformset_factory
+from django.forms.models import ModelChoiceIterator
 from .models import Gym, Location, ContactInfo, GymImage, MembershipType, ClassCategory, Amenity, OperatingHour
+from .search_index import deferred_search_refresh
+from .taxonomy import taxonomy_objects
 
 
 
@@ -36,9 +40,48 @@ class CustomUserChangeForm(UserChangeForm):
         model = User
         fields = ['email', 'first_name', 'last_name', 'is_business_owner', 'business_name', 'website']
 
+class TaxonomyChoiceIterator(ModelChoiceIterator):
+    """Lists the cached rows of gymFindr.taxonomy instead of running the field's queryset."""
+
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield ("", self.field.empty_label)
+        for obj in taxonomy_objects(self.queryset.model):
+            yield self.choice(obj)
+
+    def __len__(self):
+        return len(taxonomy_objects(self.queryset.model)) + (self.field.empty_label is not None)
+
+    def __bool__(self):
+        return self.field.empty_label is not None or bool(taxonomy_objects(self.queryset.model))
+
+class TaxonomyMultipleChoiceField(forms.ModelMultipleChoiceField):
+    """ModelMultipleChoiceField for ClassCategory/Amenity, rendered and validated from the taxonomy cache.
+
+    Cleans to a list of the selected rows rather than a queryset.
+    """
+    iterator = TaxonomyChoiceIterator
+
+    def __init__(self, model, **kwargs):
+        super().__init__(queryset=model.objects.all(), **kwargs)
+
+    def _check_values(self, value):
+        try:
+            value = {str(pk) for pk in value}
+        except TypeError:
+            raise ValidationError(self.error_messages['invalid_list'], code='invalid_list')
+        objects = {str(obj.pk): obj for obj in taxonomy_objects(self.queryset.model)}
+        if not value <= objects.keys():
+            # The row may have been added by another process since this one loaded them
+            objects = {str(obj.pk): obj for obj in taxonomy_objects(self.queryset.model, refresh=True)}
+        for pk in value:
+            if pk not in objects:
+                raise ValidationError(self.error_messages['invalid_choice'], code='invalid_choice', params={'value': pk})
+        return [obj for pk, obj in objects.items() if pk in value]
+
 class GymForm(forms.ModelForm):
-    classes = forms.ModelMultipleChoiceField(queryset=ClassCategory.objects.all(), required=False, widget=forms.CheckboxSelectMultiple)
-    amenities = forms.ModelMultipleChoiceField(queryset=Amenity.objects.all(), required=False, widget=forms.CheckboxSelectMultiple)
+    classes = TaxonomyMultipleChoiceField(ClassCategory, required=False, widget=forms.CheckboxSelectMultiple)
+    amenities = TaxonomyMultipleChoiceField(Amenity, required=False, widget=forms.CheckboxSelectMultiple)
     class Meta:
         model = Gym
         exclude = ('owner', 'location', 'contact_info')
@@ -46,7 +89,8 @@ class GymForm(forms.ModelForm):
 class LocationForm(forms.ModelForm):
     class Meta:
         model = Location
-        fields = '__all__'
+        # Coordinates are filled in by the geocode worker
+        exclude = ('coordinates',)
 
 class ContactInfoForm(forms.ModelForm):
     class Meta:
@@ -55,28 +99,90 @@ class ContactInfoForm(forms.ModelForm):
 
 class GymSearchForm(forms.Form):
     query = forms.CharField(required=False, widget=forms.TextInput(attrs={'placeholder': 'Search by name, classes...'}))
-    class_category = forms.ModelChoiceField(queryset=ClassCategory.objects.all(), required=False)
-    amenity = forms.ModelChoiceField(queryset=Amenity.objects.all(), required=False)
+    class_category = TaxonomyMultipleChoiceField(ClassCategory, required=False, widget=forms.CheckboxSelectMultiple, label="Classes")
+    amenity = TaxonomyMultipleChoiceField(Amenity, required=False, widget=forms.CheckboxSelectMultiple, label="Amenities")
     search_location = forms.CharField(required=False, widget=forms.TextInput(attrs={'placeholder': 'City or Zip'}))
+    max_distance = forms.FloatField(required=False, min_value=0.1, label="Max distance (km)")
     use_current_location = forms.BooleanField(required=False, label="Use my current location")
+    # Filled in by the browser's geolocation API when use_current_location is ticked
+    lat = forms.FloatField(required=False, min_value=-90, max_value=90, widget=forms.HiddenInput(attrs={'id': 'lat'}))
+    lng = forms.FloatField(required=False, min_value=-180, max_value=180, widget=forms.HiddenInput(attrs={'id': 'lng'}))
+    open_now = forms.BooleanField(required=False, label="Open now")
+    open_day = forms.ChoiceField(choices=[('', 'Any day')] + OperatingHour.DAY_CHOICES, required=False, label="Open on")
+    open_time = forms.TimeField(required=False, label="At", widget=forms.TimeInput(attrs={'type': 'time'}))
+    pass_type = forms.ChoiceField(choices=[('', 'Any (price per month)')] + MembershipType.MEMBERSHIP_CHOICES, required=False, label="Membership")
+    min_price = forms.DecimalField(required=False, min_value=0, decimal_places=2, label="Min price ($)")
+    max_price = forms.DecimalField(required=False, min_value=0, decimal_places=2, label="Max price ($)")
+    sort = forms.ChoiceField(choices=[('', 'Best match'), ('price', 'Price: low to high')], required=False, label="Sort by")
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('open_time') and not cleaned_data.get('open_day'):
+            self.add_error('open_day', "Pick the day you want the gym to be open on.")
+        return cleaned_data
+
+class ExistingRowField(forms.ModelChoiceField):
+    """Primary key field of an inline formset's existing rows.
+
+    Django checks each submitted id with a query of its own; this one looks
+    it up among the rows the formset has already loaded for the gym.
+    """
+
+    def __init__(self, formset, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.formset = formset
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        try:
+            row = self.formset._existing_object(self.queryset.model._meta.pk.to_python(value))
+        except ValidationError:
+            row = None
+        if row is None:
+            raise ValidationError(self.error_messages['invalid_choice'], code='invalid_choice', params={'value': value})
+        return row
+
+class GymInlineFormSet(forms.BaseInlineFormSet):
+    """Inline formset whose validation costs the same number of queries however many rows it edits."""
+
+    def add_fields(self, form, index):
+        super().add_fields(form, index)
+        field = form.fields.get(self._pk_field.name)
+        if isinstance(field, forms.ModelChoiceField):
+            form.fields[self._pk_field.name] = ExistingRowField(
+                self, field.queryset, initial=field.initial, required=False, widget=field.widget,
+            )
 
 class GymImageForm(forms.ModelForm):
     class Meta:
         model = GymImage
         fields = ('image',)
 
-GymImageFormSet = forms.inlineformset_factory(Gym, GymImage, form=GymImageForm, extra=1)
+GymImageFormSet = forms.inlineformset_factory(Gym, GymImage, form=GymImageForm, formset=GymInlineFormSet, extra=1)
 
 class MembershipTypeForm(forms.ModelForm):
     class Meta:
         model = MembershipType
         fields = '__all__'
 
-MembershipTypeFormSet = forms.inlineformset_factory(Gym, MembershipType, form=MembershipTypeForm, extra=1)
+class BaseMembershipTypeFormSet(GymInlineFormSet):
+    def save(self, commit=True):
+        # One search document refresh for the gym's new prices, not one per row
+        with deferred_search_refresh():
+            return super().save(commit)
+
+MembershipTypeFormSet = forms.inlineformset_factory(Gym, MembershipType, form=MembershipTypeForm, formset=BaseMembershipTypeFormSet, extra=1)
 
 class OperatingHourForm(forms.ModelForm):
     class Meta:
         model = OperatingHour
         fields = '__all__'
 
-OperatingHourFormSet = forms.inlineformset_factory(Gym, OperatingHour, form=OperatingHourForm, extra=1)
+class BaseOperatingHourFormSet(GymInlineFormSet):
+    def save(self, commit=True):
+        # One opening intervals rebuild for the gym's new hours, not one per row
+        with deferred_search_refresh():
+            return super().save(commit)
+
+OperatingHourFormSet = forms.inlineformset_factory(Gym, OperatingHour, form=OperatingHourForm, formset=BaseOperatingHourFormSet, extra=1)
@@ -0,0 +1,66 @@
+from django.contrib.gis.db.models import PointField
+from django.contrib.postgres.fields import ArrayField
+from django.db.models import BigIntegerField, FloatField, Func, Value
+from django.db.models.functions import Cast
+
+
+class KNNDistance(Func):
+    """PostGIS ``<->`` distance operator.
+
+    Unlike ``ST_Distance`` it can be answered by walking the GiST index on
+    the geography column, so ``ORDER BY ... LIMIT n`` only touches the
+    nearest rows instead of sorting the whole table.
+    """
+    arg_joiner = ' <-> '
+    template = '(%(expressions)s)'
+    output_field = FloatField()
+
+    def __init__(self, expression, point, **extra):
+        point = Value(point, output_field=PointField(geography=True, srid=point.srid or 4326))
+        super().__init__(expression, point, **extra)
+
+
+class PlanarPoint(Cast):
+    """A geography point column cast to a planar SRID 4326 geometry.
+
+    Bounding-box lookups (``&&``) on the cast are plain lng/lat rectangles,
+    and an expression index built from the same expression answers them.
+    """
+
+    def __init__(self, expression):
+        super().__init__(expression, PointField(srid=4326))
+
+
+class Longitude(Func):
+    """``ST_X`` of a planar point, see PlanarPoint."""
+    function = 'ST_X'
+    output_field = FloatField()
+
+
+class Latitude(Func):
+    """``ST_Y`` of a planar point, see PlanarPoint."""
+    function = 'ST_Y'
+    output_field = FloatField()
+
+
+class PairedValue(Func):
+    """The float paired with ``expression``'s value in two parallel arrays.
+
+    ``values[array_position(keys, expression)]``, NULL for keys not in the
+    list. Both lists travel as two array parameters, so the statement stays
+    small however many pairs there are.
+    """
+    output_field = FloatField()
+
+    def __init__(self, expression, keys, values, **extra):
+        keys = Value(list(keys), output_field=ArrayField(BigIntegerField()))
+        values = Value(list(values), output_field=ArrayField(FloatField()))
+        super().__init__(expression, keys, values, **extra)
+
+    def as_sql(self, compiler, connection, **extra_context):
+        expression, keys, values = self.get_source_expressions()
+        expression_sql, expression_params = compiler.compile(expression)
+        keys_sql, keys_params = compiler.compile(keys)
+        values_sql, values_params = compiler.compile(values)
+        sql = f'(({values_sql})::float8[])[array_position(({keys_sql})::bigint[], ({expression_sql})::bigint)]'
+        return sql, (*values_params, *keys_params, *expression_params)
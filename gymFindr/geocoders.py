@@ -0,0 +1,175 @@
+"""Geocoder backends used by gymFindr.geocoding.
+
+Backends are configured with ``settings.GEOCODER_BACKENDS``, a list of
+``{'BACKEND': dotted.path, 'OPTIONS': {...}}`` entries tried in order.
+Offline backends (``remote = False``) are consulted before the database
+cache, network backends only after it.
+"""
+import csv
+import logging
+import threading
+from functools import lru_cache
+
+import requests
+from django.conf import settings
+from django.utils.module_loading import import_string
+from requests.adapters import HTTPAdapter
+
+
+logger = logging.getLogger(__name__)
+
+
+class GeocodingError(Exception):
+    """Raised when the geocoding service could not give a definitive answer."""
+
+
+def normalize_address(address):
+    """Returns the lookup key for an address: lowercased, single spaced and comma separated."""
+    parts = [' '.join(part.split()) for part in (address or '').lower().split(',')]
+    return ', '.join(part for part in parts if part)
+
+
+class BaseGeocoder:
+    """Resolves an address to ``(lat, lng)``.
+
+    ``geocode`` returns ``None`` when the backend has no match and raises
+    ``GeocodingError`` when it could not answer, so that the result is not cached.
+    """
+    remote = True
+
+    def geocode(self, address):
+        raise NotImplementedError
+
+
+class GoogleGeocoder(BaseGeocoder):
+    """Google Maps Geocoding API over a pooled keep-alive session."""
+    url = 'https://maps.googleapis.com/maps/api/geocode/json'
+
+    def __init__(self, api_key=None, timeout=(3.05, 10), pool_size=10):
+        self.api_key = api_key or settings.GOOGLE_MAPS_API_KEY
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+
+    def geocode(self, address):
+        params = {'address': address, 'key': self.api_key}
+        try:
+            response = self.session.get(self.url, params=params, timeout=self.timeout)
+            if response.status_code != 200:
+                raise GeocodingError(f'Geocoding API returned HTTP {response.status_code}')
+            data = response.json()
+            if data.get('status') not in (None, 'OK', 'ZERO_RESULTS'):
+                raise GeocodingError(f"Geocoding API returned {data['status']}")
+            if data.get('results'):
+                location = data['results'][0]['geometry']['location']
+                return float(location['lat']), float(location['lng'])
+            return None
+        except requests.RequestException as exc:
+            raise GeocodingError(str(exc)) from exc
+        except (ValueError, LookupError, TypeError, AttributeError) as exc:
+            # Not JSON, or not shaped like a Geocoding API response
+            raise GeocodingError(f'Unexpected Geocoding API response: {exc!r}') from exc
+
+
+class GazetteerGeocoder(BaseGeocoder):
+    """Offline lookups of city and postal code centroids from a CSV gazetteer.
+
+    The file needs a ``name,region,country,latitude,longitude`` header and may
+    carry a ``population`` column; ``name`` is a place name or a postal code.
+    Each row is indexed as ``name``, ``name, region``, ``name, country`` and
+    ``name, region, country`` so that "Brooklyn", "10001" or "Austin, TX"
+    resolve with a dictionary lookup. Ambiguous names go to the most
+    populous place. Free-form street addresses are left to the next backend.
+    """
+    remote = False
+
+    def __init__(self, path=None):
+        self.path = path
+        self._index = None
+        self._lock = threading.Lock()
+
+    def geocode(self, address):
+        entry = self.index.get(normalize_address(address))
+        if entry is None:
+            return None
+        return entry[0], entry[1]
+
+    @property
+    def index(self):
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    self._index = self._load()
+        return self._index
+
+    def _load(self):
+        index = {}
+        if not self.path:
+            return index
+        try:
+            with open(self.path, newline='', encoding='utf-8') as fp:
+                for row in csv.DictReader(fp):
+                    try:
+                        entry = (float(row['latitude']), float(row['longitude']), int(row.get('population') or 0))
+                    except (KeyError, TypeError, ValueError):
+                        continue
+                    name, region, country = row.get('name'), row.get('region'), row.get('country')
+                    for key in (
+                        [name],
+                        [name, region],
+                        [name, country],
+                        [name, region, country],
+                    ):
+                        if not all(key):
+                            continue
+                        key = normalize_address(', '.join(key))
+                        current = index.get(key)
+                        if current is None or current[2] < entry[2]:
+                            index[key] = entry
+        except FileNotFoundError:
+            logger.warning('Gazetteer file %s not found, offline geocoding is disabled', self.path)
+        else:
+            logger.info('Loaded %s gazetteer keys from %s', len(index), self.path)
+        return index
+
+
+class ChainGeocoder(BaseGeocoder):
+    """Tries each backend in order and returns the first match."""
+
+    def __init__(self, backends):
+        self.backends = list(backends)
+
+    @property
+    def remote(self):
+        return any(backend.remote for backend in self.backends)
+
+    def geocode(self, address, remote=None):
+        """Runs all backends, or only the network (``remote=True``) or offline ones.
+
+        A miss is only definitive when every backend answered; if one of them
+        failed the last error is raised instead.
+        """
+        error = None
+        for backend in self.backends:
+            if remote is not None and backend.remote != remote:
+                continue
+            try:
+                result = backend.geocode(address)
+            except GeocodingError as exc:
+                logger.warning('%s failed for %r: %s', type(backend).__name__, address, exc)
+                error = exc
+                continue
+            if result is not None:
+                return result
+        if error is not None:
+            raise error
+        return None
+
+
+@lru_cache(maxsize=None)
+def get_geocoder():
+    """Returns the ChainGeocoder built from ``settings.GEOCODER_BACKENDS``."""
+    config = getattr(settings, 'GEOCODER_BACKENDS', [{'BACKEND': 'gymFindr.geocoders.GoogleGeocoder'}])
+    backends = [import_string(entry['BACKEND'])(**entry.get('OPTIONS', {})) for entry in config]
+    return ChainGeocoder(backends)
@@ -0,0 +1,326 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.db import transaction
+from django.utils import timezone
+
+from .geocoders import GeocodingError, get_geocoder, normalize_address
+
+
+logger = logging.getLogger(__name__)
+
+# Positive results rarely change, misses are kept short so a typo'd address
+# that later becomes resolvable is retried within a day.
+GEOCODE_CACHE_TTL = getattr(settings, 'GEOCODE_CACHE_TTL', 60 * 60 * 24 * 30)
+GEOCODE_NEGATIVE_CACHE_TTL = getattr(settings, 'GEOCODE_NEGATIVE_CACHE_TTL', 60 * 60 * 24)
+GEOCODE_CACHE_MAX_ENTRIES = getattr(settings, 'GEOCODE_CACHE_MAX_ENTRIES', 10000)
+
+# Background worker retry policy, delays in seconds
+GEOCODE_MAX_ATTEMPTS = getattr(settings, 'GEOCODE_MAX_ATTEMPTS', 5)
+GEOCODE_RETRY_BASE_DELAY = getattr(settings, 'GEOCODE_RETRY_BASE_DELAY', 60)
+GEOCODE_RETRY_MAX_DELAY = getattr(settings, 'GEOCODE_RETRY_MAX_DELAY', 60 * 60 * 6)
+# Seconds a worker owns the tasks it claimed before others may retry them
+GEOCODE_CLAIM_TIMEOUT = getattr(settings, 'GEOCODE_CLAIM_TIMEOUT', 60 * 10)
+
+
+class GeocodeLRUCache:
+    """Thread-safe in-process LRU cache with per-entry expiry.
+
+    A value of ``None`` is a cached negative result, so lookups return a
+    ``(found, value)`` pair to tell it apart from a miss.
+    """
+
+    def __init__(self, max_entries, ttl, negative_ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl if value is not None else self.negative_ttl
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class GeocodeStats:
+    """Per-process counters for the geocoding cache tiers."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.memory_hits = 0
+        self.local_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def incr(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    @property
+    def lookups(self):
+        return self.memory_hits + self.local_hits + self.db_hits + self.misses
+
+    @property
+    def hit_rate(self):
+        """Share of lookups answered without a network call."""
+        lookups = self.lookups
+        return (lookups - self.misses) / lookups if lookups else 0.0
+
+    def as_dict(self):
+        return {
+            'memory_hits': self.memory_hits,
+            'local_hits': self.local_hits,
+            'db_hits': self.db_hits,
+            'misses': self.misses,
+            'errors': self.errors,
+            'lookups': self.lookups,
+            'hit_rate': round(self.hit_rate, 4),
+            'memory_entries': len(memory_cache),
+        }
+
+
+memory_cache = GeocodeLRUCache(GEOCODE_CACHE_MAX_ENTRIES, GEOCODE_CACHE_TTL, GEOCODE_NEGATIVE_CACHE_TTL)
+stats = GeocodeStats()
+
+
+def geocode_cache_stats():
+    """Returns hit/miss counters for the geocoding cache of the current process."""
+    return stats.as_dict()
+
+
+def _lookup_db(key):
+    from .models import GeocodedAddress
+
+    entry = GeocodedAddress.objects.filter(query=key).first()
+    if entry is None:
+        return False, None
+    ttl = GEOCODE_CACHE_TTL if entry.coordinates is not None else GEOCODE_NEGATIVE_CACHE_TTL
+    if entry.updated_at + timedelta(seconds=ttl) <= timezone.now():
+        return False, None
+    if entry.coordinates is None:
+        return True, None
+    return True, (entry.coordinates.y, entry.coordinates.x)
+
+
+def _store_db(key, result):
+    from .models import GeocodedAddress
+
+    coordinates = Point(result[1], result[0], srid=4326) if result is not None else None
+    GeocodedAddress.objects.update_or_create(query=key, defaults={'coordinates': coordinates})
+
+
+def lookup_address(address):
+    """Returns ``(lat, lng)`` for an address or ``None`` when it cannot be found.
+
+    Tries the memory cache, the offline geocoders, the database cache and
+    finally the network geocoders. Raises ``GeocodingError`` for transient
+    failures, which are not cached.
+    """
+    key = normalize_address(address)
+    if not key:
+        return None
+
+    found, result = memory_cache.get(key)
+    if found:
+        stats.incr('memory_hits')
+        return result
+
+    geocoder = get_geocoder()
+    result = geocoder.geocode(address, remote=False)
+    if result is not None:
+        stats.incr('local_hits')
+        memory_cache.set(key, result)
+        return result
+    if not geocoder.remote:
+        # Offline-only configuration (tests, benchmarks): nothing worth persisting
+        stats.incr('misses')
+        return None
+
+    found, result = _lookup_db(key)
+    if found:
+        stats.incr('db_hits')
+    else:
+        stats.incr('misses')
+        try:
+            result = geocoder.geocode(address, remote=True)
+        except GeocodingError:
+            stats.incr('errors')
+            raise
+        _store_db(key, result)
+    memory_cache.set(key, result)
+    return result
+
+
+def geocode_address(address):
+    """Converts address to coordinates, consulting the memory and database caches first."""
+    try:
+        result = lookup_address(address)
+    except GeocodingError as exc:
+        logger.warning('Geocoding %r failed: %s', address, exc)
+        return None, None
+    if result is None:
+        return None, None
+    return result
+
+
+def geocode_location(location):
+    """Geocodes a Location, falling back to its city and country.
+
+    Returns ``(lat, lng)`` or ``None`` when neither address resolves.
+    """
+    result = lookup_address(location.full_address)
+    if result is None:
+        result = lookup_address(location.fallback_address)
+    return result
+
+
+def enqueue_geocoding(location):
+    """Marks a saved Location as pending and (re)schedules it for the geocode worker."""
+    from .models import GeocodeTask
+
+    changed = location.mark_for_geocoding()
+    if changed:
+        location.save(update_fields=changed)
+    GeocodeTask.objects.update_or_create(
+        location=location,
+        defaults={'attempts': 0, 'run_after': timezone.now(), 'last_error': ''},
+    )
+
+
+def _retry_delay(attempts):
+    return min(GEOCODE_RETRY_BASE_DELAY * 2 ** (attempts - 1), GEOCODE_RETRY_MAX_DELAY)
+
+
+def _retry_or_give_up(task, error):
+    """Records a failed attempt; returns False once the task has no attempts left."""
+    from .models import GeocodeTask
+
+    task.attempts += 1
+    if task.attempts >= GEOCODE_MAX_ATTEMPTS:
+        logger.error('Giving up geocoding location %s after %s attempts: %s', task.location_id, task.attempts, error)
+        return False
+    # Only if the task is still ours; a re-enqueue (address edited) replaced it
+    GeocodeTask.objects.filter(pk=task.pk, run_after=task.run_after).update(
+        attempts=task.attempts,
+        run_after=timezone.now() + timedelta(seconds=_retry_delay(task.attempts)),
+        last_error=str(error),
+    )
+    return True
+
+
+def _save_result(task, result):
+    """Stores a location's coordinates, or marks it failed when ``result`` is None, and ends the task."""
+    from .models import GeocodeTask, Location
+
+    location = task.location
+    with transaction.atomic():
+        fingerprint = (
+            Location.objects.select_for_update().filter(pk=location.pk)
+            .values_list('address_fingerprint', flat=True).first()
+        )
+        if fingerprint != location.address_fingerprint:
+            # The address was edited while it was being geocoded; its new task takes over
+            return
+        if result is not None:
+            lat, lng = result
+            location.coordinates = Point(lng, lat, srid=4326)
+            location.geocode_status = Location.GEOCODE_DONE
+        else:
+            # Leave the location off the map rather than guessing a point for it
+            location.coordinates = None
+            location.geocode_status = Location.GEOCODE_FAILED
+        location.save(update_fields=['coordinates', 'geocode_status'])
+        GeocodeTask.objects.filter(pk=task.pk, run_after=task.run_after).delete()
+
+
+def _run_task(task):
+    try:
+        result = geocode_location(task.location)
+    except GeocodingError as exc:
+        if _retry_or_give_up(task, exc):
+            return
+        result = None
+    except Exception as exc:
+        # A bug or a malformed row must not stall the queue behind this task
+        logger.exception('Geocoding location %s failed', task.location_id)
+        if _retry_or_give_up(task, exc):
+            return
+        result = None
+    _save_result(task, result)
+
+
+def claim_geocode_tasks(batch_size=20):
+    """Claims up to ``batch_size`` due tasks for ``GEOCODE_CLAIM_TIMEOUT`` seconds and returns them.
+
+    Claimed tasks get a ``run_after`` in the future, so other workers skip
+    them and a worker that dies mid-batch leaves them to be retried. The
+    claim is a short transaction; no lock is held while geocoding.
+    """
+    from .models import GeocodeTask
+
+    with transaction.atomic():
+        tasks = list(
+            GeocodeTask.objects.select_for_update(skip_locked=True, of=('self',))
+            .select_related('location')
+            .filter(run_after__lte=timezone.now())
+            .order_by('run_after')[:batch_size]
+        )
+        if tasks:
+            lease = timezone.now() + timedelta(seconds=GEOCODE_CLAIM_TIMEOUT)
+            GeocodeTask.objects.filter(pk__in=[task.pk for task in tasks]).update(run_after=lease)
+            for task in tasks:
+                task.run_after = lease
+    return tasks
+
+
+def run_geocode_tasks(batch_size=20):
+    """Claims and processes up to ``batch_size`` due tasks, returns how many were claimed.
+
+    Each task is geocoded outside any transaction and saved in its own, so
+    one failing task costs neither the batch nor the queue.
+    """
+    from .models import GeocodeTask
+
+    tasks = claim_geocode_tasks(batch_size)
+    for task in tasks:
+        try:
+            _run_task(task)
+        except Exception as exc:
+            # Saving the result failed; retry later, and drop the task once out of attempts
+            logger.exception('Saving the geocode of location %s failed', task.location_id)
+            if not _retry_or_give_up(task, exc):
+                GeocodeTask.objects.filter(pk=task.pk, run_after=task.run_after).delete()
+    return len(tasks)
@@ -0,0 +1,471 @@
+"""Streaming bulk import of gyms, used by the import_gyms command.
+
+Records are read one at a time from CSV, JSON (an array of objects or one
+object per line) or a GeoJSON FeatureCollection, so memory stays flat
+however large the file is. Each chunk of records is geocoded first,
+outside any transaction, through a bounded thread pool that looks each
+distinct address up only once. The chunk is then written with one
+``bulk_create`` per table inside a single transaction. That transaction
+also advances the source's ImportCheckpoint, so an interrupted import
+resumes after the last committed chunk.
+
+A record is a flat mapping:
+
+    name, description, free_trial, classes_available,
+    street_address1, street_address2, city, zip_code, country,
+    latitude, longitude, email, phone, website,
+    classes, amenities        "YOGA;BOXING" or a list of codes
+    memberships               "DAY_PASS:15;MONTH:49.99" or [{"type", "price"}]
+    hours                     "MON 06:00-22:00;SAT 08:00-20:00" or [{"day", "open", "close"}]
+
+GeoJSON features take these from their properties and their coordinates
+from the point geometry.
+"""
+import csv
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.db import connections, transaction
+
+from .geocoding import GeocodingError, geocode_location
+from .models import (
+    Amenity, ClassCategory, ContactInfo, GeocodeTask, Gym, ImportCheckpoint, Location, MembershipType,
+    OperatingHour,
+)
+from .opening_hours import rebuild_opening_intervals
+from .search_index import refresh_search_documents
+from .taxonomy import invalidate_taxonomy
+
+IMPORT_CHUNK_SIZE = getattr(settings, 'IMPORT_CHUNK_SIZE', 500)
+IMPORT_GEOCODE_WORKERS = getattr(settings, 'IMPORT_GEOCODE_WORKERS', 4)
+
+FORMATS = ('csv', 'json', 'geojson')
+_TRUE = {'1', 'true', 'yes', 'y', 't'}
+# What may still follow the end of a buffer in a JSON value the chunk boundary cut
+_JSON_LITERALS = ('true', 'false', 'null', 'NaN', 'Infinity', '-Infinity')
+_NUMBER_CHARS = re.compile(r'[-+.eE\d]*')
+
+
+class ImportRowError(ValueError):
+    pass
+
+
+def detect_format(path):
+    suffix = path.rsplit('.', 1)[-1].lower()
+    if suffix in ('json', 'jsonl', 'ndjson'):
+        return 'json'
+    if suffix in FORMATS:
+        return suffix
+    raise ImportRowError(f'Cannot tell the format of {path}; pass --format.')
+
+
+def _cut_short(error):
+    """True when a JSONDecodeError may only mean that the buffer ends mid-value."""
+    if error.msg.startswith('Unterminated string'):
+        return True
+    tail = error.doc[error.pos:].rstrip()
+    return _NUMBER_CHARS.fullmatch(tail) is not None or any(literal.startswith(tail) for literal in _JSON_LITERALS)
+
+
+def iter_json_values(fp, start=None, chunk_size=1 << 16):
+    """Yields the values of a JSON array, or of a stream of JSON values, reading ``fp`` in chunks.
+
+    ``start`` is a regex matching everything up to and including the
+    opening ``[`` of the array to read. Without it the document must be an
+    array or whitespace-separated values (JSON Lines).
+    """
+    decoder = json.JSONDecoder()
+    buffer = fp.read(chunk_size)
+    if start is not None:
+        pattern = re.compile(start)
+        match = pattern.search(buffer)
+        while match is None:
+            more = fp.read(chunk_size)
+            if not more:
+                raise ImportRowError('The JSON document has no array to import.')
+            buffer += more
+            match = pattern.search(buffer)
+        position, in_array = match.end(), True
+    else:
+        position = len(buffer) - len(buffer.lstrip())
+        in_array = buffer[position:position + 1] == '['
+        position += in_array
+    while True:
+        while position < len(buffer) and (buffer[position].isspace() or (in_array and buffer[position] == ',')):
+            position += 1
+        if position >= len(buffer):
+            more = fp.read(chunk_size)
+            if not more:
+                if in_array:
+                    raise ImportRowError('The JSON array is not closed.')
+                return
+            buffer, position = buffer[position:] + more, 0
+            continue
+        if in_array and buffer[position] == ']':
+            return
+        try:
+            value, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError as exc:
+            # A syntax error is raised where it is found rather than after reading the rest of the file
+            more = fp.read(chunk_size) if _cut_short(exc) else ''
+            if not more:
+                raise
+            buffer, position = buffer[position:] + more, 0
+            continue
+        if isinstance(value, (int, float)) and _NUMBER_CHARS.fullmatch(buffer, end):
+            # A number cut short by the chunk boundary still decodes, as a shorter one
+            more = fp.read(chunk_size)
+            if more:
+                buffer, position = buffer[position:] + more, 0
+                continue
+        yield value
+        position = end
+        if position > chunk_size:
+            buffer, position = buffer[position:], 0
+
+
+def _feature_record(feature):
+    """Returns the flat record of a GeoJSON feature, or the ImportRowError describing why it has none."""
+    if not isinstance(feature, dict) or not isinstance(feature.get('properties') or {}, dict):
+        return ImportRowError('feature is not an object with object properties')
+    record = dict(feature.get('properties') or {})
+    geometry = feature.get('geometry')
+    if geometry is None:
+        return record
+    if not isinstance(geometry, dict):
+        return ImportRowError('geometry is not an object')
+    if geometry.get('type') == 'Point':
+        coordinates = geometry.get('coordinates')
+        if not isinstance(coordinates, list) or len(coordinates) < 2:
+            return ImportRowError('Point geometry needs [longitude, latitude] coordinates')
+        record['longitude'], record['latitude'] = coordinates[:2]
+    return record
+
+
+def iter_records(fp, format):
+    """Yields the flat record mappings of an open source file.
+
+    A record that cannot be read at all is yielded as the ImportRowError
+    saying why, so the import can skip it and go on.
+    """
+    if format == 'csv':
+        yield from csv.DictReader(fp)
+    elif format == 'json':
+        yield from iter_json_values(fp)
+    elif format == 'geojson':
+        for feature in iter_json_values(fp, start=r'"features"\s*:\s*\['):
+            yield _feature_record(feature)
+    else:
+        raise ImportRowError(f'Unknown format {format!r}.')
+
+
+def _text(record, name, model, required=False):
+    value = record.get(name)
+    value = '' if value is None else str(value).strip()
+    if required and not value:
+        raise ImportRowError(f'{name} is required')
+    max_length = model._meta.get_field(name).max_length
+    if max_length and len(value) > max_length:
+        raise ImportRowError(f'{name} is longer than {max_length} characters')
+    return value
+
+
+def _flag(record, name):
+    value = record.get(name)
+    if isinstance(value, bool):
+        return value
+    return str(value or '').strip().lower() in _TRUE
+
+
+def _items(record, name):
+    """Returns the list value of ``name``, raising ImportRowError for any other non-string value."""
+    value = record.get(name) or []
+    if not isinstance(value, (str, list)):
+        raise ImportRowError(f'{name} must be a string or a list')
+    return value
+
+
+def _codes(record, name, choices):
+    value = _items(record, name)
+    if isinstance(value, str):
+        value = re.split(r'[;,]', value)
+    codes = [str(code).strip().upper() for code in value if str(code).strip()]
+    unknown = set(codes) - {code for code, label in choices}
+    if unknown:
+        raise ImportRowError(f'unknown {name}: {", ".join(sorted(unknown))}')
+    return codes
+
+
+def _price(value):
+    try:
+        price = Decimal(str(value).strip())
+        if price.is_finite():
+            price = price.quantize(Decimal('0.01'))
+    except InvalidOperation as exc:
+        raise ImportRowError(f'price is not a number: {value!r}') from exc
+    if not price.is_finite():
+        raise ImportRowError(f'price is not a number: {value!r}')
+    if not Decimal('0') <= price < Decimal('10000'):
+        raise ImportRowError(f'price out of range: {value!r}')
+    return price
+
+
+def _time(value):
+    try:
+        return datetime.strptime(str(value).strip(), '%H:%M').time()
+    except ValueError as exc:
+        raise ImportRowError(f'not a HH:MM time: {value!r}') from exc
+
+
+def _memberships(record):
+    value = _items(record, 'memberships')
+    if isinstance(value, str):
+        value = [
+            dict(zip(('type', 'price'), item.split(':', 1)))
+            for item in value.split(';') if item.strip()
+        ]
+    memberships = []
+    types = dict(MembershipType.MEMBERSHIP_CHOICES)
+    for item in value:
+        if not isinstance(item, dict):
+            raise ImportRowError(f'membership {item!r} is not an object')
+        membership_type = str(item.get('type', '')).strip().upper()
+        if membership_type not in types:
+            raise ImportRowError(f'unknown membership type {membership_type!r}')
+        memberships.append((membership_type, _price(item.get('price'))))
+    return memberships
+
+
+def _hours(record):
+    value = _items(record, 'hours')
+    if isinstance(value, str):
+        items = []
+        for item in value.split(';'):
+            if not item.strip():
+                continue
+            match = re.fullmatch(r'\s*(\w{3})\s+(\d{1,2}:\d{2})\s*-\s*(\d{1,2}:\d{2})\s*', item)
+            if match is None:
+                raise ImportRowError(f'hours must look like "MON 06:00-22:00", not {item!r}')
+            items.append(dict(zip(('day', 'open', 'close'), match.groups())))
+        value = items
+    hours = []
+    days = dict(OperatingHour.DAY_CHOICES)
+    for item in value:
+        if not isinstance(item, dict):
+            raise ImportRowError(f'opening hours {item!r} are not an object')
+        day = str(item.get('day', '')).strip().upper()
+        if day not in days:
+            raise ImportRowError(f'unknown day {day!r}')
+        hours.append((day, _time(item.get('open')), _time(item.get('close'))))
+    return hours
+
+
+def parse_record(record):
+    """Validates a raw record and returns it as a dict of clean values.
+
+    Raises ImportRowError describing the first problem found.
+    """
+    latitude, longitude = record.get('latitude', record.get('lat')), record.get('longitude', record.get('lng'))
+    point = None
+    if latitude not in (None, '') and longitude not in (None, ''):
+        try:
+            latitude, longitude = float(latitude), float(longitude)
+        except (TypeError, ValueError) as exc:
+            raise ImportRowError('latitude/longitude must be numbers') from exc
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            raise ImportRowError('latitude/longitude out of range')
+        point = Point(longitude, latitude, srid=4326)
+    return {
+        'name': _text(record, 'name', Gym, required=True),
+        'description': _text(record, 'description', Gym),
+        'free_trial': _flag(record, 'free_trial'),
+        'classes_available': _flag(record, 'classes_available'),
+        'street_address1': _text(record, 'street_address1', Location, required=True),
+        'street_address2': _text(record, 'street_address2', Location) or None,
+        'city': _text(record, 'city', Location, required=True),
+        'zip_code': _text(record, 'zip_code', Location, required=True),
+        'country': _text(record, 'country', Location, required=True),
+        'coordinates': point,
+        'email': _text(record, 'email', ContactInfo, required=True),
+        'phone': _text(record, 'phone', ContactInfo),
+        'website': _text(record, 'website', ContactInfo) or None,
+        'classes': _codes(record, 'classes', ClassCategory.CATEGORY_CHOICES),
+        'amenities': _codes(record, 'amenities', Amenity.AMENITY_CHOICES),
+        'memberships': _memberships(record),
+        'hours': _hours(record),
+    }
+
+
+def _geocode(location):
+    """Runs in a pool thread; returns ``(lat, lng)``, None when not found, or the GeocodingError."""
+    try:
+        return geocode_location(location)
+    except GeocodingError as exc:
+        return exc
+    finally:
+        # Pool threads outlive the chunk, do not leave their cache lookups' connections open
+        connections.close_all()
+
+
+def geocode_locations(locations, executor):
+    """Fills in the coordinates of unsaved Locations that have none.
+
+    Each distinct normalized address is looked up once. Locations that
+    fail transiently are left pending and returned, to be queued for the
+    geocode worker.
+    """
+    by_fingerprint = {}
+    for location in locations:
+        location.address_fingerprint = location.compute_address_fingerprint()
+        if location.coordinates is not None:
+            location.geocode_status = Location.GEOCODE_DONE
+        else:
+            by_fingerprint.setdefault(location.address_fingerprint, []).append(location)
+    pending = []
+    fingerprints = list(by_fingerprint)
+    results = executor.map(_geocode, [by_fingerprint[fingerprint][0] for fingerprint in fingerprints])
+    for fingerprint, result in zip(fingerprints, results):
+        for location in by_fingerprint[fingerprint]:
+            if isinstance(result, GeocodingError):
+                location.geocode_status = Location.GEOCODE_PENDING
+                pending.append(location)
+            elif result is None:
+                location.geocode_status = Location.GEOCODE_FAILED
+            else:
+                lat, lng = result
+                location.coordinates = Point(lng, lat, srid=4326)
+                location.geocode_status = Location.GEOCODE_DONE
+    return pending
+
+
+def taxonomy_ids():
+    """Returns ``(class ids, amenity ids)`` by name code, creating any missing rows."""
+    ClassCategory.objects.bulk_create(
+        [ClassCategory(name=code) for code, label in ClassCategory.CATEGORY_CHOICES], ignore_conflicts=True,
+    )
+    Amenity.objects.bulk_create(
+        [Amenity(name=code) for code, label in Amenity.AMENITY_CHOICES], ignore_conflicts=True,
+    )
+    # bulk_create sends no signals
+    invalidate_taxonomy(ClassCategory)
+    invalidate_taxonomy(Amenity)
+    return (
+        dict(ClassCategory.objects.values_list('name', 'pk')),
+        dict(Amenity.objects.values_list('name', 'pk')),
+    )
+
+
+def write_chunk(rows, owner, taxonomy, checkpoint, rows_done, executor):
+    """Geocodes and saves one chunk of parsed records, advancing ``checkpoint`` to ``rows_done``.
+
+    Returns ``(gyms created, locations queued for the geocode worker)``.
+    """
+    class_ids, amenity_ids = taxonomy
+    locations = [
+        Location(
+            street_address1=row['street_address1'], street_address2=row['street_address2'],
+            city=row['city'], zip_code=row['zip_code'], country=row['country'],
+            coordinates=row['coordinates'],
+        )
+        for row in rows
+    ]
+    pending = geocode_locations(locations, executor)
+
+    with transaction.atomic():
+        Location.objects.bulk_create(locations)
+        contacts = ContactInfo.objects.bulk_create([
+            ContactInfo(email=row['email'], phone=row['phone'], website=row['website']) for row in rows
+        ])
+        gyms = []
+        for row, location, contact_info in zip(rows, locations, contacts):
+            gym = Gym(
+                owner=owner, name=row['name'], description=row['description'],
+                free_trial=row['free_trial'], classes_available=row['classes_available'],
+                location=location, contact_info=contact_info,
+                class_mask=ClassCategory.mask_for(row['classes']),
+                amenity_mask=Amenity.mask_for(row['amenities']),
+            )
+            gym.update_excerpt()
+            gyms.append(gym)
+        Gym.objects.bulk_create(gyms)
+
+        memberships, hours, gym_classes, gym_amenities = [], [], [], []
+        for row, gym in zip(rows, gyms):
+            memberships += [MembershipType(gym=gym, type=kind, price=price) for kind, price in row['memberships']]
+            hours += [
+                OperatingHour(gym=gym, day=day, open_time=opens, close_time=closes)
+                for day, opens, closes in row['hours']
+            ]
+            gym_classes += [
+                Gym.classes.through(gym_id=gym.pk, classcategory_id=class_ids[code]) for code in set(row['classes'])
+            ]
+            gym_amenities += [
+                Gym.amenities.through(gym_id=gym.pk, amenity_id=amenity_ids[code]) for code in set(row['amenities'])
+            ]
+        MembershipType.objects.bulk_create(memberships)
+        OperatingHour.objects.bulk_create(hours)
+        Gym.classes.through.objects.bulk_create(gym_classes)
+        Gym.amenities.through.objects.bulk_create(gym_amenities)
+        GeocodeTask.objects.bulk_create([GeocodeTask(location=location) for location in pending])
+
+        # bulk_create sends no signals, so derive the search state here
+        gym_ids = [gym.pk for gym in gyms]
+        refresh_search_documents(gym_ids)
+        rebuild_opening_intervals(gym_ids)
+
+        checkpoint.rows_done = rows_done
+        checkpoint.save(update_fields=['rows_done', 'updated_at'])
+    return len(gyms), len(pending)
+
+
+def import_gyms(fp, format, owner, source, chunk_size=IMPORT_CHUNK_SIZE, geocode_workers=IMPORT_GEOCODE_WORKERS,
+                restart=False, on_chunk=None, on_error=None):
+    """Imports every record of ``fp`` after the ones ``source``'s checkpoint says are done.
+
+    ``on_chunk(rows_done, created)`` is called after each committed chunk
+    and ``on_error(row_number, error)`` for each record that was skipped.
+    Returns a dict of counters.
+    """
+    checkpoint, _ = ImportCheckpoint.objects.get_or_create(source=source)
+    if restart and checkpoint.rows_done:
+        checkpoint.rows_done = 0
+        checkpoint.save(update_fields=['rows_done', 'updated_at'])
+    counts = {'resumed_at': checkpoint.rows_done, 'imported': 0, 'skipped': 0, 'queued': 0}
+    taxonomy = taxonomy_ids()
+    rows_done = checkpoint.rows_done
+    chunk = []
+    with ThreadPoolExecutor(max_workers=geocode_workers, thread_name_prefix='import-geocode') as executor:
+        for number, record in enumerate(iter_records(fp, format), start=1):
+            if number <= checkpoint.rows_done:
+                continue
+            try:
+                if isinstance(record, ImportRowError):
+                    raise record
+                if not isinstance(record, dict):
+                    raise ImportRowError('record is not an object')
+                chunk.append(parse_record(record))
+            except ImportRowError as exc:
+                counts['skipped'] += 1
+                if on_error:
+                    on_error(number, exc)
+            rows_done = number
+            if len(chunk) >= chunk_size:
+                imported, queued = write_chunk(chunk, owner, taxonomy, checkpoint, rows_done, executor)
+                counts['imported'] += imported
+                counts['queued'] += queued
+                chunk = []
+                if on_chunk:
+                    on_chunk(rows_done, counts['imported'])
+        if chunk or rows_done > checkpoint.rows_done:
+            imported, queued = write_chunk(chunk, owner, taxonomy, checkpoint, rows_done, executor)
+            counts['imported'] += imported
+            counts['queued'] += queued
+            if on_chunk:
+                on_chunk(rows_done, counts['imported'])
+    counts['rows'] = rows_done
+    return counts
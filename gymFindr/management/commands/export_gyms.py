@@ -0,0 +1,28 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from gymFindr.exporting import EXPORT_CHUNK_SIZE, EXPORT_FORMATS, export_catalog
+
+
+class Command(BaseCommand):
+    help = 'Streams every gym to a CSV, GeoJSON or NDJSON file (or stdout) without loading the catalog into memory.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), default='csv')
+        parser.add_argument('--output', '-o', default='-', help='File to write, or - for stdout.')
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE, help='Gyms fetched per batch.')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        output = sys.stdout if options['output'] == '-' else open(options['output'], 'w', newline='', encoding='utf-8')
+        try:
+            for chunk in export_catalog(options['format'], chunk_size=options['chunk_size']):
+                output.write(chunk)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        if options['output'] != '-':
+            elapsed = time.monotonic() - started
+            self.stdout.write(self.style.SUCCESS(f"Exported to {options['output']} in {elapsed:.1f}s."))
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from gymFindr.geocoding import run_geocode_tasks
+
+
+class Command(BaseCommand):
+    help = 'Fills in Location.coordinates for locations queued by the gym create/update views.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=20, help='Tasks claimed per transaction.')
+        parser.add_argument('--interval', type=float, default=5.0, help='Seconds to sleep when the queue is empty.')
+        parser.add_argument('--once', action='store_true', help='Drain the tasks that are due now and exit.')
+
+    def handle(self, *args, **options):
+        processed = 0
+        while True:
+            claimed = run_geocode_tasks(batch_size=options['batch_size'])
+            processed += claimed
+            if claimed:
+                continue
+            if options['once']:
+                break
+            time.sleep(options['interval'])
+        self.stdout.write(self.style.SUCCESS(f'Processed {processed} geocoding tasks.'))
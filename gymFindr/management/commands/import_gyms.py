@@ -0,0 +1,63 @@
+import os
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from gymFindr.importing import (
+    FORMATS, IMPORT_CHUNK_SIZE, IMPORT_GEOCODE_WORKERS, ImportRowError, detect_format, import_gyms,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Imports gyms from a CSV, JSON/JSON Lines or GeoJSON file, see gymFindr.importing for the columns. '
+        'Rerunning it on the same file resumes after the last committed chunk.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to import.')
+        parser.add_argument('--owner', required=True, help='Email of the user who will own the imported gyms.')
+        parser.add_argument('--format', choices=FORMATS, help='Defaults to the file extension.')
+        parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE, help='Rows saved per transaction.')
+        parser.add_argument(
+            '--geocode-workers', type=int, default=IMPORT_GEOCODE_WORKERS,
+            help='Threads geocoding rows without coordinates.',
+        )
+        parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint and start from the first row.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        try:
+            owner = get_user_model().objects.get(email=options['owner'])
+        except get_user_model().DoesNotExist:
+            raise CommandError(f"No user with email {options['owner']}.")
+        try:
+            format = options['format'] or detect_format(path)
+        except ImportRowError as exc:
+            raise CommandError(str(exc))
+        started = time.monotonic()
+
+        def report_chunk(rows_done, imported):
+            elapsed = time.monotonic() - started
+            self.stdout.write(f'Row {rows_done}: {imported} gyms imported ({imported / elapsed:.1f} rows/s)')
+
+        def report_error(number, error):
+            self.stderr.write(f'Skipped row {number}: {error}')
+
+        with open(path, newline='', encoding='utf-8') as fp:
+            try:
+                counts = import_gyms(
+                    fp, format, owner, source=os.path.abspath(path),
+                    chunk_size=options['chunk_size'], geocode_workers=options['geocode_workers'],
+                    restart=options['restart'], on_chunk=report_chunk, on_error=report_error,
+                )
+            except (ImportRowError, ValueError) as exc:
+                raise CommandError(f'Import stopped, rerun to resume: {exc}')
+        elapsed = time.monotonic() - started
+        if counts['resumed_at']:
+            self.stdout.write(f"Resumed after row {counts['resumed_at']}.")
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {counts['imported']} gyms in {elapsed:.1f}s ({counts['imported'] / max(elapsed, 1e-9):.1f} rows/s); "
+            f"skipped {counts['skipped']} rows, queued {counts['queued']} locations for the geocode worker."
+        ))
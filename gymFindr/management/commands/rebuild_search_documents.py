@@ -0,0 +1,18 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from gymFindr.search_index import rebuild_search_documents
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the GymSearchDocument row of every gym.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Gyms refreshed per upsert.')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        refreshed = rebuild_search_documents(batch_size=options['batch_size'])
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {refreshed} search documents in {elapsed:.1f}s.'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from gymFindr.favorites import reconcile_favorite_counts
+
+
+class Command(BaseCommand):
+    help = 'Recomputes Gym.favorite_count from the Favorite rows.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Gyms checked per UPDATE.')
+
+    def handle(self, *args, **options):
+        corrected = reconcile_favorite_counts(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Corrected the favorite count of {corrected} gyms.'))
@@ -0,0 +1,123 @@
+"""Compact GeoJSON markers for the map's current viewport.
+
+The viewport is matched with ``&&`` against the planar cast of the search
+documents' coordinates, which the ``gymdoc_coordinates_planar_gist``
+expression index answers directly. Coordinates are rounded to
+``MARKER_PRECISION`` decimals and at most ``MARKER_MAX_FEATURES`` gyms are
+returned per request.
+
+Below ``MARKER_CLUSTER_MAX_ZOOM`` gyms are snapped in SQL to a grid of
+``MARKER_CLUSTER_CELLS_PER_TILE`` cells per 256px map tile width, and each
+cell comes back as one feature with its count and centroid. The grid is
+anchored at 0,0 so clusters stay put while the user pans.
+"""
+import math
+
+from django.conf import settings
+from django.contrib.gis.geos import Polygon
+from django.db.models import Avg, Count, Min, Q
+from django.db.models.functions import Floor
+
+from .functions import Latitude, Longitude, PlanarPoint
+
+MARKER_MAX_FEATURES = getattr(settings, 'MARKER_MAX_FEATURES', 500)
+# 5 decimals is about a metre, plenty for a marker
+MARKER_PRECISION = getattr(settings, 'MARKER_PRECISION', 5)
+# Street level; from this zoom on every gym is sent individually
+MARKER_CLUSTER_MAX_ZOOM = getattr(settings, 'MARKER_CLUSTER_MAX_ZOOM', 15)
+MARKER_CLUSTER_CELLS_PER_TILE = getattr(settings, 'MARKER_CLUSTER_CELLS_PER_TILE', 4)
+
+
+class InvalidBBox(ValueError):
+    pass
+
+
+def _wrap_longitude(lng):
+    return ((lng + 180) % 360) - 180
+
+
+def parse_bbox(value):
+    """Parses Leaflet's ``west,south,east,north`` string into lng/lat envelopes.
+
+    Longitudes are wrapped into [-180, 180), so a viewport that crosses the
+    antimeridian becomes two envelopes.
+    """
+    try:
+        west, south, east, north = (float(part) for part in value.split(','))
+    except (AttributeError, ValueError) as exc:
+        raise InvalidBBox(value) from exc
+    if not (math.isfinite(west) and math.isfinite(east)) or not (-90 <= south <= north <= 90) or west > east:
+        raise InvalidBBox(value)
+    if east - west >= 360:
+        return [(-180, south, 180, north)]
+    west, east = _wrap_longitude(west), _wrap_longitude(east)
+    if east == -180 and west > east:
+        # The east edge is the antimeridian itself
+        east = 180
+    if west > east:
+        return [(west, south, 180, north), (-180, south, east, north)]
+    return [(west, south, east, north)]
+
+
+def in_bbox(queryset, envelopes):
+    """Filters search documents to those inside any of the ``envelopes``."""
+    condition = Q()
+    for envelope in envelopes:
+        condition |= Q(planar_point__bboverlaps=Polygon.from_bbox(envelope))
+    return queryset.alias(planar_point=PlanarPoint('coordinates')).filter(condition)
+
+
+def _point_feature(pk, name, lng, lat, precision):
+    return {
+        'type': 'Feature',
+        'id': pk,
+        'geometry': {'type': 'Point', 'coordinates': [round(lng, precision), round(lat, precision)]},
+        'properties': {'name': name},
+    }
+
+
+def markers_geojson(queryset, limit=MARKER_MAX_FEATURES, precision=MARKER_PRECISION):
+    """Returns a GeoJSON FeatureCollection of the first ``limit`` documents by id.
+
+    ``truncated`` tells the client that the viewport holds more gyms than
+    were sent and it should zoom in.
+    """
+    rows = list(queryset.order_by('pk').values_list('pk', 'name', 'coordinates')[:limit + 1])
+    features = [_point_feature(pk, name, point.x, point.y, precision) for pk, name, point in rows[:limit]]
+    return {'type': 'FeatureCollection', 'features': features, 'truncated': len(rows) > limit}
+
+
+def cluster_cell_size(zoom):
+    """Returns the cluster grid cell size in degrees at a Leaflet zoom level."""
+    return 360 / 2 ** zoom / MARKER_CLUSTER_CELLS_PER_TILE
+
+
+def clusters_geojson(queryset, zoom, limit=MARKER_MAX_FEATURES, precision=MARKER_PRECISION):
+    """Returns one feature per occupied grid cell of a queryset filtered by ``in_bbox``.
+
+    Cells holding a single gym are returned as that gym's marker; the
+    others carry ``count`` and sit at the centroid of their gyms. The
+    most populated cells are kept when there are more than ``limit``.
+    """
+    size = cluster_cell_size(zoom)
+    lng, lat = Longitude('planar_point'), Latitude('planar_point')
+    cells = list(
+        queryset.annotate(cell_x=Floor(lng / size), cell_y=Floor(lat / size))
+        .values('cell_x', 'cell_y')
+        .annotate(count=Count('pk'), lng=Avg(lng), lat=Avg(lat), gym_id=Min('pk'), name=Min('name'))
+        .order_by('-count', 'cell_x', 'cell_y')[:limit + 1]
+    )
+    features = []
+    for cell in cells[:limit]:
+        if cell['count'] == 1:
+            features.append(_point_feature(cell['gym_id'], cell['name'], cell['lng'], cell['lat'], precision))
+            continue
+        features.append({
+            'type': 'Feature',
+            'geometry': {
+                'type': 'Point',
+                'coordinates': [round(cell['lng'], precision), round(cell['lat'], precision)],
+            },
+            'properties': {'count': cell['count']},
+        })
+    return {'type': 'FeatureCollection', 'features': features, 'truncated': len(cells) > limit}
@@ -0,0 +1,70 @@
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+# Point the create/update views used to store when geocoding failed
+NYC_PLACEHOLDER = (-74.0060, 40.7128)
+
+
+def normalize_address(address):
+    # Frozen copy of gymFindr.geocoders.normalize_address as of this migration
+    parts = [' '.join(part.split()) for part in (address or '').lower().split(',')]
+    return ', '.join(part for part in parts if part)
+
+
+def has_geocode_result(GeocodedAddress, location):
+    """Whether the geocoding cache holds a match for the location's address or its city."""
+    queries = [
+        normalize_address(f"{location.street_address1}, {location.city}, {location.zip_code}, {location.country}"),
+        normalize_address(f"{location.city}, {location.country}"),
+    ]
+    return GeocodedAddress.objects.filter(query__in=queries, coordinates__isnull=False).exists()
+
+
+def queue_ungeocoded_locations(apps, schema_editor):
+    Location = apps.get_model('gymFindr', 'Location')
+    GeocodeTask = apps.get_model('gymFindr', 'GeocodeTask')
+    GeocodedAddress = apps.get_model('gymFindr', 'GeocodedAddress')
+    pending = []
+    for location in Location.objects.all().iterator():
+        point = location.coordinates
+        # Only a failed lookup stored exactly this point; keep it where a lookup succeeded
+        if (
+            point is not None and (round(point.x, 6), round(point.y, 6)) == NYC_PLACEHOLDER
+            and not has_geocode_result(GeocodedAddress, location)
+        ):
+            location.coordinates = None
+            location.save(update_fields=['coordinates'])
+        if location.coordinates is None:
+            pending.append(location.pk)
+        else:
+            location.geocode_status = 'DONE'
+            location.save(update_fields=['geocode_status'])
+    GeocodeTask.objects.bulk_create([GeocodeTask(location_id=pk) for pk in pending])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gymFindr', '0004_geocodedaddress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='location',
+            name='geocode_status',
+            field=models.CharField(choices=[('PENDING', 'Pending'), ('DONE', 'Done'), ('FAILED', 'Failed')], default='PENDING', max_length=10),
+        ),
+        migrations.CreateModel(
+            name='GeocodeTask',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('run_after', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('location', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='geocode_task', to='gymFindr.location')),
+            ],
+        ),
+        migrations.RunPython(queue_ungeocoded_locations, migrations.RunPython.noop),
+    ]
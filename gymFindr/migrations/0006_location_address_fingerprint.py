@@ -0,0 +1,38 @@
+import hashlib
+
+from django.db import migrations, models
+
+
+def normalize_address(address):
+    # Frozen copy of gymFindr.geocoders.normalize_address as of this migration
+    parts = [' '.join(part.split()) for part in (address or '').lower().split(',')]
+    return ', '.join(part for part in parts if part)
+
+
+def fill_address_fingerprints(apps, schema_editor):
+    Location = apps.get_model('gymFindr', 'Location')
+    for location in Location.objects.all().iterator():
+        full_address = f"{location.street_address1}, {location.city}, {location.zip_code}, {location.country}"
+        location.address_fingerprint = hashlib.sha1(normalize_address(full_address).encode('utf-8')).hexdigest()
+        location.save(update_fields=['address_fingerprint'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gymFindr', '0005_location_geocode_status_geocodetask'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='location',
+            name='geocode_status',
+            field=models.CharField(choices=[('PENDING', 'Pending'), ('DONE', 'Done'), ('FAILED', 'Failed')], default='PENDING', editable=False, max_length=10),
+        ),
+        migrations.AddField(
+            model_name='location',
+            name='address_fingerprint',
+            field=models.CharField(blank=True, editable=False, max_length=40),
+        ),
+        migrations.RunPython(fill_address_fingerprints, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,51 @@
+from django.db import migrations
+
+INDEX_NAME = 'gymFindr_location_coordinates_gist'
+
+
+def ensure_coordinates_gist_index(apps, schema_editor):
+    """Creates a GiST index on Location.coordinates unless one already exists.
+
+    Django normally creates a spatial index for the field, but databases
+    restored from dumps or created by hand can lack it, and KNN ordering
+    without it degrades into a full scan.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    Location = apps.get_model('gymFindr', 'Location')
+    table = Location._meta.db_table
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT 1
+            FROM pg_index i
+            JOIN pg_class t ON t.oid = i.indrelid
+            JOIN pg_class ic ON ic.oid = i.indexrelid
+            JOIN pg_am am ON am.oid = ic.relam
+            JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = ANY(i.indkey)
+            WHERE t.relname = %s AND a.attname = 'coordinates' AND am.amname = 'gist'
+            """,
+            [table],
+        )
+        if cursor.fetchone() is None:
+            cursor.execute(
+                f'CREATE INDEX IF NOT EXISTS "{INDEX_NAME}" ON "{table}" USING GIST ("coordinates")'
+            )
+
+
+def drop_coordinates_gist_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f'DROP INDEX IF EXISTS "{INDEX_NAME}"')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gymFindr', '0006_location_address_fingerprint'),
+    ]
+
+    operations = [
+        migrations.RunPython(ensure_coordinates_gist_index, drop_coordinates_gist_index),
+    ]
@@ -0,0 +1,45 @@
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.operations import TrigramExtension
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations
+from django.db.models import Value
+
+
+def fill_search_vectors(apps, schema_editor):
+    Gym = apps.get_model('gymFindr', 'Gym')
+    for gym in Gym.objects.prefetch_related('classes', 'amenities').iterator(chunk_size=500):
+        taxonomy = ' '.join(
+            [category.get_name_display() for category in gym.classes.all()]
+            + [amenity.get_name_display() for amenity in gym.amenities.all()]
+        )
+        Gym.objects.filter(pk=gym.pk).update(
+            search_vector=SearchVector(Value(gym.name), weight='A', config='english')
+            + SearchVector(Value(taxonomy), weight='B', config='english')
+            + SearchVector(Value(gym.description), weight='C', config='english')
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gymFindr', '0007_location_coordinates_gist_index'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='gym',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='gym',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='gym_search_vector_gin'),
+        ),
+        migrations.AddIndex(
+            model_name='gym',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['name'], name='gym_name_trgm_gin', opclasses=['gin_trgm_ops']),
+        ),
+        migrations.RunPython(fill_search_vectors, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+from django.db import migrations, models
+
+
+def _mask(model, names):
+    codes = [code for code, label in model._meta.get_field('name').choices]
+    mask = 0
+    for name in names:
+        mask |= 1 << codes.index(name)
+    return mask
+
+
+def fill_taxonomy_masks(apps, schema_editor):
+    Gym = apps.get_model('gymFindr', 'Gym')
+    ClassCategory = apps.get_model('gymFindr', 'ClassCategory')
+    Amenity = apps.get_model('gymFindr', 'Amenity')
+    for gym in Gym.objects.prefetch_related('classes', 'amenities').iterator(chunk_size=500):
+        Gym.objects.filter(pk=gym.pk).update(
+            class_mask=_mask(ClassCategory, [category.name for category in gym.classes.all()]),
+            amenity_mask=_mask(Amenity, [amenity.name for amenity in gym.amenities.all()]),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gymFindr', '0008_gym_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gym',
+            name='amenity_mask',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='gym',
+            name='class_mask',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_taxonomy_masks, migrations.RunPython.noop),
+    ]
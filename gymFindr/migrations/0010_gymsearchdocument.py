@@ -0,0 +1,80 @@
+import django.contrib.gis.db.models.fields
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+import django.db.models.deletion
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations, models
+from django.db.models import Value
+
+
+def build_search_documents(apps, schema_editor):
+    Gym = apps.get_model('gymFindr', 'Gym')
+    GymSearchDocument = apps.get_model('gymFindr', 'GymSearchDocument')
+    gyms = Gym.objects.select_related('location').prefetch_related('classes', 'amenities', 'membership_types')
+    documents = []
+    for gym in gyms.iterator(chunk_size=500):
+        taxonomy = ' '.join(
+            [category.get_name_display() for category in gym.classes.all()]
+            + [amenity.get_name_display() for amenity in gym.amenities.all()]
+        )
+        prices = [membership.price for membership in gym.membership_types.all()]
+        documents.append(GymSearchDocument(
+            gym=gym,
+            name=gym.name,
+            city=gym.location.city if gym.location else '',
+            coordinates=gym.location.coordinates if gym.location else None,
+            class_mask=gym.class_mask,
+            amenity_mask=gym.amenity_mask,
+            min_price=min(prices) if prices else None,
+            free_trial=gym.free_trial,
+            search_vector=SearchVector(Value(gym.name), weight='A', config='english')
+            + SearchVector(Value(taxonomy), weight='B', config='english')
+            + SearchVector(Value(gym.description), weight='C', config='english'),
+        ))
+        if len(documents) >= 500:
+            GymSearchDocument.objects.bulk_create(documents)
+            documents = []
+    GymSearchDocument.objects.bulk_create(documents)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gymFindr', '0009_gym_taxonomy_masks'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GymSearchDocument',
+            fields=[
+                ('gym', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_document', serialize=False, to='gymFindr.gym')),
+                ('name', models.CharField(max_length=255)),
+                ('city', models.CharField(blank=True, max_length=100)),
+                ('coordinates', django.contrib.gis.db.models.fields.PointField(blank=True, geography=True, null=True, srid=4326)),
+                ('class_mask', models.IntegerField(default=0)),
+                ('amenity_mask', models.IntegerField(default=0)),
+                ('min_price', models.DecimalField(blank=True, decimal_places=2, max_digits=6, null=True)),
+                ('free_trial', models.BooleanField(default=False)),
+                ('search_vector', django.contrib.postgres.search.SearchVectorField(null=True)),
+            ],
+            options={
+                'indexes': [
+                    django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='gymdoc_search_vector_gin'),
+                    django.contrib.postgres.indexes.GinIndex(fields=['name'], name='gymdoc_name_trgm_gin', opclasses=['gin_trgm_ops']),
+                ],
+            },
+        ),
+        migrations.RemoveIndex(
+            model_name='gym',
+            name='gym_search_vector_gin',
+        ),
+        migrations.RemoveIndex(
+            model_name='gym',
+            name='gym_name_trgm_gin',
+        ),
+        migrations.RemoveField(
+            model_name='gym',
+            name='search_vector',
+        ),
+        migrations.RunPython(build_search_documents, migrations.RunPython.noop),
+    ]
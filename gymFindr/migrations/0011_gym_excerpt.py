@@ -0,0 +1,25 @@
+from django.db import migrations, models
+from django.utils.text import Truncator
+
+
+def fill_excerpts(apps, schema_editor):
+    Gym = apps.get_model('gymFindr', 'Gym')
+    for gym in Gym.objects.only('pk', 'description').iterator(chunk_size=500):
+        excerpt = Truncator(Truncator(gym.description).words(20)).chars(255)
+        Gym.objects.filter(pk=gym.pk).update(excerpt=excerpt)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gymFindr', '0010_gymsearchdocument'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gym',
+            name='excerpt',
+            field=models.CharField(blank=True, editable=False, max_length=255),
+        ),
+        migrations.RunPython(fill_excerpts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+import django.contrib.postgres.indexes
+import gymFindr.functions
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gymFindr', '0012_gym_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='gymsearchdocument',
+            index=django.contrib.postgres.indexes.GistIndex(
+                gymFindr.functions.PlanarPoint('coordinates'), name='gymdoc_coordinates_planar_gist',
+            ),
+        ),
+    ]
@@ -0,0 +1,57 @@
+import django.contrib.postgres.fields.ranges
+import django.contrib.postgres.indexes
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.backends.postgresql.psycopg_any import NumericRange
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+DAYS = ['MON', 'TUE', 'WED', 'THU', 'FRI', 'SAT', 'SUN']
+
+
+def build_opening_intervals(apps, schema_editor):
+    OperatingHour = apps.get_model('gymFindr', 'OperatingHour')
+    OpeningInterval = apps.get_model('gymFindr', 'OpeningInterval')
+    ranges_by_gym = {}
+    for hour in OperatingHour.objects.iterator(chunk_size=2000):
+        start = DAYS.index(hour.day) * MINUTES_PER_DAY + hour.open_time.hour * 60 + hour.open_time.minute
+        opens = hour.open_time.hour * 60 + hour.open_time.minute
+        closes = hour.close_time.hour * 60 + hour.close_time.minute
+        end = start + ((closes - opens) % MINUTES_PER_DAY or MINUTES_PER_DAY)
+        ranges = ranges_by_gym.setdefault(hour.gym_id, [])
+        if end > MINUTES_PER_WEEK:
+            ranges += [(start, MINUTES_PER_WEEK), (0, end - MINUTES_PER_WEEK)]
+        else:
+            ranges.append((start, end))
+    intervals = []
+    for gym_id, ranges in ranges_by_gym.items():
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        intervals += [OpeningInterval(gym_id=gym_id, minutes=NumericRange(start, end)) for start, end in merged]
+    OpeningInterval.objects.bulk_create(intervals, batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gymFindr', '0013_gymsearchdocument_coordinates_planar_gist'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OpeningInterval',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('minutes', django.contrib.postgres.fields.ranges.IntegerRangeField()),
+                ('gym', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='opening_intervals', to='gymFindr.gym')),
+            ],
+            options={
+                'indexes': [django.contrib.postgres.indexes.GistIndex(fields=['minutes'], name='opening_interval_minutes_gist')],
+            },
+        ),
+        migrations.RunPython(build_opening_intervals, migrations.RunPython.noop),
+    ]
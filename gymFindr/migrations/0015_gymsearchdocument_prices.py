@@ -0,0 +1,73 @@
+from decimal import Decimal
+
+from django.db import migrations, models
+
+TYPE_PRICE_FIELDS = {
+    'DAY_PASS': 'day_pass_price',
+    'WEEKLY_PASS': 'weekly_pass_price',
+    'BIWEEKLY_PASS': 'biweekly_pass_price',
+    'MONTH': 'monthly_pass_price',
+    'YEAR': 'annual_pass_price',
+}
+MONTHLY_FACTORS = {
+    'DAY_PASS': Decimal('30'),
+    'WEEKLY_PASS': Decimal('30') / Decimal('7'),
+    'BIWEEKLY_PASS': Decimal('30') / Decimal('14'),
+    'MONTH': Decimal('1'),
+    'YEAR': Decimal('1') / Decimal('12'),
+}
+
+
+def fill_prices(apps, schema_editor):
+    MembershipType = apps.get_model('gymFindr', 'MembershipType')
+    GymSearchDocument = apps.get_model('gymFindr', 'GymSearchDocument')
+    prices = {}
+    for membership in MembershipType.objects.iterator(chunk_size=2000):
+        gym_prices = prices.setdefault(membership.gym_id, {})
+        field = TYPE_PRICE_FIELDS[membership.type]
+        gym_prices[field] = min(membership.price, gym_prices.get(field, membership.price))
+        monthly = (membership.price * MONTHLY_FACTORS[membership.type]).quantize(Decimal('0.01'))
+        gym_prices['price_per_month'] = min(monthly, gym_prices.get('price_per_month', monthly))
+    for gym_id, gym_prices in prices.items():
+        GymSearchDocument.objects.filter(gym_id=gym_id).update(**gym_prices)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gymFindr', '0014_openinginterval'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gymsearchdocument',
+            name='day_pass_price',
+            field=models.DecimalField(blank=True, db_index=True, decimal_places=2, max_digits=6, null=True),
+        ),
+        migrations.AddField(
+            model_name='gymsearchdocument',
+            name='weekly_pass_price',
+            field=models.DecimalField(blank=True, db_index=True, decimal_places=2, max_digits=6, null=True),
+        ),
+        migrations.AddField(
+            model_name='gymsearchdocument',
+            name='biweekly_pass_price',
+            field=models.DecimalField(blank=True, db_index=True, decimal_places=2, max_digits=6, null=True),
+        ),
+        migrations.AddField(
+            model_name='gymsearchdocument',
+            name='monthly_pass_price',
+            field=models.DecimalField(blank=True, db_index=True, decimal_places=2, max_digits=6, null=True),
+        ),
+        migrations.AddField(
+            model_name='gymsearchdocument',
+            name='annual_pass_price',
+            field=models.DecimalField(blank=True, db_index=True, decimal_places=2, max_digits=6, null=True),
+        ),
+        migrations.AddField(
+            model_name='gymsearchdocument',
+            name='price_per_month',
+            field=models.DecimalField(blank=True, db_index=True, decimal_places=2, max_digits=8, null=True),
+        ),
+        migrations.RunPython(fill_prices, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_favorites(apps, schema_editor):
+    Gym = apps.get_model('gymFindr', 'Gym')
+    Favorite = apps.get_model('gymFindr', 'Favorite')
+    counts = Favorite.objects.filter(gym=OuterRef('pk')).order_by().values('gym').annotate(count=Count('pk')).values('count')
+    Gym.objects.update(favorite_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gymFindr', '0016_importcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gym',
+            name='favorite_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_favorites, migrations.RunPython.noop),
+    ]
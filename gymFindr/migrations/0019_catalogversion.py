@@ -0,0 +1,26 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def create_catalog_version(apps, schema_editor):
+    CatalogVersion = apps.get_model('gymFindr', 'CatalogVersion')
+    CatalogVersion.objects.get_or_create(pk=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gymFindr', '0018_gymsearchdocument_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveBigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.RunPython(create_catalog_version, migrations.RunPython.noop),
+    ]
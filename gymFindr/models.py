@@ -1,9 +1,19 @@
+import hashlib
+from decimal import Decimal
+
 from django.db import models
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.conf import settings
+from django.utils import timezone
+from django.utils.text import Truncator
 from django.contrib.gis.db import models as geomodels
+from django.contrib.postgres.fields import IntegerRangeField
+from django.contrib.postgres.indexes import GinIndex, GistIndex
+from django.contrib.postgres.search import SearchVectorField
+from .functions import PlanarPoint
+from .geocoding import normalize_address
 
 
 class CustomUserManager(BaseUserManager):
@@ -64,22 +74,180 @@ class Gym(models.Model):
     contact_info = models.OneToOneField('ContactInfo', on_delete=models.CASCADE, null=True, blank=True)
     classes = models.ManyToManyField('ClassCategory', blank=True)
     amenities = models.ManyToManyField('Amenity', blank=True)
+    # Bitsets of the classes/amenities names, see TaxonomyBitsMixin; the M2M
+    # relations stay the source of truth and gymFindr.signals keeps these in sync
+    class_mask = models.IntegerField(default=0, editable=False)
+    amenity_mask = models.IntegerField(default=0, editable=False)
+    # First words of the description, so listings need not load the full text
+    excerpt = models.CharField(max_length=255, blank=True, editable=False)
+    # Last change to the gym or any row shown on its page, see Gym.touch
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    # Number of Favorite rows, moved with F() updates by gymFindr.favorites;
+    # the reconcile_favorite_counts command recomputes it from the rows
+    favorite_count = models.PositiveIntegerField(default=0, editable=False)
+
+    EXCERPT_WORDS = 20
+
+    def __str__(self):
+        return self.name
+
+    def update_excerpt(self):
+        self.excerpt = Truncator(Truncator(self.description).words(self.EXCERPT_WORDS)).chars(255)
+
+    def save(self, *args, **kwargs):
+        self.update_excerpt()
+        update_fields = kwargs.get('update_fields')
+        if update_fields:
+            update_fields = {*update_fields, 'updated_at'}
+            if 'description' in update_fields:
+                update_fields.add('excerpt')
+            kwargs['update_fields'] = update_fields
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def touch(cls, gym_ids):
+        """Bumps ``updated_at`` of the given gyms after a change to one of their related rows."""
+        gym_ids = [gym_id for gym_id in gym_ids if gym_id is not None]
+        if gym_ids:
+            cls.objects.filter(pk__in=gym_ids).update(updated_at=timezone.now())
+
+
+class GymSearchDocument(models.Model):
+    """Flat, denormalized copy of everything search and the map need for one gym.
+
+    Rows are refreshed by gymFindr.signals and can be rebuilt with the
+    rebuild_search_documents command; never edit them directly.
+    """
+    gym = models.OneToOneField(Gym, on_delete=models.CASCADE, primary_key=True, related_name='search_document')
+    name = models.CharField(max_length=255)
+    city = models.CharField(max_length=100, blank=True)
+    coordinates = geomodels.PointField(geography=True, blank=True, null=True)
+    class_mask = models.IntegerField(default=0)
+    amenity_mask = models.IntegerField(default=0)
+    min_price = models.DecimalField(max_digits=6, decimal_places=2, null=True, blank=True)
+    # Cheapest pass of each MembershipType type, see TYPE_PRICE_FIELDS
+    day_pass_price = models.DecimalField(max_digits=6, decimal_places=2, null=True, blank=True, db_index=True)
+    weekly_pass_price = models.DecimalField(max_digits=6, decimal_places=2, null=True, blank=True, db_index=True)
+    biweekly_pass_price = models.DecimalField(max_digits=6, decimal_places=2, null=True, blank=True, db_index=True)
+    monthly_pass_price = models.DecimalField(max_digits=6, decimal_places=2, null=True, blank=True, db_index=True)
+    annual_pass_price = models.DecimalField(max_digits=6, decimal_places=2, null=True, blank=True, db_index=True)
+    # Cheapest price of a month of access with any pass, see MembershipType.MONTHLY_FACTORS
+    price_per_month = models.DecimalField(max_digits=8, decimal_places=2, null=True, blank=True, db_index=True)
+    free_trial = models.BooleanField(default=False)
+    # Weighted name/classes+amenities/description vector
+    search_vector = SearchVectorField(null=True)
+    # Last refresh of this document
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    TYPE_PRICE_FIELDS = {
+        'DAY_PASS': 'day_pass_price',
+        'WEEKLY_PASS': 'weekly_pass_price',
+        'BIWEEKLY_PASS': 'biweekly_pass_price',
+        'MONTH': 'monthly_pass_price',
+        'YEAR': 'annual_pass_price',
+    }
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_vector'], name='gymdoc_search_vector_gin'),
+            GinIndex(fields=['name'], name='gymdoc_name_trgm_gin', opclasses=['gin_trgm_ops']),
+            # Serves the map's viewport queries, see gymFindr.markers
+            GistIndex(PlanarPoint('coordinates'), name='gymdoc_coordinates_planar_gist'),
+        ]
 
     def __str__(self):
         return self.name
 
 
+class CatalogVersion(models.Model):
+    """Single row counting changes to the search data.
+
+    Bumped by gymFindr.search_cache in the same transaction as every change,
+    it keys the search result cache and the catalog pages' validators, for
+    every process alike.
+    """
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"Catalog version {self.version}"
+
+
 class Location(models.Model):
+    GEOCODE_PENDING = 'PENDING'
+    GEOCODE_DONE = 'DONE'
+    GEOCODE_FAILED = 'FAILED'
+    GEOCODE_STATUS_CHOICES = [
+        (GEOCODE_PENDING, 'Pending'),
+        (GEOCODE_DONE, 'Done'),
+        (GEOCODE_FAILED, 'Failed'),
+    ]
     street_address1 = models.CharField(max_length=255)
     street_address2 = models.CharField(max_length=255, null=True, blank=True)
     city = models.CharField(max_length=100)
     zip_code = models.CharField(max_length=20)
     country = models.CharField(max_length=100)
     coordinates = geomodels.PointField(geography=True, blank=True, null=True)
+    geocode_status = models.CharField(max_length=10, choices=GEOCODE_STATUS_CHOICES, default=GEOCODE_PENDING, editable=False)
+    # Hash of the normalized full_address the coordinates were requested for
+    address_fingerprint = models.CharField(max_length=40, blank=True, editable=False)
 
     def __str__(self):
         return f"{self.street_address1}, {self.city}, {self.country}"
 
+    @property
+    def full_address(self):
+        return f"{self.street_address1}, {self.city}, {self.zip_code}, {self.country}"
+
+    @property
+    def fallback_address(self):
+        return f"{self.city}, {self.country}"
+
+    def compute_address_fingerprint(self):
+        return hashlib.sha1(normalize_address(self.full_address).encode('utf-8')).hexdigest()
+
+    def address_changed(self):
+        """True when the geocoded address fields differ from the stored fingerprint."""
+        return self.compute_address_fingerprint() != self.address_fingerprint
+
+    def mark_for_geocoding(self):
+        """Flags the current address as awaiting coordinates, returns the fields that changed."""
+        fingerprint = self.compute_address_fingerprint()
+        changed = []
+        if self.geocode_status != self.GEOCODE_PENDING:
+            self.geocode_status = self.GEOCODE_PENDING
+            changed.append('geocode_status')
+        if self.address_fingerprint != fingerprint:
+            self.address_fingerprint = fingerprint
+            changed.append('address_fingerprint')
+        return changed
+
+
+class GeocodedAddress(models.Model):
+    # Normalized address string, see gymFindr.geocoding.normalize_address
+    query = models.CharField(max_length=512, unique=True)
+    # Null records a negative result so unknown addresses are not re-queried
+    coordinates = geomodels.PointField(geography=True, blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = 'geocoded addresses'
+
+    def __str__(self):
+        return self.query
+
+
+class GeocodeTask(models.Model):
+    """Queue entry for a Location waiting to be geocoded by the geocode_worker command."""
+    location = models.OneToOneField(Location, on_delete=models.CASCADE, related_name='geocode_task')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now, db_index=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Geocode {self.location}"
+
 
 class ContactInfo(models.Model):
     email = models.EmailField()
@@ -105,6 +273,14 @@ class MembershipType(models.Model):
         ('MONTH', 'Monthly Membership'),
         ('YEAR', 'Annual Membership'),
     ]
+    # Passes needed to cover one month, to compare prices across types
+    MONTHLY_FACTORS = {
+        'DAY_PASS': Decimal('30'),
+        'WEEKLY_PASS': Decimal('30') / Decimal('7'),
+        'BIWEEKLY_PASS': Decimal('30') / Decimal('14'),
+        'MONTH': Decimal('1'),
+        'YEAR': Decimal('1') / Decimal('12'),
+    }
     gym = models.ForeignKey(Gym, related_name='membership_types', on_delete=models.CASCADE)
     type = models.CharField(max_length=100, choices=MEMBERSHIP_CHOICES)
     price = models.DecimalField(max_digits=6, decimal_places=2)
@@ -112,8 +288,32 @@ class MembershipType(models.Model):
     def __str__(self):
         return f"{self.get_type_display()} for {self.gym.name}"
 
+    @property
+    def monthly_price(self):
+        return (self.price * self.MONTHLY_FACTORS[self.type]).quantize(Decimal('0.01'))
+
+
+class TaxonomyBitsMixin:
+    """Maps each ``name`` choice to a bit by its position in the choices list.
 
-class ClassCategory(models.Model):
+    Bit positions are stored in Gym.class_mask/amenity_mask, so new choices
+    must only ever be appended.
+    """
+
+    @classmethod
+    def bit_for(cls, name):
+        codes = [code for code, label in cls._meta.get_field('name').choices]
+        return 1 << codes.index(name)
+
+    @classmethod
+    def mask_for(cls, names):
+        mask = 0
+        for name in names:
+            mask |= cls.bit_for(name)
+        return mask
+
+
+class ClassCategory(TaxonomyBitsMixin, models.Model):
     CATEGORY_CHOICES = [
         ('YOGA', 'Yoga'),
         ('CROSSFIT', 'CrossFit'),
@@ -135,7 +335,7 @@ class ClassCategory(models.Model):
         return self.name
 
 
-class Amenity(models.Model):
+class Amenity(TaxonomyBitsMixin, models.Model):
     AMENITY_CHOICES = [
         ('PARKING', 'Parking'),
         ('LOCKER', 'Locker'),
@@ -172,9 +372,48 @@ class OperatingHour(models.Model):
     open_time = models.TimeField()
     close_time = models.TimeField()
 
+    @classmethod
+    def week_order(cls):
+        """Expression that sorts rows Monday to Sunday rather than alphabetically by day code."""
+        return models.Case(
+            *[models.When(day=code, then=models.Value(index)) for index, (code, label) in enumerate(cls.DAY_CHOICES)],
+            output_field=models.IntegerField(),
+        )
+
     def __str__(self):
         return f"{self.get_day_display()} {self.open_time.strftime('%H:%M')} - {self.close_time.strftime('%H:%M')}"
 
+class ImportCheckpoint(models.Model):
+    """How far the import_gyms command got through a source file.
+
+    Updated in the same transaction as each imported chunk, so a rerun
+    resumes exactly after the last committed row.
+    """
+    source = models.CharField(max_length=512, unique=True)
+    rows_done = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.source}: {self.rows_done} rows"
+
+
+class OpeningInterval(models.Model):
+    """A stretch of a gym's week in minutes since Monday 00:00, derived from its OperatingHours.
+
+    Maintained by gymFindr.opening_hours; never edit these rows directly.
+    """
+    gym = models.ForeignKey(Gym, related_name='opening_intervals', on_delete=models.CASCADE)
+    # Half-open [open, close) range within 0-10080
+    minutes = IntegerRangeField()
+
+    class Meta:
+        indexes = [
+            GistIndex(fields=['minutes'], name='opening_interval_minutes_gist'),
+        ]
+
+    def __str__(self):
+        return f"{self.gym_id}: {self.minutes.lower}-{self.minutes.upper}"
+
 class Favorite(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='favorites', on_delete=models.CASCADE)
     gym = models.ForeignKey(Gym, related_name='favorited_by', on_delete=models.CASCADE)
@@ -0,0 +1,79 @@
+"""Weekly opening intervals for "open now" / "open at" searches.
+
+A gym's OperatingHour rows are flattened into OpeningInterval rows holding
+half-open ranges of minutes since Monday 00:00. Hours that close at or
+before they open run past midnight, and a Sunday night that runs into
+Monday is split at the end of the week, so no stored range wraps around.
+Overlapping and touching ranges are merged. "Is gym X open at minute m"
+then becomes a single ``minutes @> m`` test, which the GiST index on
+OpeningInterval.minutes answers.
+
+Times are wall-clock times in ``TIME_ZONE``.
+"""
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.db.backends.postgresql.psycopg_any import NumericRange
+from django.utils import timezone
+
+from .models import OpeningInterval, OperatingHour
+from .search_cache import invalidate_search_cache
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+DAY_INDEX = {code: index for index, (code, label) in enumerate(OperatingHour.DAY_CHOICES)}
+
+
+def minute_of_week(day, time):
+    """Returns the minutes since Monday 00:00 of a ``DAY_CHOICES`` code and a time."""
+    return DAY_INDEX[day] * MINUTES_PER_DAY + time.hour * 60 + time.minute
+
+
+def current_minute_of_week():
+    now = timezone.localtime()
+    return now.weekday() * MINUTES_PER_DAY + now.hour * 60 + now.minute
+
+
+def week_intervals(hours):
+    """Returns the merged ``(start, end)`` minute ranges covered by OperatingHour rows."""
+    ranges = []
+    for hour in hours:
+        start = minute_of_week(hour.day, hour.open_time)
+        opens = hour.open_time.hour * 60 + hour.open_time.minute
+        closes = hour.close_time.hour * 60 + hour.close_time.minute
+        # Closing at or before opening time means closing the next day
+        end = start + ((closes - opens) % MINUTES_PER_DAY or MINUTES_PER_DAY)
+        if end > MINUTES_PER_WEEK:
+            ranges += [(start, MINUTES_PER_WEEK), (0, end - MINUTES_PER_WEEK)]
+        else:
+            ranges.append((start, end))
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def rebuild_opening_intervals(gym_ids):
+    """Replaces the OpeningInterval rows of the given gyms with ones built from their hours."""
+    gym_ids = list(gym_ids)
+    hours_by_gym = {gym_id: [] for gym_id in gym_ids}
+    for hour in OperatingHour.objects.filter(gym_id__in=gym_ids).only('gym_id', 'day', 'open_time', 'close_time'):
+        hours_by_gym[hour.gym_id].append(hour)
+    intervals = [
+        OpeningInterval(gym_id=gym_id, minutes=NumericRange(start, end))
+        for gym_id, hours in hours_by_gym.items()
+        for start, end in week_intervals(hours)
+    ]
+    with transaction.atomic():
+        OpeningInterval.objects.filter(gym_id__in=gym_ids).delete()
+        OpeningInterval.objects.bulk_create(intervals)
+        invalidate_search_cache()
+    return len(intervals)
+
+
+def open_at_filter(minute):
+    """Returns a Q for GymSearchDocument rows whose gym is open at ``minute`` of the week."""
+    return Q(Exists(OpeningInterval.objects.filter(gym=OuterRef('pk'), minutes__contains=minute)))
@@ -0,0 +1,173 @@
+"""Keyset ("seek") pagination for list views.
+
+Pages are addressed by an opaque cursor holding the ordering key of the
+row the page starts after, so page 50 is a ``WHERE key > cursor LIMIT n``
+index seek like page 1, and no ``COUNT(*)`` is ever run.
+"""
+import base64
+import binascii
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(values, backwards=False):
+    payload = json.dumps({'k': list(values), 'b': backwards}, cls=DjangoJSONEncoder, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Returns ``(values, backwards)`` for a cursor made by ``encode_cursor``."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        return payload['k'], bool(payload['b'])
+    except (binascii.Error, UnicodeError, ValueError, KeyError, TypeError) as exc:
+        raise InvalidCursor(cursor) from exc
+
+
+def _split(ordering):
+    return [(name.lstrip('-'), name.startswith('-')) for name in ordering]
+
+
+def keyset_filter(ordering, values, backwards=False):
+    """Returns a Q selecting the rows strictly after ``values`` in ``ordering``.
+
+    With ``backwards`` it selects the rows strictly before them instead.
+    ``(a, b) > (x, y)`` is expanded to ``a > x OR (a = x AND b > y)`` so each
+    column keeps its own direction.
+    """
+    condition = Q()
+    equal = Q()
+    for (name, descending), value in zip(_split(ordering), values):
+        lookup = 'lt' if descending != backwards else 'gt'
+        condition |= equal & Q(**{f'{name}__{lookup}': value})
+        equal &= Q(**{name: value})
+    return condition
+
+
+def row_key(obj, ordering):
+    return [getattr(obj, name) for name, descending in _split(ordering)]
+
+
+class KeysetPage:
+    """The rows of one keyset page plus the cursors of its neighbours."""
+
+    def __init__(self, object_list, ordering, has_next, has_previous):
+        self.object_list = object_list
+        self.has_next_page = has_next
+        self.has_previous_page = has_previous
+        self.next_cursor = encode_cursor(row_key(object_list[-1], ordering)) if has_next else None
+        self.previous_cursor = (
+            encode_cursor(row_key(object_list[0], ordering), backwards=True) if has_previous else None
+        )
+
+    def has_next(self):
+        return self.has_next_page
+
+    def has_previous(self):
+        return self.has_previous_page
+
+    def has_other_pages(self):
+        return self.has_next_page or self.has_previous_page
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def paginate_keyset(queryset, ordering, per_page, cursor=None):
+    """Returns the KeysetPage of ``queryset`` in ``ordering`` that follows ``cursor``.
+
+    The last ordering column must be unique (normally ``pk``). One extra row
+    is fetched to tell whether another page exists. Invalid cursors fall
+    back to the first page.
+    """
+    values, backwards = None, False
+    if cursor:
+        try:
+            values, backwards = decode_cursor(cursor)
+        except InvalidCursor:
+            values = None
+    if values is not None and len(values) != len(ordering):
+        values, backwards = None, False
+
+    if backwards:
+        flipped = [name[1:] if name.startswith('-') else f'-{name}' for name in ordering]
+        queryset = queryset.filter(keyset_filter(ordering, values, backwards=True)).order_by(*flipped)
+    else:
+        if values is not None:
+            queryset = queryset.filter(keyset_filter(ordering, values))
+        queryset = queryset.order_by(*ordering)
+
+    rows = list(queryset[:per_page + 1])
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+        has_next, has_previous = True, more
+    else:
+        has_next, has_previous = more, values is not None
+    if not rows:
+        has_next = has_previous = False
+    return KeysetPage(rows, ordering, has_next, has_previous)
+
+
+def estimate_count(queryset):
+    """Returns the PostgreSQL planner's row estimate for ``queryset``, or None.
+
+    Costs one EXPLAIN instead of running the query, and is meant for
+    "about N results" labels where an exact COUNT(*) would be too slow.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    if queryset.query.is_empty():
+        return 0
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']['Plan Rows']
+
+
+class KeysetPaginationMixin:
+    """ListView mixin replacing page-number pagination with keyset cursors.
+
+    Set ``keyset_ordering`` to the ordering to page through; its last
+    column must be unique. Adds ``next_page_url``/``previous_page_url`` to
+    the context, preserving the other query parameters.
+    """
+    keyset_ordering = ('pk',)
+    cursor_kwarg = 'cursor'
+
+    def get_keyset_ordering(self):
+        return self.keyset_ordering
+
+    def paginate_queryset(self, queryset, page_size):
+        cursor = self.request.GET.get(self.cursor_kwarg)
+        page = paginate_keyset(queryset, self.get_keyset_ordering(), page_size, cursor)
+        return None, page, page.object_list, page.has_other_pages()
+
+    def _page_url(self, cursor):
+        params = self.request.GET.copy()
+        params[self.cursor_kwarg] = cursor
+        return f'?{params.urlencode()}'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        page = context.get('page_obj')
+        if page is not None:
+            context['next_page_url'] = self._page_url(page.next_cursor) if page.has_next() else None
+            context['previous_page_url'] = self._page_url(page.previous_cursor) if page.has_previous() else None
+        return context
@@ -0,0 +1,204 @@
+import logging
+import math
+
+from django.contrib.gis.geos import Point
+from django.contrib.gis.measure import D
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramWordSimilarity
+from django.db.models import F, FloatField, Q
+from django.db.models.functions import Cast
+from django.db.models.lookups import Exact
+from django.utils.functional import cached_property
+
+from .functions import KNNDistance
+from .geocoding import GeocodingError, lookup_address
+from .models import Amenity, ClassCategory, GymSearchDocument
+from .opening_hours import current_minute_of_week, minute_of_week, open_at_filter
+from .search_index import SEARCH_CONFIG
+from .spatial_engine import engine_nearest_gyms, get_spatial_engine
+
+logger = logging.getLogger(__name__)
+
+
+def lookup_search_location(request, address):
+    """Geocodes a searched place once per request, so the ETag and the view share one lookup.
+
+    Returns ``(lat, lng)`` or None like ``lookup_address``, and raises its
+    GeocodingError again on every call when the lookup failed.
+    """
+    lookups = getattr(request, '_search_locations', None)
+    if lookups is None:
+        lookups = {}
+        if request is not None:
+            request._search_locations = lookups
+    if address not in lookups:
+        try:
+            lookups[address] = lookup_address(address)
+        except GeocodingError as exc:
+            lookups[address] = exc
+    result = lookups[address]
+    if isinstance(result, GeocodingError):
+        raise result
+    return result
+
+
+def nearest_gyms(queryset, point, max_distance=None, filtered=False):
+    """Orders search documents nearest-first, optionally limited to ``max_distance`` km.
+
+    The radius is an ST_DWithin filter and ``distance`` (in meters) is the
+    KNN operator, so both the filter and the ordering are answered from the
+    GiST index on coordinates. With the in-process spatial engine enabled,
+    the engine finds the nearest gyms of unfiltered searches instead, see
+    gymFindr.spatial_engine; pass ``filtered`` when ``queryset`` has filters.
+    """
+    engine = None if filtered else get_spatial_engine()
+    if engine is not None:
+        nearest = engine_nearest_gyms(queryset, engine, point, max_distance)
+        if nearest is not None:
+            return nearest
+    queryset = queryset.filter(coordinates__isnull=False)
+    if max_distance:
+        queryset = queryset.filter(coordinates__dwithin=(point, D(km=max_distance)))
+    return queryset.annotate(distance=KNNDistance('coordinates', point)).order_by('distance', 'pk')
+
+
+class GymSearch:
+    """Plans a gym search from ``GymSearchForm.cleaned_data``.
+
+    Location, text, class, amenity, opening time and price filters are
+    all optional and combine into a single statement over
+    GymSearchDocument. Classes and amenities are matched against the
+    bitset columns, opening times against the gym's OpeningIntervals and
+    prices against the precomputed price columns. Text matches the
+    stored search vector, or the name by trigram word similarity to
+    tolerate typos, and is ranked by relevance when there is no point to
+    order by. Sorting by price overrides both orders. ``ordering`` is the
+    unique sort key used for keyset paging.
+    """
+
+    def __init__(self, cleaned_data, grid=None, request=None):
+        self.data = cleaned_data
+        # Shares the geocoding of search_location with the page's ETag
+        self.request = request
+        # Current locations are snapped to the centre of a ``grid``-degree cell
+        # so that nearby users share search cache entries
+        self.grid = grid
+        self._point = None
+        self._resolved = False
+        # True when search_location could not be geocoded because of a
+        # transient error, so the empty result must not be cached
+        self.geocode_failed = False
+
+    @property
+    def uses_current_location(self):
+        data = self.data
+        return bool(data.get('use_current_location')) and data.get('lat') is not None and data.get('lng') is not None
+
+    @property
+    def has_location(self):
+        return self.uses_current_location or bool(self.data.get('search_location'))
+
+    @property
+    def current_location(self):
+        """Returns ``(lat, lng)`` of the browser location, snapped to the grid."""
+        lat, lng = self.data['lat'], self.data['lng']
+        if self.grid:
+            lat = round((math.floor(lat / self.grid) + 0.5) * self.grid, 6)
+            lng = round((math.floor(lng / self.grid) + 0.5) * self.grid, 6)
+        return lat, lng
+
+    @property
+    def point(self):
+        """The point to search around, geocoding ``search_location`` on first use."""
+        if not self._resolved:
+            self._resolved = True
+            if self.uses_current_location:
+                lat, lng = self.current_location
+            elif self.data.get('search_location'):
+                try:
+                    lat, lng = lookup_search_location(self.request, self.data['search_location']) or (None, None)
+                except GeocodingError as exc:
+                    logger.warning('Geocoding %r failed: %s', self.data['search_location'], exc)
+                    self.geocode_failed = True
+                    lat = lng = None
+            else:
+                lat = lng = None
+            if lat is not None and lng is not None:
+                self._point = Point(lng, lat, srid=4326)
+        return self._point
+
+    @property
+    def price_field(self):
+        """Document column the price filters and sort apply to."""
+        pass_type = self.data.get('pass_type')
+        return GymSearchDocument.TYPE_PRICE_FIELDS[pass_type] if pass_type else 'price_per_month'
+
+    @property
+    def ordering(self):
+        if self.data.get('sort') == 'price':
+            return (self.price_field, 'pk')
+        if self.has_location:
+            return ('distance', 'pk')
+        if self.data.get('query'):
+            return ('-rank', 'pk')
+        return ('pk',)
+
+    @cached_property
+    def open_minute(self):
+        """Minute of the week the gym must be open at, or None; "open now" is fixed on first use."""
+        if self.data.get('open_now'):
+            return current_minute_of_week()
+        if self.data.get('open_day') and self.data.get('open_time') is not None:
+            return minute_of_week(self.data['open_day'], self.data['open_time'])
+        return None
+
+    @property
+    def search_query(self):
+        return SearchQuery(self.data['query'], search_type='websearch', config=SEARCH_CONFIG)
+
+    def filters(self):
+        filters = Q()
+        query = self.data.get('query')
+        class_categories = self.data.get('class_category')
+        amenities = self.data.get('amenity')
+        if query:
+            filters &= Q(search_vector=self.search_query) | Q(name__trigram_word_similar=query)
+        if class_categories:
+            mask = ClassCategory.mask_for(category.name for category in class_categories)
+            filters &= Q(Exact(F('class_mask').bitand(mask), mask))
+        if amenities:
+            mask = Amenity.mask_for(amenity.name for amenity in amenities)
+            filters &= Q(Exact(F('amenity_mask').bitand(mask), mask))
+        if self.open_minute is not None:
+            filters &= open_at_filter(self.open_minute)
+        if self.data.get('min_price') is not None:
+            filters &= Q(**{f'{self.price_field}__gte': self.data['min_price']})
+        if self.data.get('max_price') is not None:
+            filters &= Q(**{f'{self.price_field}__lte': self.data['max_price']})
+        if self.data.get('sort') == 'price' or self.data.get('pass_type'):
+            # Gyms without a price cannot be sorted or compared on it
+            filters &= Q(**{f'{self.price_field}__isnull': False})
+        return filters
+
+    def queryset(self, queryset=None):
+        if queryset is None:
+            queryset = GymSearchDocument.objects.all()
+        if self.has_location:
+            if self.point is None:
+                # The place could not be found, so nothing can be near it
+                return queryset.none()
+            filters = self.filters()
+            queryset = nearest_gyms(
+                queryset.filter(filters), self.point, self.data.get('max_distance'), filtered=bool(filters),
+            )
+            return queryset.order_by(*self.ordering)
+        queryset = queryset.filter(self.filters())
+        if self.data.get('query'):
+            # float8 so the rank survives a round trip through a page cursor
+            queryset = queryset.annotate(
+                rank=Cast(
+                    SearchRank(F('search_vector'), self.search_query)
+                    + TrigramWordSimilarity(self.data['query'], 'name'),
+                    FloatField(),
+                ),
+            )
+        return queryset.order_by(*self.ordering)
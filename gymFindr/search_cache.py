@@ -0,0 +1,172 @@
+"""Shared cache of ordered search results.
+
+An entry holds the sort keys (ending in the gym id) of the first
+``SEARCH_CACHE_MAX_RESULTS`` matches of one normalized set of search
+parameters. Pages inside that window are served from the entry plus one
+``in_bulk`` of their documents, skipping both the geocoder and the spatial
+query.
+
+Entries are keyed by the CatalogVersion row, which ``invalidate_search_cache``
+bumps in the same transaction as every change to the indexed data. The
+version lives in the database rather than in the cache, so a write handled
+by one process also orphans the entries of every other one, even when each
+has its own cache. Writers queue on the row until they commit, which is
+cheap at the rate gyms are edited and once per chunk for imports.
+"""
+import bisect
+import datetime
+import decimal
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import F, Model
+from django.utils import timezone
+
+from .geocoders import normalize_address
+from .models import CatalogVersion, GymSearchDocument
+from .pagination import InvalidCursor, KeysetPage, decode_cursor, estimate_count
+
+SEARCH_CACHE_ALIAS = getattr(settings, 'SEARCH_CACHE_ALIAS', 'default')
+SEARCH_CACHE_TIMEOUT = getattr(settings, 'SEARCH_CACHE_TIMEOUT', 300)
+SEARCH_CACHE_GRID = getattr(settings, 'SEARCH_CACHE_GRID', 0.01)
+SEARCH_CACHE_MAX_RESULTS = getattr(settings, 'SEARCH_CACHE_MAX_RESULTS', 200)
+
+# Location inputs, folded into a single normalized entry below
+LOCATION_FIELDS = {'lat', 'lng', 'use_current_location', 'search_location'}
+# Opening time inputs, folded into the minute of the week they stand for
+OPEN_FIELDS = {'open_now', 'open_day', 'open_time'}
+
+
+def _normalize(value):
+    if isinstance(value, str):
+        return ' '.join(value.lower().split())
+    if isinstance(value, Model):
+        return value.pk
+    if isinstance(value, (list, tuple, set)) or hasattr(value, 'model'):
+        return sorted(_normalize(item) for item in value)
+    if isinstance(value, (datetime.date, datetime.time, decimal.Decimal)):
+        return str(value)
+    return value
+
+
+def catalog_version(request=None):
+    """Returns ``(version, updated_at)`` of the catalog, read once per ``request`` when one is given."""
+    state = getattr(request, '_catalog_version', None)
+    if state is None:
+        state = CatalogVersion.objects.filter(pk=1).values_list('version', 'updated_at').first() or (0, None)
+        if request is not None:
+            request._catalog_version = state
+    return state
+
+
+def search_cache_key(search, version):
+    """Returns the cache key for a GymSearch's parameters at catalog ``version``."""
+    params = {
+        name: _normalize(value)
+        for name, value in search.data.items()
+        if name not in LOCATION_FIELDS | OPEN_FIELDS and value not in (None, '', [], False)
+    }
+    if search.open_minute is not None:
+        # "Open now" must not be served from an entry made in another minute
+        params['@open_minute'] = search.open_minute
+    if search.uses_current_location:
+        params['@point'] = search.current_location
+    elif search.data.get('search_location'):
+        params['@place'] = normalize_address(search.data['search_location'])
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+    return f"gymsearch:{version}:{digest}"
+
+
+def invalidate_search_cache():
+    """Orphans every cached search result; called whenever search documents change.
+
+    Runs in the caller's transaction, so searches in other transactions keep
+    reading, and caching under, the old version until the change commits.
+    """
+    updated = CatalogVersion.objects.filter(pk=1).update(version=F('version') + 1, updated_at=timezone.now())
+    if not updated:
+        CatalogVersion.objects.get_or_create(pk=1, defaults={'version': 1})
+
+
+def _sort_value(row, descending):
+    # Decimal keys (prices) come back from a JSON page cursor as strings
+    row = [decimal.Decimal(value) if isinstance(value, str) else value for value in row]
+    return tuple(-value if desc else value for value, desc in zip(row, descending))
+
+
+def _load_entry(search, version):
+    cache = caches[SEARCH_CACHE_ALIAS]
+    key = search_cache_key(search, version)
+    entry = cache.get(key)
+    if entry is None:
+        queryset = search.queryset()
+        fields = [name.lstrip('-') for name in search.ordering]
+        rows = [list(row) for row in queryset.values_list(*fields)[:SEARCH_CACHE_MAX_RESULTS + 1]]
+        complete = len(rows) <= SEARCH_CACHE_MAX_RESULTS
+        rows = rows[:SEARCH_CACHE_MAX_RESULTS]
+        entry = {
+            'rows': rows,
+            'complete': complete,
+            'total': len(rows) if complete else estimate_count(queryset),
+        }
+        # A place that could not be geocoded right now may well be found on the next try
+        if not search.geocode_failed:
+            cache.set(key, entry, SEARCH_CACHE_TIMEOUT)
+    return entry
+
+
+def get_cached_page(search, per_page, cursor=None, documents=None, request=None):
+    """Returns ``(KeysetPage, total)`` for a search from the result cache.
+
+    The page's rows are loaded from ``documents``, a GymSearchDocument
+    queryset (all of them by default). Returns ``(None, None)`` when the
+    requested page lies past the cached window, in which case the caller
+    runs the search query itself. ``request`` shares its catalog version
+    read with the page's validators.
+    """
+    entry = _load_entry(search, catalog_version(request)[0])
+    ordering = search.ordering
+    descending = [name.startswith('-') for name in ordering]
+    rows = entry['rows']
+    keys = [_sort_value(row, descending) for row in rows]
+
+    values, backwards = None, False
+    if cursor:
+        try:
+            values, backwards = decode_cursor(cursor)
+        except InvalidCursor:
+            values = None
+        if values is not None and len(values) != len(ordering):
+            values, backwards = None, False
+
+    if values is None:
+        start = 0
+        end = per_page
+    elif backwards:
+        end = bisect.bisect_left(keys, _sort_value(values, descending))
+        start = max(end - per_page, 0)
+    else:
+        start = bisect.bisect_right(keys, _sort_value(values, descending))
+        end = start + per_page
+    if end > len(rows) and not entry['complete']:
+        return None, None
+
+    page_rows = rows[start:end]
+    if documents is None:
+        documents = GymSearchDocument.objects.all()
+    page_documents = documents.in_bulk([row[-1] for row in page_rows])
+    object_list = []
+    for row in page_rows:
+        document = page_documents.get(row[-1])
+        if document is None:
+            continue
+        for name, value in zip(ordering[:-1], row[:-1]):
+            setattr(document, name.lstrip('-'), value)
+        object_list.append(document)
+    has_next = end < len(rows) or not entry['complete']
+    has_previous = start > 0
+    if not object_list:
+        has_next = has_previous = False
+    return KeysetPage(object_list, ordering, has_next, has_previous), entry['total']
@@ -0,0 +1,147 @@
+import threading
+from contextlib import contextmanager
+
+from django.contrib.postgres.search import SearchVector
+from django.db.models import Value
+
+from .models import Amenity, ClassCategory, Gym, GymSearchDocument
+from .opening_hours import rebuild_opening_intervals
+from .search_cache import invalidate_search_cache
+from .spatial_engine import update_spatial_engine
+
+SEARCH_CONFIG = 'english'
+
+# Document columns rewritten on every refresh
+DOCUMENT_FIELDS = [
+    'name', 'city', 'coordinates', 'class_mask', 'amenity_mask',
+    'min_price', *GymSearchDocument.TYPE_PRICE_FIELDS.values(), 'price_per_month',
+    'free_trial', 'search_vector', 'updated_at',
+]
+
+_deferred = threading.local()
+
+
+def gym_search_vector(gym):
+    """Returns the weighted search vector expression for a gym.
+
+    Name ranks above class and amenity labels, which rank above the
+    description. ``gym`` should have classes and amenities prefetched.
+    """
+    taxonomy = ' '.join(
+        [category.get_name_display() for category in gym.classes.all()]
+        + [amenity.get_name_display() for amenity in gym.amenities.all()]
+    )
+    return (
+        SearchVector(Value(gym.name), weight='A', config=SEARCH_CONFIG)
+        + SearchVector(Value(taxonomy), weight='B', config=SEARCH_CONFIG)
+        + SearchVector(Value(gym.description), weight='C', config=SEARCH_CONFIG)
+    )
+
+
+def build_search_document(gym):
+    """Returns the unsaved GymSearchDocument for a gym loaded by ``refresh_search_documents``."""
+    location = gym.location
+    memberships = list(gym.membership_types.all())
+    type_prices = {}
+    for membership in memberships:
+        field = GymSearchDocument.TYPE_PRICE_FIELDS[membership.type]
+        type_prices[field] = min(membership.price, type_prices.get(field, membership.price))
+    return GymSearchDocument(
+        gym=gym,
+        name=gym.name,
+        city=location.city if location else '',
+        coordinates=location.coordinates if location else None,
+        class_mask=gym.class_mask,
+        amenity_mask=gym.amenity_mask,
+        min_price=min(membership.price for membership in memberships) if memberships else None,
+        price_per_month=min(membership.monthly_price for membership in memberships) if memberships else None,
+        free_trial=gym.free_trial,
+        search_vector=gym_search_vector(gym),
+        **type_prices,
+    )
+
+
+@contextmanager
+def deferred_search_refresh():
+    """Collects the refresh_search_documents and refresh_opening_intervals calls made inside the block
+    and runs them once at the end.
+
+    Use it around writes that touch many rows of the same gyms, such as
+    saving a formset, which would otherwise refresh once per row.
+    """
+    pending = getattr(_deferred, 'gym_ids', None)
+    if pending is not None:
+        # Nested; the outermost block does the refresh
+        yield
+        return
+    _deferred.gym_ids = set()
+    _deferred.interval_gym_ids = set()
+    try:
+        yield
+        gym_ids, interval_gym_ids = _deferred.gym_ids, _deferred.interval_gym_ids
+    finally:
+        _deferred.gym_ids = _deferred.interval_gym_ids = None
+    if gym_ids:
+        refresh_search_documents(gym_ids)
+    if interval_gym_ids:
+        rebuild_opening_intervals(interval_gym_ids)
+
+
+def refresh_search_documents(gym_ids):
+    """Rebuilds the search documents of the given gyms with one upsert.
+
+    Also brings the Gym class/amenity bitsets in line with the M2M rows,
+    since the documents copy them. Inside ``deferred_search_refresh`` the
+    gyms are only recorded.
+    """
+    pending = getattr(_deferred, 'gym_ids', None)
+    if pending is not None:
+        pending.update(gym_ids)
+        return 0
+    gyms = list(
+        Gym.objects.filter(pk__in=gym_ids)
+        .select_related('location')
+        .prefetch_related('classes', 'amenities', 'membership_types')
+    )
+    for gym in gyms:
+        class_mask = ClassCategory.mask_for(category.name for category in gym.classes.all())
+        amenity_mask = Amenity.mask_for(amenity.name for amenity in gym.amenities.all())
+        if (class_mask, amenity_mask) != (gym.class_mask, gym.amenity_mask):
+            gym.class_mask, gym.amenity_mask = class_mask, amenity_mask
+            Gym.objects.filter(pk=gym.pk).update(class_mask=class_mask, amenity_mask=amenity_mask)
+    documents = [build_search_document(gym) for gym in gyms]
+    GymSearchDocument.objects.bulk_create(
+        documents,
+        update_conflicts=True,
+        unique_fields=['gym'],
+        update_fields=DOCUMENT_FIELDS,
+    )
+    invalidate_search_cache()
+    update_spatial_engine({document.gym_id: document.coordinates for document in documents})
+    return len(gyms)
+
+
+def refresh_opening_intervals(gym_ids):
+    """Rebuilds the OpeningInterval rows of the given gyms from their hours.
+
+    Inside ``deferred_search_refresh`` the gyms are only recorded.
+    """
+    pending = getattr(_deferred, 'interval_gym_ids', None)
+    if pending is not None:
+        pending.update(gym_ids)
+        return 0
+    return rebuild_opening_intervals(gym_ids)
+
+
+def rebuild_search_documents(batch_size=500):
+    """Refreshes the documents of every gym in id-ordered batches, returns the count."""
+    refreshed = 0
+    last_id = 0
+    while True:
+        gym_ids = list(
+            Gym.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:batch_size]
+        )
+        if not gym_ids:
+            return refreshed
+        refreshed += refresh_search_documents(gym_ids)
+        last_id = gym_ids[-1]
@@ -0,0 +1,139 @@
+"""Saving a gym together with its location, contact details and inline rows.
+
+GymCreateView and GymUpdateView build the forms with ``gym_related_forms``
+once per request, validate them once, and hand them to ``save_gym``. It
+writes everything in one transaction. New inline rows (images, memberships,
+hours) and a new gym's class/amenity rows go in with one ``bulk_create``
+per table, and edited inline rows with one ``bulk_update`` per table.
+Neither sends signals, so the search document, opening intervals and
+Gym.updated_at are refreshed here, once per save rather than once per row.
+"""
+from django.db import transaction
+
+from .forms import ContactInfoForm, GymImageFormSet, LocationForm, MembershipTypeFormSet, OperatingHourFormSet
+from .geocoding import enqueue_geocoding
+from .models import Amenity, ClassCategory, GeocodeTask, Gym
+from .search_index import deferred_search_refresh, refresh_opening_intervals, refresh_search_documents
+
+
+def gym_related_forms(gym=None, data=None, files=None):
+    """Returns the forms edited alongside GymForm, keyed by their template context name.
+
+    ``gym`` is None on create. Pass ``data`` (and ``files``) to bind them.
+    """
+    return {
+        'location_form': LocationForm(data, instance=gym.location if gym else None, prefix='location'),
+        'contact_info_form': ContactInfoForm(data, instance=gym.contact_info if gym else None, prefix='contact_info'),
+        'image_formset': GymImageFormSet(data, files, instance=gym, prefix='images'),
+        'membership_formset': MembershipTypeFormSet(data, instance=gym, prefix='memberships'),
+        'operating_hour_formset': OperatingHourFormSet(data, instance=gym, prefix='operating_hours'),
+    }
+
+
+def _update_rows(formset):
+    """Writes the edited existing rows of a formset saved with ``commit=False`` with one bulk_update."""
+    rows = [row for row, changed in formset.changed_objects]
+    names = {name for row, changed in formset.changed_objects for name in changed}
+    fields = [field for field in formset.model._meta.concrete_fields if field.name in names and not field.primary_key]
+    if not rows or not fields:
+        return
+    for row in rows:
+        for field in fields:
+            # What save() would write, e.g. a newly uploaded image is stored first
+            setattr(row, field.attname, field.pre_save(row, add=False))
+    formset.model.objects.bulk_update(rows, [field.name for field in fields])
+
+
+def _save_rows(formset, gym):
+    """Saves a validated inline formset with one query per kind of change. Returns True if any row changed."""
+    formset.instance = gym
+    rows = formset.save(commit=False)
+    _update_rows(formset)
+    formset.model.objects.bulk_create([row for row in rows if row._state.adding])
+    deleted = [row.pk for row in formset.deleted_objects]
+    if deleted:
+        formset.model.objects.filter(pk__in=deleted).delete()
+    return bool(rows or deleted)
+
+
+def _create_gym(gym, form, location_form, contact_info_form):
+    # Coordinates are filled in later by the geocode_worker command
+    location = location_form.save(commit=False)
+    location.mark_for_geocoding()
+    location.save()
+    GeocodeTask.objects.create(location=location)
+    gym.location = location
+    gym.contact_info = contact_info_form.save()
+
+    classes, amenities = form.cleaned_data['classes'], form.cleaned_data['amenities']
+    # With the bitsets set up front the search refresh has nothing to correct
+    gym.class_mask = ClassCategory.mask_for(category.name for category in classes)
+    gym.amenity_mask = Amenity.mask_for(amenity.name for amenity in amenities)
+    gym.save()
+    Gym.classes.through.objects.bulk_create([
+        Gym.classes.through(gym_id=gym.pk, classcategory_id=category.pk) for category in classes
+    ])
+    Gym.amenities.through.objects.bulk_create([
+        Gym.amenities.through(gym_id=gym.pk, amenity_id=amenity.pk) for amenity in amenities
+    ])
+
+
+def _update_gym(gym, form, location_form, contact_info_form):
+    gym_fields = [name for name in form.changed_data if name not in ('classes', 'amenities')]
+    if gym_fields:
+        gym.save(update_fields=gym_fields)
+    if 'classes' in form.changed_data:
+        gym.classes.set(form.cleaned_data['classes'])
+    if 'amenities' in form.changed_data:
+        gym.amenities.set(form.cleaned_data['amenities'])
+
+    # Only rewrite the Location/ContactInfo columns that were edited, and
+    # only re-geocode when a field that feeds the geocoder changed
+    if location_form.has_changed():
+        location = location_form.save(commit=False)
+        update_fields = list(location_form.changed_data)
+        geocode = location.address_changed()
+        if geocode:
+            update_fields += location.mark_for_geocoding()
+        if location._state.adding:
+            location.save()
+            gym.location = location
+            gym.save(update_fields=['location'])
+        else:
+            location.save(update_fields=update_fields)
+        if geocode:
+            enqueue_geocoding(location)
+    if contact_info_form.has_changed():
+        contact_info = contact_info_form.save(commit=False)
+        if contact_info._state.adding:
+            contact_info.save()
+            gym.contact_info = contact_info
+            gym.save(update_fields=['contact_info'])
+        else:
+            contact_info.save(update_fields=contact_info_form.changed_data)
+
+
+def save_gym(form, related_forms, owner=None):
+    """Saves a validated GymForm and its ``gym_related_forms`` in one transaction, returns the gym.
+
+    ``owner`` is only used when the gym is new.
+    """
+    gym = form.save(commit=False)
+    creating = gym._state.adding
+    with transaction.atomic(), deferred_search_refresh():
+        if creating:
+            gym.owner = owner
+            _create_gym(gym, form, related_forms['location_form'], related_forms['contact_info_form'])
+        else:
+            _update_gym(gym, form, related_forms['location_form'], related_forms['contact_info_form'])
+
+        images_changed = _save_rows(related_forms['image_formset'], gym)
+        memberships_changed = _save_rows(related_forms['membership_formset'], gym)
+        hours_changed = _save_rows(related_forms['operating_hour_formset'], gym)
+        if creating or memberships_changed:
+            refresh_search_documents([gym.pk])
+        if hours_changed:
+            refresh_opening_intervals([gym.pk])
+        if not creating and (images_changed or memberships_changed or hours_changed):
+            Gym.touch([gym.pk])
+    return gym
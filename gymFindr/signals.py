@@ -0,0 +1,113 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Amenity, ClassCategory, ContactInfo, Gym, GymImage, Location, MembershipType, OperatingHour
+from .search_cache import invalidate_search_cache
+from .search_index import refresh_opening_intervals, refresh_search_documents
+from .spatial_engine import update_spatial_engine
+from .taxonomy import invalidate_taxonomy
+
+# Gym fields copied into, or feeding, its GymSearchDocument
+SEARCH_DOCUMENT_FIELDS = {'name', 'description', 'free_trial', 'location'}
+
+
+def _gym_rows_changed(gym_ids):
+    """Marks the given gyms modified after a change to a row shown on their pages."""
+    # Gym.updated_at keys the detail page cache and validates conditional requests
+    Gym.touch(list(gym_ids))
+
+
+def _m2m_gym_ids(instance, reverse, pk_set):
+    """Returns the ids of the gyms touched by an m2m_changed signal on Gym.classes/amenities."""
+    if not reverse:
+        return [instance.pk]
+    return list(pk_set or ())
+
+
+@receiver(post_save, sender=Gym)
+def refresh_gym_search_document(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not SEARCH_DOCUMENT_FIELDS.intersection(update_fields):
+        return
+    refresh_search_documents([instance.pk])
+
+
+@receiver(post_delete, sender=Gym)
+def invalidate_deleted_gym_search_results(sender, instance, **kwargs):
+    # The search document goes with the gym through the cascade, without a refresh
+    invalidate_search_cache()
+    update_spatial_engine({instance.pk: None})
+
+
+@receiver(post_save, sender=Location)
+def refresh_location_search_document(sender, instance, **kwargs):
+    gym_ids = list(Gym.objects.filter(location=instance).values_list('pk', flat=True))
+    if gym_ids:
+        refresh_search_documents(gym_ids)
+        _gym_rows_changed(gym_ids)
+
+
+@receiver(post_save, sender=MembershipType)
+@receiver(post_delete, sender=MembershipType)
+def refresh_membership_search_document(sender, instance, **kwargs):
+    refresh_search_documents([instance.gym_id])
+
+
+@receiver(post_save, sender=OperatingHour)
+@receiver(post_delete, sender=OperatingHour)
+def refresh_gym_opening_intervals(sender, instance, **kwargs):
+    refresh_opening_intervals([instance.gym_id])
+
+
+@receiver(m2m_changed, sender=Gym.classes.through)
+@receiver(m2m_changed, sender=Gym.amenities.through)
+def refresh_taxonomy_search_document(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        # The reverse side does not say which gyms a clear affects, so remember them now
+        instance._cleared_gym_ids = list(instance.gym_set.values_list('pk', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if action == 'post_clear' and reverse:
+        gym_ids = getattr(instance, '_cleared_gym_ids', [])
+    else:
+        gym_ids = _m2m_gym_ids(instance, reverse, pk_set)
+    if gym_ids:
+        refresh_search_documents(gym_ids)
+        _gym_rows_changed(gym_ids)
+
+
+# Gym.updated_at: mark every gym whose page shows the changed row. Saving the
+# gym itself moves it through auto_now; location and taxonomy changes are
+# handled by the receivers above.
+
+@receiver(post_save, sender=ContactInfo)
+def bump_contact_info_detail_version(sender, instance, **kwargs):
+    _gym_rows_changed(Gym.objects.filter(contact_info=instance).values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=GymImage)
+@receiver(post_delete, sender=GymImage)
+@receiver(post_save, sender=MembershipType)
+@receiver(post_delete, sender=MembershipType)
+@receiver(post_save, sender=OperatingHour)
+@receiver(post_delete, sender=OperatingHour)
+def bump_gym_row_detail_version(sender, instance, **kwargs):
+    _gym_rows_changed([instance.gym_id])
+
+
+@receiver(post_save, sender=ClassCategory)
+@receiver(post_save, sender=Amenity)
+def bump_taxonomy_label_detail_version(sender, instance, created, **kwargs):
+    if not created:
+        _gym_rows_changed(instance.gym_set.values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=ClassCategory)
+@receiver(post_save, sender=Amenity)
+@receiver(post_delete, sender=ClassCategory)
+@receiver(post_delete, sender=Amenity)
+def invalidate_taxonomy_choices(sender, **kwargs):
+    invalidate_taxonomy(sender)
+    # Again on commit, in case another process reloaded the rows before they were visible
+    transaction.on_commit(lambda: invalidate_taxonomy(sender))
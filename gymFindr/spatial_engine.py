@@ -0,0 +1,257 @@
+"""Optional in-process index of gym coordinates for nearest-gym searches.
+
+When ``SPATIAL_ENGINE_ENABLED`` is set and NumPy is installed, every
+worker keeps the coordinates of all search documents in NumPy arrays,
+sorted by the cell of a ``SPATIAL_ENGINE_CELL_SIZE``-degree grid. Radius
+queries only compute distances for the points of the cells that the circle
+touches. Searches without a radius match every gym, so the engine only
+takes them while the whole index fits in ``SPATIAL_ENGINE_MAX_CANDIDATES``
+and then runs a vectorized haversine over every point. The database is
+then only asked to hydrate the returned ids.
+
+The engine only answers searches it can answer exactly: location-only
+searches (every candidate matches, so no filter can empty a page) whose
+matches fit in ``SPATIAL_ENGINE_MAX_CANDIDATES``. Everything else goes to
+the PostGIS KNN query, so enabling the engine never changes the results.
+
+Every search document refresh (so every Location save) is applied to a
+small overlay as soon as it is committed. The arrays are rebuilt from the database in a background
+thread every ``SPATIAL_ENGINE_REBUILD_INTERVAL`` seconds, which also picks
+up changes made by other processes.
+"""
+import itertools
+import logging
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+from .functions import PairedValue
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - the engine is optional
+    np = None
+
+logger = logging.getLogger(__name__)
+
+SPATIAL_ENGINE_ENABLED = getattr(settings, 'SPATIAL_ENGINE_ENABLED', False)
+SPATIAL_ENGINE_CELL_SIZE = getattr(settings, 'SPATIAL_ENGINE_CELL_SIZE', 0.1)
+SPATIAL_ENGINE_REBUILD_INTERVAL = getattr(settings, 'SPATIAL_ENGINE_REBUILD_INTERVAL', 300)
+# Most gyms the engine hands to the database; larger result sets use PostGIS
+SPATIAL_ENGINE_MAX_CANDIDATES = getattr(settings, 'SPATIAL_ENGINE_MAX_CANDIDATES', 1000)
+
+EARTH_RADIUS_M = 6371008.8
+
+
+def haversine(lat, lng, lats, lngs):
+    """Returns the great-circle distances in meters from one point to arrays of points, all in radians."""
+    a = np.sin((lats - lat) / 2) ** 2 + math.cos(lat) * np.cos(lats) * np.sin((lngs - lng) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class GridIndex:
+    """Immutable arrays of gym ids and coordinates, sorted by grid cell."""
+
+    def __init__(self, ids, lats, lngs, cell_size):
+        self.cell_size = cell_size
+        self.columns = int(math.ceil(360 / cell_size))
+        ids = np.asarray(ids, dtype=np.int64)
+        lats = np.asarray(lats, dtype=np.float64)
+        lngs = np.asarray(lngs, dtype=np.float64)
+        cells = self._cells(lats, lngs)
+        order = np.argsort(cells, kind='stable')
+        self.cells = cells[order]
+        self.ids = ids[order]
+        self.lats = np.radians(lats[order])
+        self.lngs = np.radians(lngs[order])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _cells(self, lats, lngs):
+        rows = np.floor((lats + 90) / self.cell_size).astype(np.int64)
+        columns = np.floor((lngs + 180) / self.cell_size).astype(np.int64) % self.columns
+        return rows * self.columns + columns
+
+    def candidates(self, lat, lng, radius):
+        """Returns the positions of the points in cells touched by a circle, or None for all of them."""
+        lat_span = math.degrees(radius / EARTH_RADIUS_M)
+        south, north = lat - lat_span, lat + lat_span
+        if south <= -90 or north >= 90:
+            return None
+        lng_span = lat_span / math.cos(math.radians(max(abs(south), abs(north))))
+        if lng_span >= 180:
+            return None
+        first_row = int(math.floor((south + 90) / self.cell_size))
+        last_row = int(math.floor((north + 90) / self.cell_size))
+        first_column = int(math.floor((lng - lng_span + 180) / self.cell_size))
+        last_column = int(math.floor((lng + lng_span + 180) / self.cell_size))
+        # Columns past the antimeridian wrap around to the other end of the row
+        if first_column < 0:
+            column_ranges = [(first_column + self.columns, self.columns - 1), (0, last_column)]
+        elif last_column >= self.columns:
+            column_ranges = [(first_column, self.columns - 1), (0, last_column - self.columns)]
+        else:
+            column_ranges = [(first_column, last_column)]
+        slices = []
+        for row in range(first_row, last_row + 1):
+            for start, end in column_ranges:
+                low = np.searchsorted(self.cells, row * self.columns + start, side='left')
+                high = np.searchsorted(self.cells, row * self.columns + end, side='right')
+                if high > low:
+                    slices.append(np.arange(low, high))
+        if not slices:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(slices)
+
+
+class SpatialEngine:
+    """A GridIndex plus the changes committed since it was built."""
+
+    def __init__(self, cell_size=SPATIAL_ENGINE_CELL_SIZE):
+        self.cell_size = cell_size
+        self.index = GridIndex([], [], [], cell_size)
+        # gym id -> (sequence, (lat, lng) or None for removed)
+        self._overlay = {}
+        self._sequence = itertools.count(1)
+        self._lock = threading.Lock()
+        self._rebuilder = None
+
+    def rebuild(self):
+        """Reloads every search document's coordinates from the database."""
+        from .models import GymSearchDocument
+
+        with self._lock:
+            started_at = next(self._sequence)
+        ids, lats, lngs = [], [], []
+        rows = GymSearchDocument.objects.filter(coordinates__isnull=False).values_list('pk', 'coordinates')
+        for pk, point in rows.iterator(chunk_size=5000):
+            ids.append(pk)
+            lats.append(point.y)
+            lngs.append(point.x)
+        index = GridIndex(ids, lats, lngs, self.cell_size)
+        with self._lock:
+            self.index = index
+            # Changes committed before the load started are in the new arrays
+            self._overlay = {
+                gym_id: change for gym_id, change in self._overlay.items() if change[0] > started_at
+            }
+        return len(index)
+
+    def update(self, gym_id, point):
+        """Records a gym's new coordinates, or its removal when ``point`` is None."""
+        with self._lock:
+            location = (point.y, point.x) if point is not None else None
+            self._overlay[gym_id] = (next(self._sequence), location)
+
+    def nearest(self, lat, lng, radius=None, limit=SPATIAL_ENGINE_MAX_CANDIDATES):
+        """Returns ``[(gym_id, meters), ...]`` nearest first, within ``radius`` meters if given."""
+        with self._lock:
+            index, overlay = self.index, dict(self._overlay)
+        lat_r, lng_r = math.radians(lat), math.radians(lng)
+
+        positions = index.candidates(lat, lng, radius) if radius is not None else None
+        if positions is None:
+            ids, distances = index.ids, haversine(lat_r, lng_r, index.lats, index.lngs)
+        else:
+            ids = index.ids[positions]
+            distances = haversine(lat_r, lng_r, index.lats[positions], index.lngs[positions])
+        if overlay:
+            # Overlay entries replace whatever the arrays hold for those gyms
+            keep = ~np.isin(ids, np.fromiter(overlay, dtype=np.int64, count=len(overlay)))
+            ids, distances = ids[keep], distances[keep]
+            moved = [(gym_id, location) for gym_id, (sequence, location) in overlay.items() if location]
+            if moved:
+                moved_ids = np.array([gym_id for gym_id, location in moved], dtype=np.int64)
+                moved_lats = np.radians([location[0] for gym_id, location in moved])
+                moved_lngs = np.radians([location[1] for gym_id, location in moved])
+                ids = np.concatenate([ids, moved_ids])
+                distances = np.concatenate([distances, haversine(lat_r, lng_r, moved_lats, moved_lngs)])
+        if radius is not None:
+            within = distances <= radius
+            ids, distances = ids[within], distances[within]
+        if len(ids) > limit:
+            nearest = np.argpartition(distances, limit - 1)[:limit]
+            ids, distances = ids[nearest], distances[nearest]
+        order = np.lexsort((ids, distances))
+        return [(int(gym_id), float(distance)) for gym_id, distance in zip(ids[order], distances[order])]
+
+    def start_background_rebuild(self, interval=SPATIAL_ENGINE_REBUILD_INTERVAL):
+        if self._rebuilder is not None:
+            return
+        self._rebuilder = threading.Thread(
+            target=self._rebuild_forever, args=(interval,), name='spatial-engine-rebuild', daemon=True,
+        )
+        self._rebuilder.start()
+
+    def _rebuild_forever(self, interval):
+        from django.db import connection
+
+        while True:
+            time.sleep(interval)
+            try:
+                self.rebuild()
+            except Exception:
+                logger.exception('Rebuilding the spatial engine failed')
+            finally:
+                connection.close()
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_spatial_engine():
+    """Returns this process's SpatialEngine, or None when it is disabled or NumPy is missing.
+
+    The first call loads the index and starts the background rebuilds.
+    """
+    global _engine
+    if not SPATIAL_ENGINE_ENABLED or np is None:
+        return None
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                engine = SpatialEngine()
+                engine.rebuild()
+                engine.start_background_rebuild()
+                _engine = engine
+    return _engine
+
+
+def update_spatial_engine(points):
+    """Applies ``{gym_id: point or None}`` to this process's engine once the transaction commits."""
+    engine = _engine
+    if engine is None or not points:
+        return
+
+    def apply():
+        for gym_id, point in points.items():
+            engine.update(gym_id, point)
+
+    transaction.on_commit(apply)
+
+
+def engine_nearest_gyms(queryset, engine, point, max_distance=None):
+    """``nearest_gyms`` answered by the engine: the database only hydrates ids.
+
+    ``distance`` is annotated from the engine's haversine distances (meters),
+    so ordering and keyset cursors work as with the KNN operator. Returns
+    None when more than ``SPATIAL_ENGINE_MAX_CANDIDATES`` gyms match, since
+    the engine's answer would then be cut short.
+    """
+    radius = max_distance * 1000 if max_distance else None
+    if radius is None and len(engine.index) > SPATIAL_ENGINE_MAX_CANDIDATES:
+        # Every gym matches, so scanning them all would only find that out
+        return None
+    nearest = engine.nearest(point.y, point.x, radius, limit=SPATIAL_ENGINE_MAX_CANDIDATES + 1)
+    if len(nearest) > SPATIAL_ENGINE_MAX_CANDIDATES:
+        return None
+    if not nearest:
+        return queryset.none()
+    gym_ids = [gym_id for gym_id, meters in nearest]
+    distance = PairedValue('pk', gym_ids, [meters for gym_id, meters in nearest])
+    return queryset.filter(pk__in=gym_ids).annotate(distance=distance).order_by('distance', 'pk')
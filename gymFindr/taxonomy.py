@@ -0,0 +1,55 @@
+"""Process-level cache of the ClassCategory and Amenity rows.
+
+Both tables hold one row per hard-coded choice and almost never change,
+yet GymForm and GymSearchForm list and validate them on every request.
+Each process keeps the rows in memory for ``TAXONOMY_CACHE_TIMEOUT``
+seconds. Saves and deletes drop the copy of the process that made them
+(see gymFindr.signals) and replace the ``taxonomy:<model>`` version token,
+which also reaches other processes when the default cache is shared. With
+a per-process default cache, other processes pick the change up within
+the timeout; until then a form that is sent a pk missing from the copy
+reloads it once before rejecting the choice (see
+gymFindr.forms.TaxonomyMultipleChoiceField).
+"""
+import threading
+import time
+
+from django.conf import settings
+
+from .caching import bump_version, get_version
+
+TAXONOMY_CACHE_TIMEOUT = getattr(settings, 'TAXONOMY_CACHE_TIMEOUT', 300)
+
+# model -> (version, loaded at, rows)
+_rows = {}
+_lock = threading.Lock()
+
+
+def _version_name(model):
+    return f'taxonomy:{model._meta.model_name}'
+
+
+def _is_current(cached, version):
+    return cached is not None and cached[0] == version and time.monotonic() - cached[1] < TAXONOMY_CACHE_TIMEOUT
+
+
+def taxonomy_objects(model, refresh=False):
+    """Returns the rows of ClassCategory or Amenity as a tuple, ordered by pk.
+
+    ``refresh`` reloads them from the database first.
+    """
+    version = get_version(_version_name(model))
+    cached = _rows.get(model)
+    if refresh or not _is_current(cached, version):
+        with _lock:
+            cached = _rows.get(model)
+            if refresh or not _is_current(cached, version):
+                cached = (version, time.monotonic(), tuple(model._default_manager.order_by('pk')))
+                _rows[model] = cached
+    return cached[2]
+
+
+def invalidate_taxonomy(model):
+    """Makes this process, and those sharing the default cache, reload ``model``'s rows on their next read."""
+    bump_version(_version_name(model))
+    _rows.pop(model, None)
@@ -1,3 +1,1136 @@
-from django.test import TestCase
+import base64
+import io
+import json
+import os
+import tempfile
+import unittest
+import unittest.mock
+from datetime import time, timedelta
+from decimal import Decimal
 
-# Create your tests here.
+import requests
+from django.contrib.gis.geos import Point
+from django.core.cache import caches
+from django.db import connection
+from django.db.backends.postgresql.psycopg_any import NumericRange
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .detail_cache import DETAIL_CACHE_ALIAS
+from .exporting import export_queryset, gym_record
+from .favorites import add_favorite, reconcile_favorite_counts
+from .forms import GymSearchForm
+from .geocoders import ChainGeocoder, GazetteerGeocoder, GeocodingError, GoogleGeocoder
+from .geocoding import (
+    GEOCODE_CACHE_TTL, GeocodeLRUCache, claim_geocode_tasks, lookup_address, memory_cache, run_geocode_tasks, stats,
+)
+from .importing import ImportRowError, import_gyms, iter_json_values, parse_record
+from .markers import InvalidBBox, parse_bbox
+from .opening_hours import MINUTES_PER_WEEK, week_intervals
+from .pagination import (
+    InvalidCursor, decode_cursor, encode_cursor, estimate_count, keyset_filter, paginate_keyset, row_key,
+)
+from .search import GymSearch
+from .search_cache import SEARCH_CACHE_ALIAS, catalog_version, get_cached_page, search_cache_key
+from .search_index import deferred_search_refresh, refresh_search_documents
+from .taxonomy import taxonomy_objects
+from .views import GymSearchView
+from .spatial_engine import SPATIAL_ENGINE_MAX_CANDIDATES, GridIndex, SpatialEngine, engine_nearest_gyms, np
+from .models import (
+    Amenity, ClassCategory, ContactInfo, CustomUser, Favorite, GeocodedAddress, GeocodeTask, Gym, GymImage,
+    GymSearchDocument, ImportCheckpoint, Location, MembershipType, OpeningInterval, OperatingHour,
+)
+
+
+def create_gym(owner, name='Iron Temple'):
+    location = Location.objects.create(
+        street_address1='1 Main St', city='Brooklyn', zip_code='11201', country='US',
+        coordinates=Point(-73.99, 40.69, srid=4326),
+    )
+    contact_info = ContactInfo.objects.create(email='front@example.com', phone='555-0100')
+    return Gym.objects.create(
+        owner=owner, name=name, description='Free weights and classes.',
+        location=location, contact_info=contact_info,
+    )
+
+
+def add_related_rows(gym, index):
+    """Adds one row of every relation gym_detail.html renders."""
+    GymImage.objects.create(gym=gym, image=f'gym_images/{gym.pk}-{index}.jpg')
+    MembershipType.objects.create(
+        gym=gym, type=MembershipType.MEMBERSHIP_CHOICES[index][0], price=Decimal('10.00') * (index + 1),
+    )
+    OperatingHour.objects.create(
+        gym=gym, day=OperatingHour.DAY_CHOICES[index][0], open_time=time(6), close_time=time(22),
+    )
+    gym.classes.add(ClassCategory.objects.get_or_create(name=ClassCategory.CATEGORY_CHOICES[index][0])[0])
+    gym.amenities.add(Amenity.objects.get_or_create(name=Amenity.AMENITY_CHOICES[index][0])[0])
+
+
+class GymDetailViewQueryTests(TestCase):
+    # Gym.updated_at for the ETag, the gym with location/contact_info/owner,
+    # then one query per prefetched relation
+    QUERY_BUDGET = 7
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = CustomUser.objects.create_user('owner@example.com', 'Gym', 'Owner', password='secret')
+        cls.gym = create_gym(cls.owner)
+        add_related_rows(cls.gym, 0)
+
+    def setUp(self):
+        caches[DETAIL_CACHE_ALIAS].clear()
+
+    def test_detail_query_budget(self):
+        url = reverse('gymFindr:gym_detail', kwargs={'pk': self.gym.pk})
+        with self.assertNumQueries(self.QUERY_BUDGET):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_detail_query_budget_does_not_grow_with_related_rows(self):
+        for index in range(1, 5):
+            add_related_rows(self.gym, index)
+        url = reverse('gymFindr:gym_detail', kwargs={'pk': self.gym.pk})
+        with self.assertNumQueries(self.QUERY_BUDGET):
+            response = self.client.get(url)
+        self.assertContains(response, 'Annual Membership')
+
+    def test_operating_hours_are_listed_monday_first(self):
+        OperatingHour.objects.create(gym=self.gym, day='SUN', open_time=time(8), close_time=time(18))
+        OperatingHour.objects.create(gym=self.gym, day='FRI', open_time=time(6), close_time=time(22))
+        response = self.client.get(reverse('gymFindr:gym_detail', kwargs={'pk': self.gym.pk}))
+        days = [hour.day for hour in response.context['gym'].operating_hours.all()]
+        self.assertEqual(days, ['MON', 'FRI', 'SUN'])
+
+
+class GymDetailCacheTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = CustomUser.objects.create_user('owner@example.com', 'Gym', 'Owner', password='secret')
+        cls.gym = create_gym(cls.owner)
+        cls.url = reverse('gymFindr:gym_detail', kwargs={'pk': cls.gym.pk})
+
+    def setUp(self):
+        caches[DETAIL_CACHE_ALIAS].clear()
+
+    def test_cached_page_only_reads_last_modified(self):
+        self.client.get(self.url)
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url)
+        self.assertContains(response, 'Iron Temple')
+
+    def test_related_row_change_invalidates_cached_page(self):
+        self.client.get(self.url)
+        with self.captureOnCommitCallbacks(execute=True):
+            MembershipType.objects.create(gym=self.gym, type='DAY_PASS', price=Decimal('15.00'))
+        self.assertContains(self.client.get(self.url), 'Day Pass')
+
+    def test_owner_block_is_rendered_per_user(self):
+        self.client.get(self.url)
+        self.assertNotContains(self.client.get(self.url), 'Edit Gym')
+        self.client.force_login(self.owner)
+        self.assertContains(self.client.get(self.url), 'Edit Gym')
+
+
+class ConditionalRequestTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = CustomUser.objects.create_user('owner@example.com', 'Gym', 'Owner', password='secret')
+        cls.gym = create_gym(cls.owner)
+        cls.url = reverse('gymFindr:gym_detail', kwargs={'pk': cls.gym.pk})
+
+    def setUp(self):
+        caches[DETAIL_CACHE_ALIAS].clear()
+
+    def test_matching_etag_is_answered_without_loading_the_gym(self):
+        etag = self.client.get(self.url)['ETag']
+        # Only Gym.updated_at
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_detail_page_ignores_if_modified_since(self):
+        response = self.client.get(self.url)
+        self.assertFalse(response.has_header('Last-Modified'))
+        self.client.force_login(self.owner)
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT')
+        self.assertContains(response, 'Edit Gym')
+
+    def test_related_row_change_gets_a_new_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        MembershipType.objects.create(gym=self.gym, type='DAY_PASS', price=Decimal('15.00'))
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, 'Day Pass')
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_catalog_if_modified_since_is_answered_from_the_version_row(self):
+        url = reverse('gymFindr:gym_list')
+        last_modified = self.client.get(url)['Last-Modified']
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+    def test_catalog_write_gets_a_new_etag(self):
+        url = reverse('gymFindr:gym_list')
+        etag = self.client.get(url)['ETag']
+        self.gym.name = 'Pump Room'
+        self.gym.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, 'Pump Room')
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_signed_in_catalog_has_no_last_modified(self):
+        self.client.force_login(self.owner)
+        response = self.client.get(reverse('gymFindr:gym_list'))
+        self.assertTrue(response.has_header('ETag'))
+        self.assertFalse(response.has_header('Last-Modified'))
+
+    def test_search_has_no_etag_while_geocoding_fails(self):
+        url = reverse('gymFindr:gym_search')
+        with unittest.mock.patch('gymFindr.search.lookup_address', side_effect=GeocodingError('timeout')) as lookup:
+            response = self.client.get(url, {'search_location': 'Brooklyn'})
+        self.assertFalse(response.has_header('ETag'))
+        lookup.assert_called_once()
+
+        with unittest.mock.patch('gymFindr.search.lookup_address', return_value=(40.69, -73.99)) as lookup:
+            response = self.client.get(url, {'search_location': 'Brooklyn'})
+        self.assertTrue(response.has_header('ETag'))
+        self.assertContains(response, 'Iron Temple')
+        lookup.assert_called_once()
+
+
+class GymCreateViewQueryTests(TestCase):
+    # Session and user, the test case's savepoint pair, the location with its
+    # search-refresh lookup and geocode task, the contact info with its
+    # Gym.touch lookup, the gym, one bulk insert per inline table, the
+    # opening intervals rebuild (6) and the single search document refresh (6),
+    # each bumping the catalog version
+    QUERY_BUDGET = 24
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = CustomUser.objects.create_user('owner@example.com', 'Gym', 'Owner', password='secret')
+
+    def setUp(self):
+        self.client.force_login(self.owner)
+
+    def post_data(self, memberships=1):
+        data = {
+            'name': 'Iron Temple', 'description': 'Free weights and classes.',
+            'location-street_address1': '1 Main St', 'location-city': 'Brooklyn',
+            'location-zip_code': '11201', 'location-country': 'US',
+            'contact_info-email': 'front@example.com', 'contact_info-phone': '555-0100',
+            'images-TOTAL_FORMS': 0, 'images-INITIAL_FORMS': 0,
+            'memberships-TOTAL_FORMS': memberships, 'memberships-INITIAL_FORMS': 0,
+            'operating_hours-TOTAL_FORMS': 1, 'operating_hours-INITIAL_FORMS': 0,
+            'operating_hours-0-day': 'MON', 'operating_hours-0-open_time': '06:00',
+            'operating_hours-0-close_time': '22:00',
+        }
+        for index in range(memberships):
+            data[f'memberships-{index}-type'] = MembershipType.MEMBERSHIP_CHOICES[index][0]
+            data[f'memberships-{index}-price'] = '10.00'
+        return data
+
+    def test_create_query_budget(self):
+        with self.assertNumQueries(self.QUERY_BUDGET):
+            response = self.client.post(reverse('gymFindr:gym_create'), self.post_data())
+        self.assertEqual(response.status_code, 302)
+        gym = Gym.objects.get(name='Iron Temple')
+        self.assertEqual(gym.owner, self.owner)
+        self.assertEqual(gym.search_document.min_price, Decimal('10.00'))
+        self.assertTrue(gym.opening_intervals.exists())
+
+    def test_create_query_budget_does_not_grow_with_inline_rows(self):
+        with self.assertNumQueries(self.QUERY_BUDGET):
+            self.client.post(reverse('gymFindr:gym_create'), self.post_data(memberships=5))
+        self.assertEqual(MembershipType.objects.filter(gym__name='Iron Temple').count(), 5)
+
+
+class GymUpdateViewQueryTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = CustomUser.objects.create_user('owner@example.com', 'Gym', 'Owner', password='secret')
+
+    def setUp(self):
+        self.client.force_login(self.owner)
+        # Both requests should find the taxonomy rows already loaded
+        taxonomy_objects(ClassCategory)
+        taxonomy_objects(Amenity)
+
+    def create_gym_with_rows(self, name, rows):
+        gym = create_gym(self.owner, name=name)
+        for index in range(rows):
+            MembershipType.objects.create(
+                gym=gym, type=MembershipType.MEMBERSHIP_CHOICES[index][0], price=Decimal('10.00'),
+            )
+            OperatingHour.objects.create(
+                gym=gym, day=OperatingHour.DAY_CHOICES[index][0], open_time=time(6), close_time=time(22),
+            )
+        return gym
+
+    def post_data(self, gym):
+        """Returns the edit form's data with every membership price and closing time changed."""
+        location, contact_info = gym.location, gym.contact_info
+        memberships = list(gym.membership_types.order_by('pk'))
+        hours = list(gym.operating_hours.order_by('pk'))
+        data = {
+            'name': gym.name, 'description': gym.description,
+            'location-street_address1': location.street_address1, 'location-city': location.city,
+            'location-zip_code': location.zip_code, 'location-country': location.country,
+            'contact_info-email': contact_info.email, 'contact_info-phone': contact_info.phone,
+            'images-TOTAL_FORMS': 0, 'images-INITIAL_FORMS': 0,
+            'memberships-TOTAL_FORMS': len(memberships), 'memberships-INITIAL_FORMS': len(memberships),
+            'operating_hours-TOTAL_FORMS': len(hours), 'operating_hours-INITIAL_FORMS': len(hours),
+        }
+        for index, membership in enumerate(memberships):
+            data[f'memberships-{index}-id'] = membership.pk
+            data[f'memberships-{index}-type'] = membership.type
+            data[f'memberships-{index}-price'] = '12.50'
+        for index, hour in enumerate(hours):
+            data[f'operating_hours-{index}-id'] = hour.pk
+            data[f'operating_hours-{index}-day'] = hour.day
+            data[f'operating_hours-{index}-open_time'] = '06:00'
+            data[f'operating_hours-{index}-close_time'] = '23:00'
+        return data
+
+    def post_queries(self, gym):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('gymFindr:gym_edit', kwargs={'pk': gym.pk}), self.post_data(gym))
+        self.assertEqual(response.status_code, 302)
+        return len(queries)
+
+    def test_update_query_budget_does_not_grow_with_edited_rows(self):
+        small = self.create_gym_with_rows('Small Gym', 1)
+        large = self.create_gym_with_rows('Large Gym', 5)
+        self.assertEqual(self.post_queries(large), self.post_queries(small))
+        self.assertEqual(set(large.membership_types.values_list('price', flat=True)), {Decimal('12.50')})
+        self.assertEqual(set(large.operating_hours.values_list('close_time', flat=True)), {time(23)})
+        self.assertEqual(
+            [interval.minutes.upper for interval in large.opening_intervals.order_by('minutes')][-1],
+            4 * 1440 + 23 * 60,
+        )
+        self.assertEqual(large.search_document.min_price, Decimal('12.50'))
+
+
+class TaxonomyChoicesTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.yoga = ClassCategory.objects.create(name='YOGA')
+        cls.sauna = Amenity.objects.create(name='SAUNA')
+
+    def test_search_form_runs_no_queries_once_cached(self):
+        str(GymSearchForm())
+        with self.assertNumQueries(0):
+            form = GymSearchForm(data={'class_category': [self.yoga.pk], 'amenity': [self.sauna.pk]})
+            self.assertTrue(form.is_valid())
+            self.assertIn('SAUNA', str(form))
+        self.assertEqual(form.cleaned_data['class_category'], [self.yoga])
+
+    def test_new_row_is_a_valid_choice(self):
+        str(GymSearchForm())
+        pool = Amenity.objects.create(name='POOL')
+        self.assertTrue(GymSearchForm(data={'amenity': [pool.pk]}).is_valid())
+        self.assertFalse(GymSearchForm(data={'amenity': [pool.pk + 1]}).is_valid())
+
+    def test_row_added_by_another_process_is_a_valid_choice(self):
+        str(GymSearchForm())
+        # bulk_create sends no signals, like a write made by another worker
+        pool, = Amenity.objects.bulk_create([Amenity(name='POOL')])
+        self.assertTrue(GymSearchForm(data={'amenity': [pool.pk]}).is_valid())
+
+
+class FavoriteTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = CustomUser.objects.create_user('owner@example.com', 'Gym', 'Owner', password='secret')
+        cls.gym = create_gym(cls.owner)
+
+    def setUp(self):
+        self.client.force_login(self.owner)
+
+    def test_favorite_and_unfavorite_are_idempotent(self):
+        url = reverse('gymFindr:gym_favorite', kwargs={'pk': self.gym.pk})
+        for attempt in range(2):
+            response = self.client.post(url, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.json(), {'gym': self.gym.pk, 'favorited': True, 'favorite_count': 1})
+        self.assertEqual(Favorite.objects.filter(gym=self.gym).count(), 1)
+        url = reverse('gymFindr:gym_unfavorite', kwargs={'pk': self.gym.pk})
+        for attempt in range(2):
+            response = self.client.post(url)
+        self.assertRedirects(response, reverse('gymFindr:gym_detail', kwargs={'pk': self.gym.pk}))
+        self.gym.refresh_from_db()
+        self.assertEqual(self.gym.favorite_count, 0)
+
+    def test_list_shows_favorited_state(self):
+        add_favorite(self.owner, self.gym.pk)
+        response = self.client.get(reverse('gymFindr:gym_list'))
+        self.assertTrue(response.context['gyms'][0].is_favorite)
+        self.assertContains(response, 'Favorited')
+
+    def test_reconcile_fixes_drifted_counts(self):
+        Favorite.objects.create(user=self.owner, gym=self.gym)
+        self.assertEqual(reconcile_favorite_counts(), 1)
+        self.gym.refresh_from_db()
+        self.assertEqual(self.gym.favorite_count, 1)
+        self.assertEqual(reconcile_favorite_counts(), 0)
+
+
+@unittest.skipIf(np is None, 'NumPy is not installed')
+class SpatialEngineTests(SimpleTestCase):
+
+    def setUp(self):
+        self.engine = SpatialEngine(cell_size=0.1)
+        # Brooklyn, Manhattan, Newark, and a gym across the antimeridian from Fiji
+        self.engine.index = GridIndex(
+            [1, 2, 3, 4], [40.69, 40.75, 40.73, -17.8], [-73.99, -73.99, -74.17, -179.9], 0.1,
+        )
+
+    def test_nearest_orders_by_distance(self):
+        self.assertEqual([gym_id for gym_id, meters in self.engine.nearest(40.70, -73.99)], [1, 2, 3, 4])
+
+    def test_radius_limits_results(self):
+        nearest = self.engine.nearest(40.70, -73.99, radius=7000)
+        self.assertEqual([gym_id for gym_id, meters in nearest], [1, 2])
+        self.assertAlmostEqual(nearest[0][1], 1112, delta=5)
+
+    def test_radius_crosses_antimeridian(self):
+        self.assertEqual(self.engine.nearest(-17.8, 179.95, radius=20000), [(4, unittest.mock.ANY)])
+
+    def test_cut_short_answers_are_left_to_the_database(self):
+        engine = unittest.mock.Mock(index=range(SPATIAL_ENGINE_MAX_CANDIDATES))
+        engine.nearest.return_value = [(gym_id, 1.0) for gym_id in range(SPATIAL_ENGINE_MAX_CANDIDATES + 1)]
+        self.assertIsNone(engine_nearest_gyms(None, engine, Point(-73.99, 40.70, srid=4326)))
+
+    def test_unbounded_search_over_a_large_index_skips_the_scan(self):
+        engine = unittest.mock.Mock(index=range(SPATIAL_ENGINE_MAX_CANDIDATES + 1))
+        self.assertIsNone(engine_nearest_gyms(None, engine, Point(-73.99, 40.70, srid=4326)))
+        engine.nearest.assert_not_called()
+
+    def test_overlay_moves_and_removes_gyms(self):
+        self.engine.update(3, Point(-73.99, 40.70, srid=4326))
+        self.engine.update(1, None)
+        self.assertEqual([gym_id for gym_id, meters in self.engine.nearest(40.70, -73.99, radius=7000)], [3, 2])
+
+
+class GeocodeWorkerTests(TestCase):
+
+    def create_task(self, street_address, run_after):
+        location = Location(street_address1=street_address, city='Brooklyn', zip_code='11201', country='US')
+        location.mark_for_geocoding()
+        location.save()
+        return GeocodeTask.objects.create(location=location, run_after=run_after)
+
+    def test_failing_task_is_retried_and_the_batch_goes_on(self):
+        now = timezone.now()
+        broken = self.create_task('1 Main St', now - timedelta(minutes=2))
+        working = self.create_task('2 Main St', now - timedelta(minutes=1))
+        with unittest.mock.patch(
+            'gymFindr.geocoding.geocode_location', side_effect=[RuntimeError('bad row'), (40.69, -73.99)],
+        ):
+            self.assertEqual(run_geocode_tasks(), 2)
+
+        broken.refresh_from_db()
+        self.assertEqual(broken.attempts, 1)
+        self.assertEqual(broken.last_error, 'bad row')
+        self.assertGreater(broken.run_after, now)
+        self.assertFalse(GeocodeTask.objects.filter(pk=working.pk).exists())
+        working.location.refresh_from_db()
+        self.assertEqual(working.location.geocode_status, Location.GEOCODE_DONE)
+
+    def test_detail_page_shows_whether_the_map_is_pending_or_failed(self):
+        gym = create_gym(CustomUser.objects.create_user('owner@example.com', 'Gym', 'Owner', password='secret'))
+        url = reverse('gymFindr:gym_detail', kwargs={'pk': gym.pk})
+        location = gym.location
+        location.coordinates, location.geocode_status = None, Location.GEOCODE_PENDING
+        location.save(update_fields=['coordinates', 'geocode_status'])
+        self.assertContains(self.client.get(url), 'Map location is being determined.')
+
+        # As the worker leaves a location no lookup could find
+        location.geocode_status = Location.GEOCODE_FAILED
+        location.save(update_fields=['coordinates', 'geocode_status'])
+        response = self.client.get(url)
+        self.assertContains(response, 'This address could not be found on the map.')
+        self.assertNotContains(response, 'being determined')
+
+    def test_claimed_tasks_are_skipped_by_other_workers(self):
+        self.create_task('1 Main St', timezone.now() - timedelta(minutes=1))
+        self.assertEqual(len(claim_geocode_tasks()), 1)
+        self.assertEqual(claim_geocode_tasks(), [])
+
+
+def google_response(data=None, status_code=200, json_error=None):
+    """A stand-in for the requests.Response of a Geocoding API call."""
+    response = unittest.mock.Mock(status_code=status_code)
+    response.json.side_effect = json_error
+    response.json.return_value = data
+    return response
+
+
+def google_result(lat, lng):
+    return {'status': 'OK', 'results': [{'geometry': {'location': {'lat': lat, 'lng': lng}}}]}
+
+
+class GoogleGeocoderTests(SimpleTestCase):
+
+    def setUp(self):
+        self.geocoder = GoogleGeocoder(api_key='test-key')
+        self.geocoder.session = unittest.mock.Mock()
+
+    def geocode(self, response):
+        self.geocoder.session.get.return_value = response
+        return self.geocoder.geocode('1 Main St, Brooklyn')
+
+    def test_match_and_no_match(self):
+        self.assertEqual(self.geocode(google_response(google_result('40.69', -73.99))), (40.69, -73.99))
+        self.assertIsNone(self.geocode(google_response({'status': 'ZERO_RESULTS', 'results': []})))
+
+    def test_failures_raise_geocoding_error(self):
+        responses = {
+            'http error': google_response(status_code=503),
+            'not json': google_response(json_error=ValueError('Expecting value')),
+            'not an object': google_response(['OK']),
+            'results not a list': google_response({'status': 'OK', 'results': 'none'}),
+            'no geometry': google_response({'status': 'OK', 'results': [{}]}),
+            'bad coordinates': google_response(google_result('north', None)),
+            'over quota': google_response({'status': 'OVER_QUERY_LIMIT', 'results': []}),
+            'denied': google_response({'status': 'REQUEST_DENIED'}),
+        }
+        for name, response in responses.items():
+            with self.subTest(name):
+                with self.assertRaises(GeocodingError):
+                    self.geocode(response)
+
+    def test_network_errors_raise_geocoding_error(self):
+        self.geocoder.session.get.side_effect = requests.ConnectionError('connection refused')
+        with self.assertRaises(GeocodingError):
+            self.geocoder.geocode('1 Main St, Brooklyn')
+
+
+class GeocodeLRUCacheTests(SimpleTestCase):
+
+    def test_entries_expire_after_their_ttl(self):
+        cache = GeocodeLRUCache(max_entries=10, ttl=60, negative_ttl=10)
+        with unittest.mock.patch('gymFindr.geocoding.time.monotonic', return_value=1000):
+            cache.set('brooklyn', (40.69, -73.99))
+            cache.set('nowhere', None)
+        with unittest.mock.patch('gymFindr.geocoding.time.monotonic', return_value=1030):
+            self.assertEqual(cache.get('brooklyn'), (True, (40.69, -73.99)))
+            self.assertEqual(cache.get('nowhere'), (False, None))
+        with unittest.mock.patch('gymFindr.geocoding.time.monotonic', return_value=1060):
+            self.assertEqual(cache.get('brooklyn'), (False, None))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = GeocodeLRUCache(max_entries=2, ttl=60, negative_ttl=10)
+        cache.set('a', (1, 1))
+        cache.set('b', (2, 2))
+        cache.get('a')
+        cache.set('c', (3, 3))
+        self.assertEqual([cache.get(key)[0] for key in 'abc'], [True, False, True])
+
+
+class LookupAddressTests(TestCase):
+    ADDRESS = '1 Main St, Brooklyn, 11201, US'
+
+    def setUp(self):
+        memory_cache.clear()
+        stats.reset()
+        self.addCleanup(memory_cache.clear)
+        self.google = GoogleGeocoder(api_key='test-key')
+        self.google.session = unittest.mock.Mock()
+        self.google.session.get.return_value = google_response(google_result(40.69, -73.99))
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as fp:
+            fp.write('name,region,country,latitude,longitude,population\nBrooklyn,NY,US,40.65,-73.95,2600000\n')
+        self.addCleanup(lambda: os.remove(fp.name))
+        geocoder = ChainGeocoder([GazetteerGeocoder(fp.name), self.google])
+        patcher = unittest.mock.patch('gymFindr.geocoding.get_geocoder', return_value=geocoder)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_memory_then_database_then_network(self):
+        self.assertEqual(lookup_address(self.ADDRESS), (40.69, -73.99))
+        self.assertEqual(lookup_address(self.ADDRESS), (40.69, -73.99))
+        memory_cache.clear()
+        self.assertEqual(lookup_address(self.ADDRESS), (40.69, -73.99))
+        self.assertEqual(self.google.session.get.call_count, 1)
+        self.assertEqual((stats.misses, stats.memory_hits, stats.db_hits), (1, 1, 1))
+
+    def test_expired_database_entries_are_looked_up_again(self):
+        lookup_address(self.ADDRESS)
+        memory_cache.clear()
+        GeocodedAddress.objects.update(updated_at=timezone.now() - timedelta(seconds=GEOCODE_CACHE_TTL + 1))
+        lookup_address(self.ADDRESS)
+        self.assertEqual(self.google.session.get.call_count, 2)
+
+    def test_failed_lookups_are_not_cached(self):
+        self.google.session.get.side_effect = requests.Timeout('read timed out')
+        for attempt in range(2):
+            with self.assertRaises(GeocodingError):
+                lookup_address(self.ADDRESS)
+        self.assertEqual(self.google.session.get.call_count, 2)
+        self.assertEqual(len(memory_cache), 0)
+        self.assertFalse(GeocodedAddress.objects.exists())
+
+    def test_gazetteer_answers_without_a_network_call(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(lookup_address('Brooklyn, NY'), (40.65, -73.95))
+        self.google.session.get.assert_not_called()
+        self.assertEqual(stats.local_hits, 1)
+
+
+class WeekIntervalsTests(SimpleTestCase):
+
+    def hours(self, *rows):
+        return [OperatingHour(day=day, open_time=opens, close_time=closes) for day, opens, closes in rows]
+
+    def test_hours_past_midnight_run_into_the_next_day(self):
+        self.assertEqual(week_intervals(self.hours(('MON', time(22), time(2)))), [(22 * 60, 26 * 60)])
+
+    def test_sunday_night_is_split_at_the_end_of_the_week(self):
+        self.assertEqual(
+            week_intervals(self.hours(('SUN', time(22), time(2)))),
+            [(0, 2 * 60), (MINUTES_PER_WEEK - 2 * 60, MINUTES_PER_WEEK)],
+        )
+
+    def test_equal_open_and_close_times_mean_open_all_day(self):
+        self.assertEqual(week_intervals(self.hours(('TUE', time(0), time(0)))), [(1440, 2 * 1440)])
+
+    def test_touching_and_overlapping_ranges_are_merged(self):
+        hours = self.hours(('MON', time(12), time(18)), ('MON', time(6), time(12)), ('MON', time(17), time(23)))
+        self.assertEqual(week_intervals(hours), [(6 * 60, 23 * 60)])
+
+
+class OpeningIntervalSignalTests(TestCase):
+
+    def setUp(self):
+        self.gym = create_gym(CustomUser.objects.create_user('owner@example.com', 'Gym', 'Owner', password='secret'))
+
+    def test_hours_saved_or_deleted_outside_the_forms_rebuild_the_intervals(self):
+        hour = OperatingHour.objects.create(gym=self.gym, day='MON', open_time=time(6), close_time=time(22))
+        self.assertEqual(
+            [interval.minutes for interval in OpeningInterval.objects.filter(gym=self.gym)],
+            [NumericRange(6 * 60, 22 * 60)],
+        )
+        hour.delete()
+        self.assertFalse(OpeningInterval.objects.filter(gym=self.gym).exists())
+
+    def test_deferred_block_rebuilds_once(self):
+        with unittest.mock.patch('gymFindr.search_index.rebuild_opening_intervals') as rebuild:
+            with deferred_search_refresh():
+                for day in ('MON', 'TUE', 'WED'):
+                    OperatingHour.objects.create(gym=self.gym, day=day, open_time=time(6), close_time=time(22))
+        rebuild.assert_called_once_with({self.gym.pk})
+
+
+class GymMarkersViewTests(TestCase):
+
+    def test_non_finite_zoom_is_rejected(self):
+        for zoom in ('inf', '-inf', '1e400', 'nan'):
+            with self.subTest(zoom=zoom):
+                response = self.client.get(
+                    reverse('gymFindr:gym_markers'), {'bbox': '-74.1,40.6,-73.9,40.8', 'zoom': zoom},
+                )
+                self.assertEqual(response.status_code, 400)
+
+
+class IterJsonValuesTests(SimpleTestCase):
+
+    def values(self, text, **kwargs):
+        return list(iter_json_values(io.StringIO(text), **kwargs))
+
+    def test_values_split_across_chunks(self):
+        text = '[{"name": "Iron Temple", "tags": ["a", "b"]}, {"name": "Pump, Inc."}, 12345, "x", true]'
+        for chunk_size in (1, 4, 7, 64):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(
+                    self.values(text, chunk_size=chunk_size),
+                    [{'name': 'Iron Temple', 'tags': ['a', 'b']}, {'name': 'Pump, Inc.'}, 12345, 'x', True],
+                )
+
+    def test_json_lines(self):
+        text = '{"name": "One"}\n{"name": "Two"}\n\n{"name": "Three"}\n'
+        self.assertEqual([value['name'] for value in self.values(text, chunk_size=5)], ['One', 'Two', 'Three'])
+
+    def test_array_found_by_start_pattern(self):
+        text = '{"type": "FeatureCollection", "features": [{"id": 1}, {"id": 2}]}'
+        self.assertEqual(self.values(text, start=r'"features"\s*:\s*\[', chunk_size=6), [{'id': 1}, {'id': 2}])
+
+    def test_truncated_value_raises(self):
+        with self.assertRaises(json.JSONDecodeError):
+            self.values('[{"name": "One"}, {"name": "Tw', chunk_size=8)
+
+    def test_unclosed_array_raises(self):
+        with self.assertRaisesMessage(ImportRowError, 'not closed'):
+            self.values('[{"name": "One"}, ', chunk_size=8)
+
+    def test_missing_array_raises(self):
+        with self.assertRaisesMessage(ImportRowError, 'no array'):
+            self.values('{"type": "FeatureCollection"}', start=r'"features"\s*:\s*\[', chunk_size=8)
+
+    def test_syntax_error_is_raised_without_reading_the_rest(self):
+        fp = io.StringIO('{"name": "One"}\n{"name": "Two",, "city": "x"}\n' + '{"name": "More"}\n' * 1000)
+        with self.assertRaises(json.JSONDecodeError):
+            list(iter_json_values(fp, chunk_size=16))
+        self.assertLess(fp.tell(), 100)
+
+
+class ParseRecordTests(SimpleTestCase):
+    VALID = {
+        'name': 'Iron Temple', 'street_address1': '1 Main St', 'city': 'Brooklyn', 'zip_code': '11201',
+        'country': 'US', 'email': 'front@example.com',
+    }
+
+    def test_valid_record(self):
+        record = dict(
+            self.VALID, memberships=[{'type': 'month', 'price': '49.999'}], hours='MON 06:00-22:00',
+            classes=['yoga'], latitude='40.69', longitude='-73.99',
+        )
+        parsed = parse_record(record)
+        self.assertEqual(parsed['memberships'], [('MONTH', Decimal('50.00'))])
+        self.assertEqual(parsed['hours'], [('MON', time(6), time(22))])
+        self.assertEqual(parsed['classes'], ['YOGA'])
+        self.assertEqual(parsed['coordinates'].coords, (-73.99, 40.69))
+
+    def test_malformed_values_are_row_errors(self):
+        for name, value in [
+            ('memberships', [{'type': 'MONTH', 'price': 'NaN'}]),
+            ('memberships', [{'type': 'MONTH', 'price': 'Infinity'}]),
+            ('memberships', 'MONTH:-5'),
+            ('memberships', ['MONTH']),
+            ('memberships', 5),
+            ('hours', [['MON', '06:00', '22:00']]),
+            ('hours', {'day': 'MON'}),
+            ('hours', 'MON 6am-10pm'),
+            ('classes', 3),
+            ('amenities', True),
+            ('classes', 'YOGA;UNDERWATER_CHESS'),
+            ('latitude', [40.69]),
+        ]:
+            with self.subTest(name=name, value=value):
+                with self.assertRaises(ImportRowError):
+                    parse_record(dict(self.VALID, longitude=-73.99, **{name: value}))
+
+
+class ImportGymsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = CustomUser.objects.create_user('owner@example.com', 'Gym', 'Owner', password='secret')
+
+    def source(self, count):
+        records = [
+            {
+                'name': f'Gym {index}', 'street_address1': f'{index} Main St', 'city': 'Brooklyn',
+                'zip_code': '11201', 'country': 'US', 'email': f'gym{index}@example.com',
+                'latitude': 40.69, 'longitude': -73.99, 'hours': 'MON 06:00-22:00',
+            }
+            for index in range(1, count + 1)
+        ]
+        return io.StringIO('\n'.join(json.dumps(record) for record in records))
+
+    def test_resume_skips_committed_rows(self):
+        def interrupt(rows_done, imported):
+            raise KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            import_gyms(self.source(3), 'json', self.owner, 'gyms.jsonl', chunk_size=1, on_chunk=interrupt)
+        self.assertEqual(ImportCheckpoint.objects.get(source='gyms.jsonl').rows_done, 1)
+
+        counts = import_gyms(self.source(3), 'json', self.owner, 'gyms.jsonl', chunk_size=1)
+        self.assertEqual((counts['resumed_at'], counts['imported'], counts['rows']), (1, 2, 3))
+        self.assertEqual(
+            sorted(Gym.objects.values_list('name', flat=True)), ['Gym 1', 'Gym 2', 'Gym 3'],
+        )
+        self.assertEqual(OpeningInterval.objects.count(), 3)
+
+    def test_finished_import_is_not_repeated(self):
+        import_gyms(self.source(2), 'json', self.owner, 'gyms.jsonl')
+        counts = import_gyms(self.source(2), 'json', self.owner, 'gyms.jsonl')
+        self.assertEqual(counts['imported'], 0)
+        self.assertEqual(Gym.objects.count(), 2)
+
+    def test_bad_rows_are_skipped(self):
+        valid = {
+            'name': 'Iron Temple', 'street_address1': '1 Main St', 'city': 'Brooklyn', 'zip_code': '11201',
+            'country': 'US', 'email': 'front@example.com',
+        }
+        features = [
+            {'type': 'Feature', 'properties': valid, 'geometry': {'type': 'Point', 'coordinates': [-73.99, 40.69]}},
+            {'type': 'Feature', 'properties': valid, 'geometry': {'type': 'Point'}},
+            {'type': 'Feature', 'properties': valid, 'geometry': {'type': 'Point', 'coordinates': 5}},
+            {'type': 'Feature', 'properties': valid, 'geometry': 'here'},
+            {'type': 'Feature', 'properties': dict(valid, memberships=[{'type': 'MONTH', 'price': 'NaN'}])},
+            {'type': 'Feature', 'properties': dict(valid, hours=['MON 06:00-22:00'])},
+            {'type': 'Feature', 'properties': dict(valid, classes=7)},
+            'not a feature',
+        ]
+        errors = []
+        counts = import_gyms(
+            io.StringIO(json.dumps({'type': 'FeatureCollection', 'features': features})), 'geojson', self.owner,
+            'gyms.geojson', on_error=lambda number, error: errors.append(number),
+        )
+        self.assertEqual((counts['imported'], counts['skipped']), (1, 7))
+        self.assertEqual(errors, [2, 3, 4, 5, 6, 7, 8])
+
+
+class GymExportViewTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = CustomUser.objects.create_user('owner@example.com', 'Gym', 'Owner', password='secret')
+        cls.staff = CustomUser.objects.create_user(
+            'staff@example.com', 'Staff', 'User', password='secret', is_staff=True,
+        )
+        cls.gym = create_gym(cls.owner)
+        for index in range(2):
+            add_related_rows(cls.gym, index)
+
+    def export(self, format):
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse('gymFindr:gym_export', kwargs={'format': format}))
+        self.assertEqual(response.status_code, 200)
+        return ''.join(
+            chunk.decode('utf-8') if isinstance(chunk, bytes) else chunk for chunk in response.streaming_content
+        )
+
+    def record(self, gym):
+        record = gym_record(export_queryset().get(pk=gym.pk))
+        del record['id']
+        return record
+
+    def test_exports_import_back_unchanged(self):
+        for format in ('csv', 'geojson'):
+            with self.subTest(format=format):
+                content = self.export(format)
+                counts = import_gyms(io.StringIO(content), format, self.owner, f'gyms.{format}')
+                self.assertEqual((counts['imported'], counts['skipped']), (1, 0))
+                imported = Gym.objects.exclude(pk=self.gym.pk).get()
+                self.assertEqual(self.record(imported), self.record(self.gym))
+                imported.delete()
+
+    def test_non_staff_users_are_forbidden(self):
+        self.client.force_login(self.owner)
+        response = self.client.get(reverse('gymFindr:gym_export', kwargs={'format': 'csv'}))
+        self.assertEqual(response.status_code, 403)
+
+
+class CursorTests(SimpleTestCase):
+
+    def test_round_trip(self):
+        cursor = encode_cursor([Decimal('9.99'), 'Iron Temple', 42], backwards=True)
+        self.assertNotIn('=', cursor)
+        self.assertEqual(decode_cursor(cursor), (['9.99', 'Iron Temple', 42], True))
+
+    def test_invalid_cursors_raise(self):
+        not_a_cursor = base64.urlsafe_b64encode(b'{"k": [1]}').decode('ascii')
+        for cursor in ('!!!', 'bm90IGpzb24', not_a_cursor, ''):
+            with self.subTest(cursor=cursor):
+                with self.assertRaises(InvalidCursor):
+                    decode_cursor(cursor)
+
+
+class KeysetPaginationTests(TestCase):
+    ORDERING = ('-free_trial', 'name', 'pk')
+
+    @classmethod
+    def setUpTestData(cls):
+        owner = CustomUser.objects.create_user('owner@example.com', 'Gym', 'Owner', password='secret')
+        for name, free_trial in [('B', False), ('A', True), ('B', True), ('C', False), ('A', False), ('B', False)]:
+            gym = create_gym(owner, name=name)
+            Gym.objects.filter(pk=gym.pk).update(free_trial=free_trial)
+        cls.expected = list(Gym.objects.order_by(*cls.ORDERING))
+
+    def test_keyset_filter_selects_rows_after_and_before(self):
+        for index, gym in enumerate(self.expected):
+            key = row_key(gym, self.ORDERING)
+            with self.subTest(gym=key):
+                after = Gym.objects.filter(keyset_filter(self.ORDERING, key)).order_by(*self.ORDERING)
+                before = Gym.objects.filter(keyset_filter(self.ORDERING, key, backwards=True)).order_by(*self.ORDERING)
+                self.assertEqual(list(after), self.expected[index + 1:])
+                self.assertEqual(list(before), self.expected[:index])
+
+    def test_pages_walk_forwards_and_back(self):
+        pages, cursor = [], None
+        while True:
+            page = paginate_keyset(Gym.objects.all(), self.ORDERING, 4, cursor)
+            pages.append(list(page))
+            if not page.has_next():
+                break
+            cursor = page.next_cursor
+        self.assertEqual([len(rows) for rows in pages], [4, 2])
+        self.assertEqual(pages[0] + pages[1], self.expected)
+
+        previous = paginate_keyset(Gym.objects.all(), self.ORDERING, 4, page.previous_cursor)
+        self.assertEqual(list(previous), pages[0])
+        self.assertFalse(previous.has_previous())
+
+    def test_invalid_cursor_falls_back_to_the_first_page(self):
+        page = paginate_keyset(Gym.objects.all(), self.ORDERING, 4, 'garbage')
+        self.assertEqual(list(page), self.expected[:4])
+
+
+class GymSearchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = CustomUser.objects.create_user('owner@example.com', 'Gym', 'Owner', password='secret')
+
+    def create_gym(self, name, lng=-73.99, lat=40.69):
+        gym = create_gym(self.owner, name=name)
+        if (lng, lat) != (-73.99, 40.69):
+            gym.location.coordinates = Point(lng, lat, srid=4326)
+            gym.location.save()
+        return gym
+
+    def search(self, **data):
+        """Returns the ids of the gyms found by a search form submission, in order."""
+        form = GymSearchForm(data=data)
+        self.assertTrue(form.is_valid(), form.errors)
+        return [document.pk for document in GymSearch(form.cleaned_data).queryset()]
+
+    def test_nearest_gyms_come_first_and_the_radius_bounds_them(self):
+        far = self.create_gym('Newark Barbell', -74.17, 40.73)
+        near = self.create_gym('Brooklyn Barbell')
+        middle = self.create_gym('Heights Barbell', -73.99, 40.72)
+        here = {'use_current_location': 'on', 'lat': '40.69', 'lng': '-73.99'}
+        self.assertEqual(self.search(**here), [near.pk, middle.pk, far.pk])
+        self.assertEqual(self.search(max_distance='5', **here), [near.pk, middle.pk])
+
+    def test_filters_combine_in_one_query(self):
+        yoga = ClassCategory.objects.create(name='YOGA')
+        sauna = Amenity.objects.create(name='SAUNA')
+        match = self.create_gym('Iron Temple')
+        no_class = self.create_gym('Iron Works')
+        no_amenity = self.create_gym('Iron Den')
+        too_far = self.create_gym('Iron Yard', -74.17, 40.73)
+        other_name = self.create_gym('Pump Room')
+        for gym in (match, no_amenity, too_far, other_name):
+            gym.classes.add(yoga)
+        for gym in (match, no_class, too_far, other_name):
+            gym.amenities.add(sauna)
+
+        form = GymSearchForm(data={
+            'query': 'iron', 'class_category': [yoga.pk], 'amenity': [sauna.pk], 'max_distance': '5',
+            'use_current_location': 'on', 'lat': '40.69', 'lng': '-73.99',
+        })
+        self.assertTrue(form.is_valid(), form.errors)
+        with self.assertNumQueries(1):
+            found = [document.pk for document in GymSearch(form.cleaned_data).queryset()]
+        self.assertEqual(found, [match.pk])
+
+    def test_text_matches_are_ranked_by_relevance(self):
+        in_description = self.create_gym('Pump Room')
+        in_description.description = 'Weights, spin and a boxing ring.'
+        in_description.save()
+        in_name = self.create_gym('Boxing Club')
+        self.create_gym('Iron Temple')
+        self.assertEqual(self.search(query='boxing'), [in_name.pk, in_description.pk])
+        # A typo still finds the name by trigram similarity
+        self.assertEqual(self.search(query='boxng'), [in_name.pk])
+
+    def test_class_and_amenity_masks_match_gyms_with_all_selected(self):
+        yoga, zumba, crossfit = (ClassCategory.objects.create(name=name) for name in ('YOGA', 'ZUMBA', 'CROSSFIT'))
+        sauna = Amenity.objects.create(name='SAUNA')
+        both = self.create_gym('Both')
+        both.classes.add(yoga, zumba, crossfit)
+        both.amenities.add(sauna)
+        yoga_only = self.create_gym('Yoga Only')
+        yoga_only.classes.add(yoga)
+        yoga_only.amenities.add(sauna)
+        self.assertEqual(
+            GymSearchDocument.objects.get(pk=both.pk).class_mask, ClassCategory.mask_for(['YOGA', 'ZUMBA', 'CROSSFIT']),
+        )
+        self.assertEqual(self.search(class_category=[yoga.pk, zumba.pk], amenity=[sauna.pk]), [both.pk])
+        self.assertEqual(self.search(class_category=[yoga.pk]), [both.pk, yoga_only.pk])
+
+    def test_search_document_follows_every_kind_of_write(self):
+        gym = self.create_gym('Iron Temple')
+
+        def document():
+            return GymSearchDocument.objects.get(pk=gym.pk)
+
+        self.assertEqual((document().name, document().city), ('Iron Temple', 'Brooklyn'))
+
+        gym.name, gym.free_trial = 'Pump Room', True
+        gym.save()
+        self.assertEqual((document().name, document().free_trial), ('Pump Room', True))
+
+        gym.location.city, gym.location.coordinates = 'Newark', Point(-74.17, 40.73, srid=4326)
+        gym.location.save()
+        self.assertEqual(document().city, 'Newark')
+        self.assertAlmostEqual(document().coordinates.x, -74.17)
+
+        membership = MembershipType.objects.create(gym=gym, type='DAY_PASS', price=Decimal('15.00'))
+        self.assertEqual((document().day_pass_price, document().price_per_month), (Decimal('15.00'), Decimal('450.00')))
+        membership.delete()
+        self.assertEqual((document().day_pass_price, document().price_per_month), (None, None))
+
+        yoga = ClassCategory.objects.create(name='YOGA')
+        sauna = Amenity.objects.create(name='SAUNA')
+        gym.classes.add(yoga)
+        yoga.gym_set.add(self.create_gym('Other Gym'))
+        sauna.gym_set.add(gym)
+        self.assertEqual(
+            (document().class_mask, document().amenity_mask),
+            (ClassCategory.mask_for(['YOGA']), Amenity.mask_for(['SAUNA'])),
+        )
+        gym.classes.clear()
+        sauna.gym_set.clear()
+        self.assertEqual((document().class_mask, document().amenity_mask), (0, 0))
+
+        gym.delete()
+        self.assertFalse(GymSearchDocument.objects.filter(pk=gym.pk).exists())
+
+
+class GymSearchPaginationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        owner = CustomUser.objects.create_user('owner@example.com', 'Gym', 'Owner', password='secret')
+        cls.gym_ids = [create_gym(owner, name=f'Gym {index}').pk for index in range(12)]
+
+    def walk(self):
+        """Follows the next-page cursors of an unfiltered search, returns the gym ids and estimated totals seen."""
+        gym_ids, totals, params = [], [], {'query': ''}
+        while True:
+            response = self.client.get(reverse('gymFindr:gym_search'), params)
+            gym_ids += [document.pk for document in response.context['gyms']]
+            totals.append(response.context.get('estimated_total'))
+            page = response.context['page_obj']
+            if not page.has_next():
+                return gym_ids, totals
+            params = {'query': '', 'cursor': page.next_cursor}
+
+    def test_cursor_pages_cover_every_match_once(self):
+        for cache_results in (True, False):
+            with self.subTest(cache_results=cache_results):
+                with unittest.mock.patch.object(GymSearchView, 'cache_results', cache_results):
+                    gym_ids, totals = self.walk()
+                self.assertEqual(gym_ids, sorted(self.gym_ids))
+                self.assertIsInstance(totals[0], int)
+                self.assertEqual(totals[1:], [None])
+
+    def test_estimate_count(self):
+        self.assertIsInstance(estimate_count(GymSearchDocument.objects.all()), int)
+        self.assertEqual(estimate_count(GymSearchDocument.objects.none()), 0)
+
+
+class GymSearchPriceTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        owner = CustomUser.objects.create_user('owner@example.com', 'Gym', 'Owner', password='secret')
+        cls.gyms = [create_gym(owner, name=f'Gym {index}') for index in range(12)]
+        # Day passes get dearer and memberships cheaper with the index
+        for index, gym in enumerate(cls.gyms):
+            MembershipType.objects.create(gym=gym, type='DAY_PASS', price=Decimal(5 + index))
+            MembershipType.objects.create(gym=gym, type='MONTH', price=Decimal(100 - index))
+        cls.unpriced = create_gym(owner, name='Free Gym')
+
+    def setUp(self):
+        caches[SEARCH_CACHE_ALIAS].clear()
+
+    def search(self, **params):
+        return self.client.get(reverse('gymFindr:gym_search'), {'query': '', **params})
+
+    def test_price_filter_applies_to_the_chosen_pass_type(self):
+        response = self.search(pass_type='DAY_PASS', min_price='7', max_price='9')
+        self.assertEqual([gym.pk for gym in response.context['gyms']], [gym.pk for gym in self.gyms[2:5]])
+        self.assertContains(response, 'Day Pass: $7.00')
+        self.assertNotContains(response, '/month')
+
+    def test_price_sort_follows_the_chosen_pass_type(self):
+        response = self.search(pass_type='MONTH', sort='price')
+        self.assertEqual([gym.pk for gym in response.context['gyms']], [gym.pk for gym in self.gyms[:1:-1]])
+        self.assertContains(response, 'Monthly Membership: $89.00')
+
+    def test_cursor_pages_under_the_price_sort(self):
+        for cache_results in (True, False):
+            with self.subTest(cache_results=cache_results):
+                gym_ids, params = [], {'pass_type': 'MONTH', 'sort': 'price'}
+                with unittest.mock.patch.object(GymSearchView, 'cache_results', cache_results):
+                    while True:
+                        response = self.search(**params)
+                        gym_ids += [gym.pk for gym in response.context['gyms']]
+                        page = response.context['page_obj']
+                        if not page.has_next():
+                            break
+                        params['cursor'] = page.next_cursor
+                self.assertEqual(gym_ids, [gym.pk for gym in reversed(self.gyms)])
+
+
+class ParseBBoxTests(SimpleTestCase):
+
+    def test_plain_viewport(self):
+        self.assertEqual(parse_bbox('-74.1,40.6,-73.9,40.8'), [(-74.1, 40.6, -73.9, 40.8)])
+
+    def test_viewport_across_the_antimeridian_is_split(self):
+        expected = [(170.0, -20.0, 180, -10.0), (-180, -20.0, -170.0, -10.0)]
+        # Leaflet keeps counting past 180 when panning east, and past -180 when panning west
+        self.assertEqual(parse_bbox('170,-20,190,-10'), expected)
+        self.assertEqual(parse_bbox('-190,-20,-170,-10'), expected)
+
+    def test_viewport_ending_on_the_antimeridian_is_not_split(self):
+        self.assertEqual(parse_bbox('170,-20,180,-10'), [(170.0, -20.0, 180, -10.0)])
+
+    def test_viewport_wider_than_the_world(self):
+        self.assertEqual(parse_bbox('-200,-80,200,80'), [(-180, -80.0, 180, 80.0)])
+
+    def test_invalid_viewports(self):
+        for value in (
+            None, '', '1,2,3', 'a,b,c,d', '10,50,20,40', '20,40,10,50', '0,-100,10,10', 'nan,0,1,1', '-inf,0,inf,1',
+        ):
+            with self.subTest(value=value):
+                with self.assertRaises(InvalidBBox):
+                    parse_bbox(value)
+
+
+class SearchCacheInvalidationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = CustomUser.objects.create_user('owner@example.com', 'Gym', 'Owner', password='secret')
+        cls.gym = create_gym(cls.owner)
+
+    def setUp(self):
+        caches[SEARCH_CACHE_ALIAS].clear()
+        self.search = GymSearch({'query': ''})
+        get_cached_page(self.search, 10)
+
+    def assertCacheMissed(self):
+        key = search_cache_key(self.search, catalog_version()[0])
+        self.assertIsNone(caches[SEARCH_CACHE_ALIAS].get(key))
+
+    def test_entry_is_cached_under_the_database_version(self):
+        self.assertIsNotNone(caches[SEARCH_CACHE_ALIAS].get(search_cache_key(self.search, catalog_version()[0])))
+
+    def test_gym_write_misses(self):
+        self.gym.name = 'Pump Room'
+        self.gym.save()
+        self.assertCacheMissed()
+
+    def test_new_gym_is_listed(self):
+        other = create_gym(self.owner, name='Pump Room')
+        page, total = get_cached_page(GymSearch({'query': ''}), 10)
+        self.assertEqual([document.pk for document in page], [self.gym.pk, other.pk])
+        self.assertEqual(total, 2)
+
+    def test_location_write_misses(self):
+        location = self.gym.location
+        location.city = 'Queens'
+        location.save()
+        self.assertCacheMissed()
+
+    def test_document_refresh_misses(self):
+        refresh_search_documents([self.gym.pk])
+        self.assertCacheMissed()
+
+    def test_deleted_gym_misses(self):
+        self.gym.delete()
+        self.assertCacheMissed()
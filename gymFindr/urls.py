@@ -1,6 +1,6 @@
 from django.urls import path
 from django.contrib.auth import views as auth_views
-from .views import GymListView, GymDetailView, GymCreateView, GymUpdateView, GymDeleteView, MyGymsView, GymSearchView
+from .views import GymListView, GymDetailView, GymCreateView, GymUpdateView, GymDeleteView, MyGymsView, GymSearchView, GymMarkersView, GeocodeCacheStatsView, GymExportView, GymFavoriteView
 
 app_name = 'gymFindr'
 
@@ -10,6 +10,11 @@ urlpatterns = [
     path('gym/new/', GymCreateView.as_view(), name='gym_create'),
     path('gym/<int:pk>/edit/', GymUpdateView.as_view(), name='gym_edit'),
     path('gym/<int:pk>/delete/', GymDeleteView.as_view(), name='gym_delete'),
+    path('gym/<int:pk>/favorite/', GymFavoriteView.as_view(), name='gym_favorite'),
+    path('gym/<int:pk>/unfavorite/', GymFavoriteView.as_view(favorite=False), name='gym_unfavorite'),
     path('my-gyms/', MyGymsView.as_view(), name='my_gyms'),
     path('search/', GymSearchView.as_view(), name='gym_search'),
+    path('search/markers/', GymMarkersView.as_view(), name='gym_markers'),
+    path('geocode-stats/', GeocodeCacheStatsView.as_view(), name='geocode_stats'),
+    path('export/<str:format>/', GymExportView.as_view(), name='gym_export'),
 ]
@@ -1,23 +1,36 @@
-import requests
 from django.views.generic import ListView, DetailView
 from django.views.generic.edit import CreateView, UpdateView, DeleteView
 from django.contrib.auth.views import LoginView, LogoutView
 from django.core.paginator import Paginator
-from django.urls import reverse_lazy
-from django.shortcuts import redirect, render
-from django.core.exceptions import ValidationError
-from .models import Gym
-from django.db.models import Q
-from .forms import GymForm, CustomUserCreationForm, LocationForm, ContactInfoForm, GymImageFormSet, MembershipTypeFormSet, OperatingHourFormSet, GymSearchForm
-from .models import Location, ContactInfo, Gym
+from django.urls import reverse, reverse_lazy
+from django.shortcuts import get_object_or_404, redirect, render
+from django.template.loader import render_to_string
+from django.utils.decorators import method_decorator
+from django.utils.http import url_has_allowed_host_and_scheme
+from django.utils.safestring import mark_safe
+from django.views.decorators.http import condition
+from django.forms import all_valid
+from django.db.models import Prefetch
+from .forms import GymForm, CustomUserCreationForm, GymSearchForm
+from .models import Location, ContactInfo, Favorite, Gym, GymSearchDocument, GymImage, MembershipType, Amenity, ClassCategory, OperatingHour
 from django.contrib.auth.forms import UserCreationForm
 from django.views import generic
-from django.contrib.auth.mixins import LoginRequiredMixin
+from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.contrib.auth import get_user_model
-from django.http import HttpResponseForbidden
-from django.conf import settings
-from django.contrib.gis.geos import Point, fromstr
-from django.contrib.gis.db.models.functions import Distance
+from django.http import Http404, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
+from django.contrib.gis.geos import fromstr
+from .search import GymSearch
+from .detail_cache import get_detail_fragment, gym_updated_at, set_detail_fragment
+from .conditional import catalog_etag, catalog_last_modified, gym_detail_etag, search_etag
+from .pagination import KeysetPaginationMixin, estimate_count
+from .search_cache import SEARCH_CACHE_GRID, get_cached_page
+from .markers import (
+    MARKER_CLUSTER_MAX_ZOOM, InvalidBBox, clusters_geojson, in_bbox, markers_geojson, parse_bbox,
+)
+from .geocoding import geocode_cache_stats
+from .exporting import EXPORT_FORMATS, export_catalog
+from .services import gym_related_forms, save_gym
+from .favorites import add_favorite, remove_favorite, with_favorite_state
 
 
 User = get_user_model()
@@ -59,169 +72,95 @@ class CustomLoginView(LoginView):
 class CustomLogoutView(LogoutView):
     next_page = reverse_lazy('login')
 
-class GymListView(ListView):
+@method_decorator(condition(etag_func=catalog_etag, last_modified_func=catalog_last_modified), name='get')
+class GymListView(KeysetPaginationMixin, ListView):
     model = Gym
     context_object_name = 'gyms'
     template_name = 'gyms/gym_list.html'
+    paginate_by = 20
 
+    def get_queryset(self):
+        return with_favorite_state(Gym.objects.only('pk', 'name', 'excerpt'), self.request.user)
+
+# No Last-Modified: the page differs per user, which only the ETag tells apart
+@method_decorator(condition(etag_func=gym_detail_etag), name='get')
 class GymDetailView(DetailView):
     model = Gym
     context_object_name = 'gym'
     template_name = 'gyms/gym_detail.html'
+    public_template_name = 'gyms/gym_detail_public.html'
 
-def geocode_address(address):
-    """Converts address to coordinates using Google Maps Geocoding API."""
-    api_url = 'https://maps.googleapis.com/maps/api/geocode/json'
-    params = {'address': address, 'key': settings.GOOGLE_MAPS_API_KEY}
-    response = requests.get(api_url, params=params)
-    if response.status_code == 200:
-        data = response.json()
-        if data['results']:
-            location = data['results'][0]['geometry']['location']
-            return location['lat'], location['lng']
-    return None, None
-
-class GymCreateView(LoginRequiredMixin, CreateView):
-    model = Gym
-    form_class = GymForm
-    template_name = 'gyms/gym_edit.html'
-    success_url = reverse_lazy('gymFindr:gym_list')
+    def get_queryset(self):
+        # Everything gym_detail.html touches, in a fixed number of queries
+        return Gym.objects.select_related('location', 'contact_info', 'owner').prefetch_related(
+            Prefetch('images', queryset=GymImage.objects.order_by('pk')),
+            Prefetch('membership_types', queryset=MembershipType.objects.order_by('price', 'pk')),
+            Prefetch('amenities', queryset=Amenity.objects.order_by('name')),
+            Prefetch('classes', queryset=ClassCategory.objects.order_by('name')),
+            Prefetch('operating_hours', queryset=OperatingHour.objects.order_by(OperatingHour.week_order(), 'open_time')),
+        )
+
+    def get(self, request, *args, **kwargs):
+        # The public part of the page is cached per gym and updated_at, which the
+        # ETag check already read, so a hit runs no other gym queries;
+        # only the owner's Edit/Delete block is per-request
+        gym_id = self.kwargs[self.pk_url_kwarg]
+        fragment = get_detail_fragment(gym_id, gym_updated_at(request, gym_id))
+        self.object = None
+        if fragment is None:
+            self.object = self.get_object()
+            html = render_to_string(self.public_template_name, {'gym': self.object})
+            fragment = set_detail_fragment(self.object, html)
+        context = self.get_context_data(
+            gym_id=gym_id,
+            gym_owner_id=fragment['owner_id'],
+            gym_public_html=mark_safe(fragment['html']),
+        )
+        if request.user.is_authenticated:
+            context['is_favorite'] = Favorite.objects.filter(user=request.user, gym_id=gym_id).exists()
+        return self.render_to_response(context)
+
+class GymFormsMixin:
+    """Edits a gym together with the forms from ``gym_related_forms``.
+
+    The related forms are built and validated once per request, then saved
+    by ``save_gym``.
+    """
+
+    def get_related_forms(self):
+        if not hasattr(self, '_related_forms'):
+            if self.request.method == 'POST':
+                self._related_forms = gym_related_forms(self.object, self.request.POST, self.request.FILES)
+            else:
+                self._related_forms = gym_related_forms(self.object)
+        return self._related_forms
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        if self.request.POST:
-            context['location_form'] = LocationForm(self.request.POST, prefix='location')
-            context['contact_info_form'] = ContactInfoForm(self.request.POST, prefix='contact_info')
-            context['image_formset'] = GymImageFormSet(self.request.POST, self.request.FILES, prefix='images')
-            context['membership_formset'] = MembershipTypeFormSet(self.request.POST, prefix='memberships')
-            context['operating_hour_formset'] = OperatingHourFormSet(self.request.POST, prefix='operating_hours')
-        else:
-            context['location_form'] = LocationForm(prefix='location')
-            context['contact_info_form'] = ContactInfoForm(prefix='contact_info')
-            context['image_formset'] = GymImageFormSet(prefix='images')
-            context['membership_formset'] = MembershipTypeFormSet(prefix='memberships')
-            context['operating_hour_formset'] = OperatingHourFormSet(prefix='operating_hours')
+        context.update(self.get_related_forms())
         return context
 
     def form_valid(self, form):
-        context = self.get_context_data()
-        location_form = context['location_form']
-        contact_info_form = context['contact_info_form']
-        image_formset = context['image_formset']
-        membership_formset = context['membership_formset']
-        operating_hour_formset = context['operating_hour_formset']
-
-        if (form.is_valid() and location_form.is_valid() and contact_info_form.is_valid() and
-            image_formset.is_valid() and membership_formset.is_valid() and operating_hour_formset.is_valid()):
-            self.object = form.save(commit=False)
-            self.object.owner = self.request.user
-
-            # Explicitly saving location and contact info first
-            # location = location_form.save()
-            location = location_form.save(commit=False)
-            full_address = f"{location.street_address1}, {location.city}, {location.zip_code}, {location.country}"
-            lat, lng = geocode_address(full_address)
-            if lat and lng:
-                # If geocoding is successful, use the precise coordinates
-                location.coordinates = Point(lng, lat, srid=4326)
-            else:
-                # Fallback: Attempt geocoding with just city and country (or zip code)
-                fallback_address = f"{location.city}, {location.country}"
-                lat, lng = geocode_address(fallback_address)
-                if lat and lng:
-                    location.coordinates = Point(lng, lat, srid=4326)
-                else:
-                     # Set to default New York City coordinates
-                     location.coordinates = Point(-74.0060, 40.7128, srid=4326)  # Placeholder or predefined point
-            location.save()
-            contact_info = contact_info_form.save()
-            self.object.location = location
-            self.object.contact_info = contact_info
-            self.object.save()
-            self.object.classes.set(form.cleaned_data['classes'])
-            self.object.amenities.set(form.cleaned_data['amenities'])
-            # Saving formsets with the instance
-            image_formset.instance = self.object
-            image_formset.save()
-            membership_formset.instance = self.object
-            membership_formset.save()
-            operating_hour_formset.instance = self.object
-            operating_hour_formset.save()
-            return redirect(self.get_success_url())
-        else:
-            return self.render_to_response(context)
+        if not all_valid(self.get_related_forms().values()):
+            return self.form_invalid(form)
+        self.object = save_gym(form, self.get_related_forms(), owner=self.request.user)
+        return redirect(self.get_success_url())
 
-class GymUpdateView(LoginRequiredMixin, UpdateView):
+class GymCreateView(LoginRequiredMixin, GymFormsMixin, CreateView):
     model = Gym
     form_class = GymForm
     template_name = 'gyms/gym_edit.html'
     success_url = reverse_lazy('gymFindr:gym_list')
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        instance = self.get_object()
-        if self.request.POST:
-            context['location_form'] = LocationForm(self.request.POST, instance=instance.location, prefix='location')
-            context['contact_info_form'] = ContactInfoForm(self.request.POST, instance=instance.contact_info, prefix='contact_info')
-            context['image_formset'] = GymImageFormSet(self.request.POST, self.request.FILES, instance=instance, prefix='images')
-            context['membership_formset'] = MembershipTypeFormSet(self.request.POST, instance=instance, prefix='memberships')
-            context['operating_hour_formset'] = OperatingHourFormSet(self.request.POST, instance=instance, prefix='operating_hours')
-        else:
-            context['location_form'] = LocationForm(instance=instance.location, prefix='location')
-            context['contact_info_form'] = ContactInfoForm(instance=instance.contact_info, prefix='contact_info')
-            context['image_formset'] = GymImageFormSet(instance=instance, prefix='images')
-            context['membership_formset'] = MembershipTypeFormSet(instance=instance, prefix='memberships')
-            context['operating_hour_formset'] = OperatingHourFormSet(instance=instance, prefix='operating_hours')
-        return context
+class GymUpdateView(LoginRequiredMixin, GymFormsMixin, UpdateView):
+    model = Gym
+    form_class = GymForm
+    template_name = 'gyms/gym_edit.html'
+    success_url = reverse_lazy('gymFindr:gym_list')
 
-    def form_valid(self, form):
-        context = self.get_context_data()
-        location_form = context['location_form']
-        contact_info_form = context['contact_info_form']
-        image_formset = context['image_formset']
-        membership_formset = context['membership_formset']
-        operating_hour_formset = context['operating_hour_formset']
-
-        if form.is_valid() and location_form.is_valid() and contact_info_form.is_valid() \
-                and image_formset.is_valid() and membership_formset.is_valid() and operating_hour_formset.is_valid():
-
-            self.object = form.save()
-            # Saving Location and ContactInfo with explicit reference
-            location = location_form.save(commit=False)
-            full_address = f"{location.street_address1}, {location.city}, {location.zip_code}, {location.country}"
-            lat, lng = geocode_address(full_address)
-
-            if lat and lng:
-                # If geocoding is successful, use the precise coordinates
-                location.coordinates = Point(lng, lat, srid=4326)
-            else:
-                # Fallback: Attempt geocoding with just city and country (or zip code)
-                fallback_address = f"{location.city}, {location.country}"
-                lat, lng = geocode_address(fallback_address)
-                if lat and lng:
-                    location.coordinates = Point(lng, lat, srid=4326)
-                else:
-                     # Set to default New York City coordinates
-                     location.coordinates = Point(-74.0060, 40.7128, srid=4326)  # Placeholder or predefined point
-            location.save()
-            contact_info = contact_info_form.save()
-            self.object.location = location
-            self.object.contact_info = contact_info
-            self.object.save()
-            self.object.classes.set(form.cleaned_data['classes'])
-            self.object.amenities.set(form.cleaned_data['amenities'])
-
-            # Saving formsets with the instance
-            image_formset.instance = self.object
-            image_formset.save()
-            membership_formset.instance = self.object
-            membership_formset.save()
-
-            operating_hour_formset.instance = self.object
-            operating_hour_formset.save()
-            return redirect(self.get_success_url())
-        else:
-            return self.render_to_response(context)
+    def get_queryset(self):
+        # The location and contact forms are bound to these, without another query each
+        return Gym.objects.select_related('location', 'contact_info')
 
 class GymDeleteView(DeleteView):
     model = Gym
@@ -229,70 +168,142 @@ class GymDeleteView(DeleteView):
     success_url = reverse_lazy('gymFindr:gym_list')
     template_name = 'gyms/gym_confirm_delete.html'
 
-class MyGymsView(LoginRequiredMixin, ListView):
+class GymFavoriteView(LoginRequiredMixin, generic.View):
+    """Adds a gym to the user's favorites, or removes it when ``favorite`` is False.
+
+    Repeating a request changes nothing. Clients that only accept JSON get
+    the gym's new state back; others are redirected to ``next`` or the gym.
+    """
+    http_method_names = ['post']
+    favorite = True
+
+    def post(self, request, *args, **kwargs):
+        gym_id = get_object_or_404(Gym.objects.only('pk'), pk=kwargs['pk']).pk
+        if self.favorite:
+            add_favorite(request.user, gym_id)
+        else:
+            remove_favorite(request.user, gym_id)
+        if request.accepts('application/json') and not request.accepts('text/html'):
+            favorite_count = Gym.objects.filter(pk=gym_id).values_list('favorite_count', flat=True).get()
+            return JsonResponse({'gym': gym_id, 'favorited': self.favorite, 'favorite_count': favorite_count})
+        next_url = request.POST.get('next')
+        if not url_has_allowed_host_and_scheme(next_url, allowed_hosts={request.get_host()}, require_https=request.is_secure()):
+            next_url = reverse('gymFindr:gym_detail', kwargs={'pk': gym_id})
+        return redirect(next_url)
+
+class MyGymsView(LoginRequiredMixin, KeysetPaginationMixin, ListView):
     model = Gym
     template_name = 'gyms/my_gyms.html'
+    paginate_by = 50
 
     def get_queryset(self):
-        return Gym.objects.filter(owner=self.request.user)
+        return Gym.objects.filter(owner=self.request.user).only('pk', 'name')
 
 
-class GymSearchView(ListView):
-    model = Gym
+# No Last-Modified: results also depend on the geocoder, which only the ETag covers
+@method_decorator(condition(etag_func=search_etag), name='get')
+class GymSearchView(KeysetPaginationMixin, ListView):
+    model = GymSearchDocument
     template_name = 'gyms/gym_search.html'
     context_object_name = 'gyms'
     paginate_by = 10
+    # Show the planner's estimate of the number of matches rather than counting them
+    estimate_total = True
+    # Serve pages from the shared search result cache when they fall inside it
+    cache_results = True
 
     def get_queryset(self):
-        queryset = super().get_queryset()
         self.form = GymSearchForm(self.request.GET or None)
-        if self.form.is_bound:
-            try:
-                self.form.is_valid()
-            except ValidationError:
-                return Gym.objects.none()
-
-            use_current_location = self.request.GET.get('use_current_location') == 'on'
-            lat = self.request.GET.get('lat')
-            lng = self.request.GET.get('lng')
-            search_location = self.form.cleaned_data.get('search_location')
-
-            if use_current_location and lat and lng:
-                try:
-                    lat = float(lat)
-                    lng = float(lng)
-                    user_location = Point(lng, lat, srid=4326)
-                    queryset = queryset.annotate(distance=Distance('location__coordinates', user_location)).order_by('distance')
-                except ValueError:
-                    # Handle the error when conversion fails
-                    queryset = Gym.objects.none()
-            elif search_location:
-                # Use the search_location to geocode and filter the queryset based on distance
-                lat, lng = geocode_address(search_location)  # Implement this function based on your geocoding service
-                if lat is not None and lng is not None:
-                    search_point = Point(lng, lat, srid=4326)
-                    queryset = queryset.annotate(distance=Distance('location__coordinates', search_point)).order_by('distance')
-                else:
-                    # Fallback if geocoding fails or no location found
-                    queryset = Gym.objects.none()
-            else:
-                # Your existing filters for query, class_category, and amenity
-                filters = Q()
-                query = self.form.cleaned_data.get('query')
-                class_category = self.form.cleaned_data.get('class_category')
-                amenity = self.form.cleaned_data.get('amenity')
-                if query:
-                    filters |= Q(name__icontains=query) | Q(description__icontains=query)
-                if class_category:
-                    filters &= Q(classes=class_category)
-                if amenity:
-                    filters &= Q(amenities=amenity)
-                queryset = queryset.filter(filters).distinct()
-        else:
-            queryset = Gym.objects.none()
-        return queryset
+        self.search = None
+        self.cached_page = self.cached_total = None
+        if not self.form.is_valid():
+            return GymSearchDocument.objects.none()
+        self.search = GymSearch(self.form.cleaned_data, grid=SEARCH_CACHE_GRID, request=self.request)
+        if self.cache_results:
+            self.cached_page, self.cached_total = get_cached_page(
+                self.search, self.paginate_by, self.request.GET.get(self.cursor_kwarg),
+                documents=with_favorite_state(GymSearchDocument.objects.all(), self.request.user),
+                request=self.request,
+            )
+            if self.cached_page is not None:
+                return GymSearchDocument.objects.none()
+        return with_favorite_state(self.search.queryset(super().get_queryset()), self.request.user)
+
+    def get_keyset_ordering(self):
+        return self.search.ordering if self.search else ('pk',)
+
+    def paginate_queryset(self, queryset, page_size):
+        if self.cached_page is not None:
+            return None, self.cached_page, self.cached_page.object_list, self.cached_page.has_other_pages()
+        return super().paginate_queryset(queryset, page_size)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['form'] = self.form
+        # Show the price the results were filtered and sorted on
+        price_field = self.search.price_field if self.search else 'price_per_month'
+        for gym in context['gyms']:
+            gym.shown_price = getattr(gym, price_field)
+        if self.search and self.search.data.get('pass_type'):
+            context['pass_type_label'] = dict(MembershipType.MEMBERSHIP_CHOICES)[self.search.data['pass_type']]
+        if self.estimate_total and self.search and not self.request.GET.get(self.cursor_kwarg):
+            if self.cached_page is not None:
+                context['estimated_total'] = self.cached_total
+            else:
+                context['estimated_total'] = estimate_count(self.object_list)
         return context
+
+
+@method_decorator(condition(etag_func=catalog_etag, last_modified_func=catalog_last_modified), name='get')
+class GymMarkersView(generic.View):
+    """GeoJSON markers inside ``bbox`` matching the search page's filters.
+
+    The location fields are ignored; the viewport takes their place. Pass
+    the map's ``zoom`` to get clusters instead of gyms when zoomed out.
+    """
+
+    def get(self, request, *args, **kwargs):
+        try:
+            envelopes = parse_bbox(request.GET.get('bbox'))
+        except InvalidBBox:
+            return JsonResponse({'error': 'bbox must be west,south,east,north'}, status=400)
+        form = GymSearchForm(request.GET)
+        if not form.is_valid():
+            return JsonResponse({'error': form.errors.get_json_data()}, status=400)
+        try:
+            zoom = int(float(request.GET['zoom'])) if request.GET.get('zoom') else None
+        except (ValueError, OverflowError):
+            # nan and inf parse as floats, but have no integer value
+            return JsonResponse({'error': 'zoom must be an integer'}, status=400)
+        queryset = in_bbox(GymSearchDocument.objects.filter(GymSearch(form.cleaned_data).filters()), envelopes)
+        if zoom is not None and zoom < MARKER_CLUSTER_MAX_ZOOM:
+            data = clusters_geojson(queryset, max(zoom, 0))
+        else:
+            data = markers_geojson(queryset)
+        return JsonResponse(data, json_dumps_params={'separators': (',', ':')})
+
+
+class GeocodeCacheStatsView(UserPassesTestMixin, generic.View):
+    """Staff-only hit/miss counters for this worker's geocoding cache."""
+
+    def test_func(self):
+        return self.request.user.is_staff
+
+    def get(self, request, *args, **kwargs):
+        return JsonResponse(geocode_cache_stats())
+
+
+class GymExportView(UserPassesTestMixin, generic.View):
+    """Staff-only download of the whole catalog, streamed as it is read."""
+
+    def test_func(self):
+        return self.request.user.is_staff
+
+    def get(self, request, *args, **kwargs):
+        format = kwargs['format']
+        if format not in EXPORT_FORMATS:
+            raise Http404(f'Unknown export format {format!r}')
+        _, content_type, extension = EXPORT_FORMATS[format]
+        response = StreamingHttpResponse(export_catalog(format), content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="gyms.{extension}"'
+        return response
@@ -31,6 +31,31 @@ SECRET_KEY = os.environ.get('SECRET_KEY')
 
 GOOGLE_MAPS_API_KEY = os.getenv('GOOGLE_MAPS_API_KEY')
 
+# Geocoders tried in order; the offline gazetteer answers city and zip
+# searches without a network call, see gymFindr.geocoders
+GEOCODER_BACKENDS = [
+    {
+        'BACKEND': 'gymFindr.geocoders.GazetteerGeocoder',
+        'OPTIONS': {'path': os.getenv('GEOCODER_GAZETTEER_PATH', BASE_DIR / 'data' / 'gazetteer.csv')},
+    },
+    {
+        'BACKEND': 'gymFindr.geocoders.GoogleGeocoder',
+        'OPTIONS': {'timeout': (3.05, 10), 'pool_size': 10},
+    },
+]
+
+# Geocoding cache lifetimes in seconds; misses are cached for a shorter time
+GEOCODE_CACHE_TTL = 60 * 60 * 24 * 30
+GEOCODE_NEGATIVE_CACHE_TTL = 60 * 60 * 24
+GEOCODE_CACHE_MAX_ENTRIES = 10000
+
+# Retry policy of the geocode_worker command, delays in seconds
+GEOCODE_MAX_ATTEMPTS = 5
+GEOCODE_RETRY_BASE_DELAY = 60
+GEOCODE_RETRY_MAX_DELAY = 60 * 60 * 6
+# Seconds a worker may hold a claimed task before another worker retries it
+GEOCODE_CLAIM_TIMEOUT = 60 * 10
+
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
 
@@ -48,6 +73,7 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     'gymFindr',
     'django.contrib.gis',
+    'django.contrib.postgres',
 ]
 
 MIDDLEWARE = [
@@ -97,6 +123,54 @@ DATABASES = {
 }
 
 
+# Caches
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# The search result cache lives in SEARCH_CACHE_ALIAS. Its entries are keyed
+# by the catalog version in the database, so a per-process backend is never
+# stale; point it at a shared one (FileBasedCache, or RedisCache with LOCATION
+# 'redis://127.0.0.1:6379') so that workers also share their entries.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'search': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'gym-search',
+        'OPTIONS': {'MAX_ENTRIES': 5000},
+    },
+}
+
+SEARCH_CACHE_ALIAS = 'search'
+SEARCH_CACHE_TIMEOUT = 300
+# Browser locations are snapped to cells of this many degrees (~1 km)
+SEARCH_CACHE_GRID = 0.01
+SEARCH_CACHE_MAX_RESULTS = 200
+
+# Seconds each process keeps its copy of the ClassCategory/Amenity rows
+TAXONOMY_CACHE_TIMEOUT = 300
+
+# Map marker endpoint: features per response and coordinate decimals
+MARKER_MAX_FEATURES = 500
+MARKER_PRECISION = 5
+# Below this zoom markers are clustered on a grid of this many cells per map tile
+MARKER_CLUSTER_MAX_ZOOM = 15
+MARKER_CLUSTER_CELLS_PER_TILE = 4
+
+# In-process nearest-gym engine for unfiltered location searches (needs NumPy).
+# It still needs PostGIS for every search it cannot answer.
+SPATIAL_ENGINE_ENABLED = os.getenv('SPATIAL_ENGINE_ENABLED', '') == '1'
+SPATIAL_ENGINE_CELL_SIZE = 0.1
+SPATIAL_ENGINE_REBUILD_INTERVAL = 300
+SPATIAL_ENGINE_MAX_CANDIDATES = 1000
+
+# import_gyms: rows saved per transaction and geocoding threads
+IMPORT_CHUNK_SIZE = 500
+IMPORT_GEOCODE_WORKERS = 4
+# export_gyms and the staff export endpoint: gyms fetched per batch
+EXPORT_CHUNK_SIZE = 2000
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 